@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Times a production refresh with the Guidception branch enabled, against
+the recursive implementation it replaced.
+
+    $ python -m benchmarks.bench_guidception [num_guids] [depth] [sla_seconds]
+
+The recursive implementation is only run on random rows for
+RECURSIVE_BUDGET_SECONDS, as it visits degree ** levels rows for each one,
+and its cost for all rows is extrapolated.  The exit status is 1 when the
+refresh does not complete within sla_seconds.
+"""
+import logging
+import random
+import signal
+import sys
+import time
+
+from taar_lite.app.production import NORM_MODE_GUIDCEPTION, build_treatment_pipeline
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.treatments import Guidception, RowNormalizationMixin
+
+from .synthetic import power_law_coinstall_dict, ranking_dict_for
+
+RECURSIVE_BUDGET_SECONDS = 10
+RECURSION_LEVELS = 3
+
+
+class RecursiveGuidception(RowNormalizationMixin):
+    """The recursive implementation Guidception replaced."""
+
+    def __init__(self, coinstallations):
+        self._coinstallations = coinstallations
+
+    def treat_row(self, coinstalls):
+        return self._compute_recursive_results(self._normalize_row_weights(coinstalls), RECURSION_LEVELS)
+
+    def _compute_recursive_results(self, row_normalized_coinstall, level):
+        if level <= 0:
+            return row_normalized_coinstall
+        consolidated_coinstall_dict = {}
+        dampener = (1.0 - (1.0 * (RECURSION_LEVELS - level) / RECURSION_LEVELS)) ** 2
+        for _, _ in row_normalized_coinstall.items():
+            for guid, guid_weight in row_normalized_coinstall.items():
+                consolidated_coinstall_dict[guid] = consolidated_coinstall_dict.get(guid, 0) + dampener * guid_weight
+        level -= 1
+        for guid in consolidated_coinstall_dict:
+            next_level_coinstalls = self._coinstallations.get(guid, {})
+            if next_level_coinstalls != {}:
+                next_level_coinstalls = self._normalize_row_weights(next_level_coinstalls)
+                next_level_results = self._compute_recursive_results(next_level_coinstalls, level)
+                for _, next_level_weight in next_level_results.items():
+                    consolidated_coinstall_dict[guid] += next_level_weight
+        return self._normalize_row_weights(consolidated_coinstall_dict)
+
+
+class BudgetSpent(Exception):
+    pass
+
+
+def _budget_spent(signum, frame):
+    raise BudgetSpent()
+
+
+def time_recursive(coinstall_dict):
+    """Returns the rows the recursive implementation treated within the
+    budget and the time it took, checking them against Guidception.
+    """
+    recursive = RecursiveGuidception(coinstall_dict)
+    actual = Guidception().treat(coinstall_dict)
+    sample = random.Random(42).sample(list(coinstall_dict), len(coinstall_dict))
+
+    rows = 0
+    start = time.perf_counter()
+    # A single row can take longer than the budget
+    signal.signal(signal.SIGALRM, _budget_spent)
+    signal.setitimer(signal.ITIMER_REAL, RECURSIVE_BUDGET_SECONDS)
+    try:
+        for guid in sample:
+            expected = recursive.treat_row(coinstall_dict[guid])
+            # It matches the default depth
+            assert all(abs(actual[guid][key] - weight) < 1e-9 for key, weight in expected.items())
+            rows += 1
+    except BudgetSpent:
+        pass
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return rows, time.perf_counter() - start
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(num_guids=50000, depth=3, sla_seconds=60.0):
+    coinstall_dict = power_law_coinstall_dict(num_guids)
+    # Keep every guid above the MinInstallPrune threshold
+    ranking_dict = {guid: rank + 1000 for guid, rank in ranking_dict_for(coinstall_dict).items()}
+    num_edges = sum(len(coinstalls) for coinstalls in coinstall_dict.values())
+    print("Synthetic graph: {} guids, {} edges".format(num_guids, num_edges))
+
+    rows, recursive_seconds = time_recursive(coinstall_dict)
+    if rows:
+        print("{:<32}{:8.3f}s for {} rows, ~{:.0f}s for all rows".format(
+            "recursive Guidception:", recursive_seconds, rows, recursive_seconds / rows * num_guids))
+    else:
+        print("{:<32}{:8.3f}s without completing a row".format("recursive Guidception:", recursive_seconds))
+
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    _, dict_seconds = timed(Guidception(depth).treat, coinstall_dict)
+    _, graph_seconds = timed(Guidception(depth).treat_graph, graph)
+    print("{:<32}{:8.3f}s".format("Guidception.treat:", dict_seconds))
+    print("{:<32}{:8.3f}s".format("Guidception.treat_graph:", graph_seconds))
+
+    pipeline = build_treatment_pipeline(ranking_dict, logging.getLogger('bench_guidception'), depth)
+    _, refresh_seconds = timed(pipeline.build_recommenders, graph, tie_breaker_dict=ranking_dict,
+                               validate_raw_coinstall_dict=False, precompute_limit=10)
+    for stage, seconds in pipeline.timings.items():
+        print("  {:<30}{:8.3f}s".format(stage, seconds))
+    guidception_seconds = (pipeline.timings['branch.' + NORM_MODE_GUIDCEPTION] +
+                           pipeline.timings['recommender.' + NORM_MODE_GUIDCEPTION])
+    print("{:<32}{:8.3f}s, {:.3f}s of it for Guidception".format("refresh:", refresh_seconds, guidception_seconds))
+
+    if refresh_seconds > sla_seconds:
+        print("Refresh exceeded the {:.1f}s SLA".format(sla_seconds))
+        return 1
+    print("Refresh completed within the {:.1f}s SLA".format(sla_seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sys.exit(main(*[int(arg) for arg in args[:2]] + [float(arg) for arg in args[2:3]]))
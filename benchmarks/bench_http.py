@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Load tests a running server over many concurrent keep-alive connections.
+
+    $ python -m benchmarks.bench_http http://127.0.0.1:8000 guid_install_ranking.json \\
+        [--connections 1000] [--requests 50000]
+
+Opens --connections HTTP/1.1 connections to the server and keeps them
+open, each one sending its share of --requests recommendation requests in
+turn, so that --connections requests are in flight at any time.  The
+guids are sampled, with a fixed seed, from the keys of the JSON models the
+server serves, ie. guid_install_ranking.json.
+
+Run it against each way of serving the route with the same models, ie.
+uvicorn serving taar_lite.app.asgi:app and the WSGI server of the Flask
+application hosting the plugin, to compare them over real sockets.
+Servers that close the connection after a response are reconnected to,
+and the reconnections are reported.
+
+Reports the connections, the requests per second and the median and 99th
+percentile latency, in milliseconds, of a request.
+"""
+import argparse
+import asyncio
+from collections import OrderedDict
+import json
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+RECOMMENDATIONS_PATH = '/taarlite/api/v1/addon_recommendations/'
+CONNECTIONS = 1000
+REQUESTS = 50000
+
+
+def request_paths(guids, requests):
+    rng = random.Random(42)
+    return [RECOMMENDATIONS_PATH + rng.choice(guids) + '/' for _ in range(requests)]
+
+
+def run(coroutine):
+    # asyncio.run is not available on Python 3.6
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def _get(connection, host, path):
+    """Sends a request on a connection and returns the response headers."""
+    reader, writer = connection
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode('ascii'))
+    status_line, _, header_lines = (await reader.readuntil(b'\r\n\r\n')).partition(b'\r\n')
+    if status_line.split()[1] != b'200':
+        raise RuntimeError("{} responded {}".format(path, status_line.decode('latin-1')))
+    headers = {}
+    for header in header_lines.strip().split(b'\r\n'):
+        name, _, value = header.partition(b':')
+        headers[name.strip().lower()] = value.strip().lower()
+    await reader.readexactly(int(headers.get(b'content-length', 0)))
+    return headers
+
+
+async def load_test(url, paths, connections):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    reconnections = 0
+
+    async def client(client_paths):
+        nonlocal reconnections
+        connection = await asyncio.open_connection(host, port)
+        latencies = []
+        try:
+            for path in client_paths:
+                start = time.perf_counter()
+                if connection is None:
+                    reconnections += 1
+                    connection = await asyncio.open_connection(host, port)
+                headers = await _get(connection, host, path)
+                latencies.append(time.perf_counter() - start)
+                if headers.get(b'connection') == b'close':
+                    connection[1].close()
+                    connection = None
+        finally:
+            if connection is not None:
+                connection[1].close()
+        return latencies
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client(paths[i::connections]) for i in range(connections)))
+    seconds = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for client_latencies in results for latency in client_latencies)
+    return OrderedDict([
+        ('connections', connections),
+        ('reconnections', reconnections),
+        ('requests', len(latencies)),
+        ('requests_per_second', len(latencies) / seconds),
+        ('p50_ms', statistics.median(latencies)),
+        ('p99_ms', latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]),
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', help="the server, ie. http://127.0.0.1:8000")
+    parser.add_argument('models', help="a JSON model the server serves, to sample the guids from")
+    parser.add_argument('--connections', type=int, default=CONNECTIONS,
+                        help="concurrent keep-alive connections")
+    parser.add_argument('--requests', type=int, default=REQUESTS)
+    args = parser.parse_args(argv)
+
+    with open(args.models) as fileobj:
+        guids = sorted(json.load(fileobj))
+    paths = request_paths(guids, args.requests)
+    json.dump(run(load_test(args.url, paths, args.connections)), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
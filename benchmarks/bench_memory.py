@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compares the memory held by a model generation built from dicts, from
+a CoinstallGraph and from a CoinstallGraph parsed row by row.
+
+    $ python -m benchmarks.bench_memory [num_guids]
+
+Each representation is built in a fresh child process, starting from the
+serialized JSON as the S3 loader would.  The retained size is the memory
+still allocated once the recommenders are built, the peak is the high
+water mark while building them, and the RSS is the peak resident size of
+the child process.
+"""
+from collections import OrderedDict
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tracemalloc
+
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.json_stream import graph_from_json_stream
+from taar_lite.recommenders.pipeline import TreatmentPipeline
+from taar_lite.recommenders.treatments import (
+    MinInstallPrune,
+    NoTreatment,
+    RowCount,
+    RowNormSum,
+    RowSum
+)
+
+from .synthetic import power_law_coinstall_dict, ranking_dict_for
+
+# 'dict' treats the parsed JSON, 'compact' converts it to a CoinstallGraph
+# first and 'streaming' parses the JSON row by row into a CoinstallGraph.
+MODES = ('dict', 'compact', 'streaming')
+CHUNK_SIZE = 1 << 16
+
+
+def build_model(raw_json, ranking_json, mode):
+    rankings = json.loads(ranking_json)
+    if mode == 'streaming':
+        chunks = (raw_json[i:i + CHUNK_SIZE] for i in range(0, len(raw_json), CHUNK_SIZE))
+        coinstallations = graph_from_json_stream(chunks, MinInstallPrune().row_filter(rankings))
+    else:
+        coinstallations = json.loads(raw_json)
+    if mode == 'compact':
+        coinstallations = CoinstallGraph.from_dict(coinstallations)
+
+    pipeline = TreatmentPipeline(
+        prefix=[MinInstallPrune()],
+        branches=OrderedDict([
+            ('none', NoTreatment()),
+            ('row_count', RowCount()),
+            ('row_sum', RowSum()),
+            ('rownorm_sum', RowNormSum()),
+        ]),
+        treatment_kwargs={
+            'ranking_dict': rankings,
+            'logger': logging.getLogger('bench_memory'),
+        }
+    )
+    return pipeline.build_recommenders(
+        coinstallations,
+        tie_breaker_dict=rankings,
+        validate_raw_coinstall_dict=False,
+        precompute_limit=10
+    )
+
+
+def measure(raw_json, ranking_json, mode, results):
+    tracemalloc.start()
+    model = build_model(raw_json, ranking_json, mode)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is reported in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put((retained, peak, rss))
+    del model
+
+
+def run_in_child(raw_json, ranking_json, mode):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=measure, args=(raw_json, ranking_json, mode, results))
+    process.start()
+    measurement = results.get()
+    process.join()
+    return measurement
+
+
+def megabytes(size):
+    return size / (1024 * 1024)
+
+
+def main(num_guids=50000):
+    coinstall_dict = power_law_coinstall_dict(num_guids)
+    # Keep every guid above the MinInstallPrune threshold
+    ranking_dict = {guid: rank + 1000 for guid, rank in ranking_dict_for(coinstall_dict).items()}
+    num_edges = sum(len(coinstalls) for coinstalls in coinstall_dict.values())
+    raw_json = json.dumps(coinstall_dict)
+    ranking_json = json.dumps(ranking_dict)
+    del coinstall_dict, ranking_dict
+    print("Synthetic graph: {} guids, {} edges, {:.1f}MB of JSON".format(
+        num_guids, num_edges, megabytes(len(raw_json))))
+
+    print("{:<10}{:>14}{:>14}{:>14}".format("", "retained MB", "peak MB", "max RSS MB"))
+    for mode in MODES:
+        retained, peak, rss = run_in_child(raw_json, ranking_json, mode)
+        print("{:<10}{:>14.1f}{:>14.1f}{:>14.1f}".format(
+            mode, megabytes(retained), megabytes(peak), megabytes(rss)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
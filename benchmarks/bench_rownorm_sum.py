@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compares RowNormSum against the list accumulating implementation it replaced.
+
+    $ python -m benchmarks.bench_rownorm_sum [num_guids]
+"""
+import sys
+import time
+
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.treatments import RowNormSum
+
+from .synthetic import power_law_coinstall_dict
+
+
+def list_accumulating_row_norm_sum(input_dict):
+    guid_row_norm = {}
+    for _, coinstalls in input_dict.items():
+        rowsum = sum(coinstalls.values())
+        for coinstall_guid, coinstall_count in coinstalls.items():
+            if coinstall_guid not in guid_row_norm:
+                guid_row_norm[coinstall_guid] = []
+            guid_row_norm[coinstall_guid].append(1.0 * coinstall_count / rowsum)
+
+    treatment_dict = {}
+    for guidkey, coinstalls in input_dict.items():
+        rowsum = sum(coinstalls.values())
+        output_dict = {}
+        for output_guid, output_guid_weight in coinstalls.items():
+            norm_sum = sum(guid_row_norm.get(output_guid, []))
+            output_dict[output_guid] = (output_guid_weight / rowsum) / norm_sum
+        treatment_dict[guidkey] = output_dict
+    return treatment_dict
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(num_guids=50000):
+    coinstall_dict = power_law_coinstall_dict(num_guids)
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    num_edges = sum(len(coinstalls) for coinstalls in coinstall_dict.values())
+    print("Synthetic graph: {} guids, {} edges".format(len(coinstall_dict), num_edges))
+
+    expected, list_seconds = timed(list_accumulating_row_norm_sum, coinstall_dict)
+    actual, dict_seconds = timed(RowNormSum().treat, coinstall_dict)
+    _, graph_seconds = timed(RowNormSum().treat_graph, graph)
+    assert actual == expected
+
+    print("{:<24}{:8.3f}s".format("list accumulation:", list_seconds))
+    print("{:<24}{:8.3f}s".format("RowNormSum.treat:", dict_seconds))
+    print("{:<24}{:8.3f}s".format("RowNormSum.treat_graph:", graph_seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
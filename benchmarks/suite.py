@@ -0,0 +1,276 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Times the build and query hot paths over synthetic power-law graphs of
+several sizes.
+
+    $ python -m benchmarks.suite [--sizes 1000,10000,50000] [--repeat 5]
+                                 [--json results.json] [--compare baseline.json]
+
+For every size it measures
+
+- treatment.<name>: applying each treatment to a CoinstallGraph, the
+  normalizations to the output of MinInstallPrune as the pipeline does
+- build.<name>: constructing a recommender with MinInstallPrune and each
+  normalization, ie. build_treatment_graph and the top-N table
+- recommend: the latency of a single guid recommend call
+- recommendation_graph: get_recommendation_graph over every guid
+- route.miss and route.hit: the latency of the Flask recommendation route,
+  with the models loaded from a moto mocked S3 bucket, without and with a
+  response cache hit
+
+Build cases report the median of the repeats and the peak memory traced
+while building once more.  Latency cases report the median and the 99th
+percentile of REQUESTS calls, throughput cases the guids per second.
+
+The graphs and the query sample are seeded, so successive runs measure the
+same work.  With --compare, the exit status is 1 when a case is slower
+than in the baseline results by more than --tolerance.
+"""
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import boto3
+from flask import Flask
+from moto import mock_s3
+from srgutil.context import default_context
+
+from taar_lite.app import plugin
+from taar_lite.app.production import (
+    ADDON_LIST_BUCKET,
+    ADDON_LIST_KEY,
+    GUID_RANKING_KEY,
+    TaarLiteAppResource
+)
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.guidguid import GuidGuidCoinstallRecommender
+from taar_lite.recommenders.treatments import (
+    ColumnStats,
+    Guidception,
+    MinInstallPrune,
+    NoTreatment,
+    RowCount,
+    RowNormSum,
+    RowSum,
+    apply_treatment
+)
+
+from .synthetic import power_law_coinstall_dict, ranking_dict_for
+
+SIZES = (1000, 10000, 50000)
+REPEAT = 5
+REQUESTS = 1000
+LIMIT = 4
+NORMALIZATIONS = (NoTreatment, RowCount, RowSum, RowNormSum, Guidception)
+
+# The metric of each kind of case that --compare checks
+COMPARED_METRICS = ('seconds', 'p50_ms', 'guids_per_second')
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def build_case(func, repeat):
+    """Returns the median duration of func and the peak memory it traces."""
+    seconds = statistics.median(timed(func)[1] for _ in range(repeat))
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([('seconds', seconds), ('peak_mb', peak / (1024 * 1024))])
+
+
+def latency_case(func, args):
+    latencies = sorted(timed(func, *arg)[1] * 1000 for arg in args)
+    return OrderedDict([
+        ('p50_ms', statistics.median(latencies)),
+        ('p99_ms', latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]),
+    ])
+
+
+def synthetic_model(num_guids):
+    coinstall_dict = power_law_coinstall_dict(num_guids)
+    # Keep every guid above the MinInstallPrune threshold
+    ranking_dict = {guid: rank + 1000 for guid, rank in ranking_dict_for(coinstall_dict).items()}
+    return coinstall_dict, ranking_dict
+
+
+def treatment_cases(graph, ranking_dict, repeat):
+    cases = OrderedDict()
+    kwargs = {'ranking_dict': ranking_dict}
+    cases['treatment.MinInstallPrune'] = build_case(
+        lambda: apply_treatment(MinInstallPrune(), graph, **kwargs), repeat)
+
+    pruned = apply_treatment(MinInstallPrune(), graph, **kwargs)
+    branch_kwargs = dict(kwargs, column_stats=ColumnStats(pruned).compute())
+    for treatment_class in NORMALIZATIONS:
+        cases['treatment.' + treatment_class.__name__] = build_case(
+            lambda: apply_treatment(treatment_class(), pruned, **branch_kwargs), repeat)
+    return cases
+
+
+def build_recommender(graph, ranking_dict, treatment_class):
+    return GuidGuidCoinstallRecommender(
+        graph,
+        treatments=[MinInstallPrune(), treatment_class()],
+        treatment_kwargs={'ranking_dict': ranking_dict},
+        tie_breaker_dict=ranking_dict,
+        validate_raw_coinstall_dict=False,
+        precompute_limit=10
+    )
+
+
+def recommender_cases(graph, ranking_dict, sample, repeat):
+    cases = OrderedDict()
+    for treatment_class in NORMALIZATIONS:
+        cases['build.' + treatment_class.__name__] = build_case(
+            lambda: build_recommender(graph, ranking_dict, treatment_class), repeat)
+
+    recommender = build_recommender(graph, ranking_dict, RowNormSum)
+    cases['recommend'] = latency_case(recommender.recommend, [(guid, LIMIT) for guid in sample])
+
+    seconds = statistics.median(timed(recommender.get_recommendation_graph, LIMIT)[1] for _ in range(repeat))
+    cases['recommendation_graph'] = OrderedDict([
+        ('seconds', seconds),
+        ('guids_per_second', len(graph) / seconds),
+    ])
+    return cases
+
+
+@contextmanager
+def mocked_s3_models(coinstall_dict, ranking_dict):
+    """Stores the models in a moto mocked S3 bucket, where the production
+    resource loads them from, for the duration of the with block.
+    """
+    mock = mock_s3()
+    mock.start()
+    try:
+        conn = boto3.resource('s3', region_name='us-east-1')
+        conn.create_bucket(Bucket=ADDON_LIST_BUCKET)
+        conn.Object(ADDON_LIST_BUCKET, ADDON_LIST_KEY).put(Body=json.dumps(coinstall_dict))
+        conn.Object(ADDON_LIST_BUCKET, GUID_RANKING_KEY).put(Body=json.dumps(ranking_dict))
+        yield
+    finally:
+        mock.stop()
+
+
+def route_cases(coinstall_dict, ranking_dict, sample):
+    """Serves the recommendation route from models stored in a mocked S3
+    bucket, as the production resource loads them.
+    """
+    with mocked_s3_models(coinstall_dict, ranking_dict):
+        app = Flask('benchmark')
+        plugin.configure_plugin(app)
+        start = time.perf_counter()
+        resource = TaarLiteAppResource(default_context())
+        load_seconds = time.perf_counter() - start
+        if not resource.is_ready():
+            raise RuntimeError("The models could not be loaded from the mocked S3 bucket")
+        plugin.PROXY_MANAGER.setResource(resource)
+        try:
+            client = app.test_client()
+
+            def get(guid):
+                response = client.get('/taarlite/api/v1/addon_recommendations/{}/'.format(guid))
+                assert response.status_code == 200
+
+            plugin.RESPONSE_CACHE.clear()
+            cases = OrderedDict()
+            cases['route.load'] = OrderedDict([('seconds', load_seconds)])
+            cases['route.miss'] = latency_case(get, [(guid,) for guid in sample])
+            cases['route.hit'] = latency_case(get, [(guid,) for guid in sample])
+            return cases
+        finally:
+            plugin.PROXY_MANAGER.setResource(None)
+            plugin.RESPONSE_CACHE.clear()
+
+
+def run(sizes, repeat):
+    results = OrderedDict()
+    for num_guids in sizes:
+        coinstall_dict, ranking_dict = synthetic_model(num_guids)
+        num_edges = sum(len(coinstalls) for coinstalls in coinstall_dict.values())
+        print("Synthetic graph: {} guids, {} edges".format(num_guids, num_edges))
+
+        graph = CoinstallGraph.from_dict(coinstall_dict)
+        # Distinct guids, so that every route.miss request misses the cache
+        sample = random.Random(42).sample(sorted(coinstall_dict), min(REQUESTS, num_guids))
+
+        cases = OrderedDict()
+        cases.update(treatment_cases(graph, ranking_dict, repeat))
+        cases.update(recommender_cases(graph, ranking_dict, sample, repeat))
+        cases.update(route_cases(coinstall_dict, ranking_dict, sample))
+        for case, metrics in cases.items():
+            print("  {:<32}{}".format(case, "  ".join(
+                "{} {:.4g}".format(metric, value) for metric, value in metrics.items())))
+        results[str(num_guids)] = cases
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a line for each case measured in both results that got
+    slower than the baseline by more than tolerance.
+    """
+    lines = []
+    for size, cases in results.items():
+        for case, metrics in cases.items():
+            previous = baseline.get(size, {}).get(case)
+            if previous is None:
+                continue
+            for metric in COMPARED_METRICS:
+                if metric not in metrics or metric not in previous:
+                    continue
+                # Throughput regresses downwards, durations upwards
+                if metric == 'guids_per_second':
+                    ratio = previous[metric] / metrics[metric]
+                else:
+                    ratio = metrics[metric] / previous[metric]
+                if ratio > 1 + tolerance:
+                    lines.append("{} guids {} {}: {:.3f} against {:.3f}".format(
+                        size, case, metric, metrics[metric], previous[metric]))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help="comma separated numbers of guids")
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    # The resource logs every model refresh
+    logging.disable(logging.INFO)
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            lines = regressions(results, json.load(baseline_file), args.tolerance)
+        for line in lines:
+            print("Regression: " + line)
+        if lines:
+            return 1
+        print("No case regressed by more than {:.0%}".format(args.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
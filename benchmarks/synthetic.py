@@ -0,0 +1,50 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Synthetic coinstallation data for benchmarks.
+
+Addon popularity on AMO follows a power law: a handful of addons are
+coinstalled with most of the catalogue while the long tail only has a few
+neighbours.  The generators here reproduce that shape deterministically.
+"""
+import numpy as np
+
+
+def power_law_coinstall_dict(num_guids, mean_degree=10, exponent=1.1, seed=42):
+    """Returns a symmetric coinstall dict of num_guids addons.
+
+    Every addon gets one edge to an addon picked by popularity, where the
+    popularity of the addon of rank i is i ** -exponent.  The remaining edges
+    are sampled with probability proportional to the product of the
+    popularity of both ends.  Coinstall counts are Pareto distributed.
+    """
+    rng = np.random.RandomState(seed)
+    popularity = np.arange(1, num_guids + 1, dtype=np.float64) ** -exponent
+    popularity /= popularity.sum()
+
+    num_edges = max(num_guids * mean_degree // 2, num_guids)
+    sources = np.concatenate([
+        np.arange(num_guids),
+        rng.choice(num_guids, size=num_edges - num_guids, p=popularity)
+    ])
+    targets = rng.choice(num_guids, size=num_edges, p=popularity)
+    # An addon picking itself is pointed at one of the two most popular addons.
+    targets[sources == targets] = (sources[sources == targets] + 1) % 2
+    counts = (rng.pareto(1.5, size=num_edges) * 10 + 1).astype(np.int64)
+
+    guids = ['guid-{}@example.com'.format(i) for i in range(num_guids)]
+    coinstalls = {}
+    for source, target, count in zip(sources.tolist(), targets.tolist(), counts.tolist()):
+        source_guid, target_guid = guids[source], guids[target]
+        coinstalls.setdefault(source_guid, {})[target_guid] = count
+        coinstalls.setdefault(target_guid, {})[source_guid] = count
+    return coinstalls
+
+
+def ranking_dict_for(coinstall_dict, seed=42):
+    """Returns an install ranking loosely correlated with coinstall degree."""
+    rng = np.random.RandomState(seed)
+    return {
+        guid: int(len(coinstalls) * 1000 * (1 + rng.rand()))
+        for guid, coinstalls in coinstall_dict.items()
+    }
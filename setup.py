@@ -24,6 +24,9 @@ setup(
     entry_points="""
     [taarapi_app]
     app=taar_lite.app.plugin:configure_plugin
+    [console_scripts]
+    taarlite-compile-model=taar_lite.app.compile_model:main
+    taarlite-export-graph=taar_lite.app.export_graph:main
     """,
     include_package_data=True,
     use_scm_version=False,
@@ -0,0 +1,190 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""An ASGI application serving the TAAR-lite recommendation route.
+
+    $ uvicorn taar_lite.app.asgi:app
+
+It exposes the same /taarlite/api/v1/addon_recommendations/<guid>/ and
+/taarlite/api/v1/ready contract as the Flask plugin, on top of the same
+TaarLiteAppResource, without depending on an ASGI framework.
+
+The resource is constructed in an executor, and refreshes its models in a
+background thread, so the event loop never waits on S3 or on a rebuild and
+a process keeps serving its connections while the models load.  Requests
+are served on the event loop from the current model generation, which
+takes microseconds; a resource refreshing inline instead serves each
+request in the executor.  A normalization listed in TAAR_LAZY_MODES is
+built on the event loop on its first request.
+"""
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+from srgutil.context import default_context
+
+from .encoding import ResponseEncoder, encode_json
+from .plugin import (
+    TAAR_MAX_RESULTS,
+    TAAR_PREENCODE_RESPONSES,
+    TAAR_RESPONSE_CACHE_SIZE,
+    encode_results,
+    recommendations_body
+)
+from .production import REFRESH_MODE_BACKGROUND, REFRESH_MODE_INLINE, TaarLiteAppResource
+from .response_cache import ResponseCache
+
+READY_PATH = '/taarlite/api/v1/ready'
+RECOMMENDATIONS_PATH = '/taarlite/api/v1/addon_recommendations/'
+
+_JSON_HEADERS = [(b'content-type', b'application/json')]
+
+
+def create_resource():
+    """Returns the resource of the ASGI application, refreshing its models
+    in the background.
+    """
+    response_encoder = None
+    if TAAR_PREENCODE_RESPONSES:
+        response_encoder = ResponseEncoder(TAAR_MAX_RESULTS, encode_results)
+    return TaarLiteAppResource(default_context().child(), refresh_mode=REFRESH_MODE_BACKGROUND,
+                               response_encoder=response_encoder)
+
+
+class TaarLiteASGIApp:
+    """Serves the recommendation and readiness routes over ASGI.
+
+    Accepts:
+        - a factory constructing the TaarLiteAppResource, called once in
+          the executor on the first request, or at startup when the server
+          sends lifespan events
+        - the executor running the factory, and the requests of a resource
+          refreshing inline; None for the default executor of the loop
+        - the response cache of the recommendation responses
+    """
+
+    def __init__(self, resource_factory=create_resource, executor=None, response_cache=None):
+        if response_cache is None:
+            response_cache = ResponseCache(TAAR_RESPONSE_CACHE_SIZE)
+        self._resource_factory = resource_factory
+        self._executor = executor
+        self._response_cache = response_cache
+        self._resource = None
+        self._offload = False
+        self._loading = None
+
+    async def resource(self):
+        """Returns the resource, constructing it in the executor on first use.
+
+        Construction is single flight: concurrent requests on a cold start
+        wait for the same construction.  A failed construction is retried on
+        the next request.
+        """
+        if self._resource is not None:
+            return self._resource
+        # _loaded publishes the resource before the awaiting requests resume
+        return await self._start_loading()
+
+    def _start_loading(self):
+        if self._loading is None:
+            loop = asyncio.get_event_loop()
+            loading = loop.run_in_executor(self._executor, self._resource_factory)
+            loading.add_done_callback(self._loaded)
+            self._loading = loading
+        return self._loading
+
+    def _loaded(self, loading):
+        """Publishes the constructed resource, or forgets a failed
+        construction so that the next request retries it.
+        """
+        if loading.cancelled() or loading.exception() is not None:
+            if self._loading is loading:
+                self._loading = None
+            return
+        resource = loading.result()
+        self._offload = resource.refresh_status()['refresh_mode'] == REFRESH_MODE_INLINE
+        self._resource = resource
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Start loading the models without delaying the startup
+                self._start_loading()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._resource is not None:
+                    self._resource.stop_refresher()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, send):
+        path = scope['path']
+        guid = _guid_of(path)
+        if scope['method'] != 'GET':
+            await _respond(send, 405, b'{"error": "method not allowed"}')
+        elif path == READY_PATH:
+            await self._ready(send)
+        elif guid:
+            normalize = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('normalize')
+            await self._recommendations(send, guid, normalize[0] if normalize else None)
+        else:
+            await _respond(send, 404, b'{"error": "not found"}')
+
+    async def _ready(self, send):
+        """Responds 200 once the models are loaded, and 503 until then,
+        starting to load them.  A resource refreshing inline whose models
+        failed to load is refreshed again in the executor.
+        """
+        resource = self._resource
+        if resource is None:
+            self._start_loading()
+        is_ready = resource is not None and resource.is_ready()
+        if resource is not None and not is_ready and self._offload:
+            asyncio.get_event_loop().run_in_executor(self._executor, resource.refresh)
+        await _respond(send, 200 if is_ready else 503, encode_json({'ready': is_ready}))
+
+    async def _recommendations(self, send, guid, normalize):
+        start = time.perf_counter()
+        resource = await self.resource()
+        client_dict = {'guid': guid}
+        if normalize is not None:
+            client_dict['normalize'] = normalize
+
+        if self._offload:
+            loop = asyncio.get_event_loop()
+            body = await loop.run_in_executor(self._executor, recommendations_body, resource, client_dict,
+                                              self._response_cache)
+        else:
+            body = recommendations_body(resource, client_dict, self._response_cache)
+        await _respond(send, 200, body)
+        resource.metrics.timing('request.total', time.perf_counter() - start)
+
+
+def _guid_of(path):
+    """Returns the guid of a recommendations path, or None."""
+    if not path.startswith(RECOMMENDATIONS_PATH) or not path.endswith('/'):
+        return None
+    guid = path[len(RECOMMENDATIONS_PATH):-1]
+    if '/' in guid:
+        return None
+    return guid
+
+
+async def _respond(send, status, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': _JSON_HEADERS + [(b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app = TaarLiteASGIApp()
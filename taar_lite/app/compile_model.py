@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compiles the coinstallation and ranking JSON models into a model file.
+
+    $ python -m taar_lite.app.compile_model \\
+        guid_coinstallation.json guid_install_ranking.json taarlite.model
+
+The production recommenders are computed and stored with the models, so a
+TaarLiteAppResource configured with TAAR_MODEL_FILE only maps the file.
+"""
+import argparse
+import json
+import logging
+
+from .production import TAAR_PRECOMPUTE_LIMIT, build_treatment_pipeline, model_parameters
+from ..recommenders.guidguid import GuidGuidCoinstallRecommender
+from ..recommenders.json_stream import graph_from_json_stream
+from ..recommenders.model_file import write_model_file
+from ..recommenders.treatments import MinInstallPrune
+
+CHUNK_SIZE = 1 << 16
+
+
+def load_json_models(coinstall_path, ranking_path):
+    """Returns the validated CoinstallGraph and the rankings read from the
+    JSON model files.
+    """
+    with open(ranking_path, 'rb') as fileobj:
+        rankings = json.loads(fileobj.read().decode('utf-8'))
+    # Rows below the install threshold are pruned while parsing
+    with open(coinstall_path, 'rb') as fileobj:
+        chunks = iter(lambda: fileobj.read(CHUNK_SIZE), b'')
+        graph = graph_from_json_stream(chunks, MinInstallPrune().row_filter(rankings))
+
+    GuidGuidCoinstallRecommender.validate_coinstall_dict(graph)
+    return graph, rankings
+
+
+def compile_model(coinstall_path, ranking_path, output_path,
+                  precompute_limit=TAAR_PRECOMPUTE_LIMIT, include_recommenders=True):
+    """Writes the model file compiled from the JSON model files."""
+    logger = logging.getLogger('taarlite')
+    graph, rankings = load_json_models(coinstall_path, ranking_path)
+
+    recommenders = None
+    parameters = None
+    if include_recommenders:
+        pipeline = build_treatment_pipeline(rankings, logger)
+        recommenders = pipeline.build_recommenders(
+            graph,
+            tie_breaker_dict=rankings,
+            validate_raw_coinstall_dict=False,
+            precompute_limit=precompute_limit or None
+        )
+        parameters = model_parameters(pipeline, precompute_limit)
+    write_model_file(output_path, graph, rankings, recommenders, parameters)
+    logger.info("Compiled model file [%s] with [%d] guids" % (output_path, len(graph.vocabulary)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('coinstall_path', help="the guid_coinstallation.json model")
+    parser.add_argument('ranking_path', help="the guid_install_ranking.json model")
+    parser.add_argument('output_path', help="the model file to write")
+    parser.add_argument('--precompute-limit', type=int, default=TAAR_PRECOMPUTE_LIMIT,
+                        help="depth of the stored top-N tables, 0 to store none")
+    parser.add_argument('--no-recommenders', dest='include_recommenders', action='store_false',
+                        help="only store the models, workers then apply the treatments")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    compile_model(args.coinstall_path, args.ranking_path, args.output_path,
+                  args.precompute_limit, args.include_recommenders)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""JSON encoding of the TAAR-lite responses.
+
+encode_json encodes an object to JSON bytes with orjson or ujson when they
+are installed, or with the json module otherwise.  The encoders differ in
+the whitespace they emit, never in the decoded value.
+"""
+from collections import OrderedDict, namedtuple
+import json
+
+from decouple import config
+
+# The encoder of the responses: 'orjson', 'ujson' or 'json', or 'auto' for
+# the first of them that is installed.
+TAAR_JSON_ENCODER = config('TAAR_JSON_ENCODER', default='auto')
+
+# Encodes the first limit recommendations of every guid to the JSON bytes
+# of its response results, when a model generation is built.  encode
+# receives the result list of a guid, ie. [('guid_b', 1.0), ...].
+ResponseEncoder = namedtuple('ResponseEncoder', ['limit', 'encode'])
+
+
+def _orjson_encoder():
+    import orjson
+    return orjson.dumps
+
+
+def _ujson_encoder():
+    import ujson
+
+    def encode(obj):
+        return ujson.dumps(obj).encode('utf-8')
+    return encode
+
+
+def _json_encoder():
+    encode_str = json.JSONEncoder().encode
+
+    def encode(obj):
+        return encode_str(obj).encode('utf-8')
+    return encode
+
+
+ENCODERS = OrderedDict([
+    ('orjson', _orjson_encoder),
+    ('ujson', _ujson_encoder),
+    ('json', _json_encoder),
+])
+
+
+def json_encoder(name='auto'):
+    """Returns a function encoding an object to JSON bytes with the named
+    encoder, or with the first installed one for 'auto'.
+
+    Raises ImportError if the named encoder is not installed.
+    """
+    if name == 'auto':
+        for factory in ENCODERS.values():
+            try:
+                return factory()
+            except ImportError:
+                continue
+    if name not in ENCODERS:
+        raise ValueError("Unknown JSON encoder [{}]".format(name))
+    return ENCODERS[name]()
+
+
+encode_json = json_encoder(TAAR_JSON_ENCODER)
+
+
+def encode_top_n(top_n_table, response_encoder):
+    """Returns a dict of guid to the encoded results of its first
+    response_encoder.limit recommendations in a top-N table.
+    """
+    limit = response_encoder.limit
+    encode = response_encoder.encode
+    return {guid: encode(results[:limit]) for guid, results in top_n_table.items()}
@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Exports the recommendations of every guid for each normalization.
+
+    $ python -m taar_lite.app.export_graph output_dir \\
+        --json guid_coinstallation.json guid_install_ranking.json
+    $ python -m taar_lite.app.export_graph output_dir --model-file taarlite.model
+
+Writes one <normalization>.jsonl file per normalization, with a line per
+guid such as
+
+    {"guid": "a", "recommendations": ["b", "c"], "weights": [0.5, 0.25]}
+
+or a <normalization>.parquet file with the same columns when pyarrow is
+installed.
+
+The guids are exported in chunks by a pool of processes forked once the
+recommenders are built.  Only a couple of chunks per process are pending at
+any time and each one is written as soon as it is its turn, so the memory
+used does not grow with the size of the catalogue.
+"""
+import argparse
+from collections import OrderedDict, deque
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from .compile_model import load_json_models
+from .production import build_treatment_pipeline, stored_recommenders
+from ..recommenders.model_file import ModelFile
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_PARQUET = 'parquet'
+FORMATS = (FORMAT_JSONL, FORMAT_PARQUET)
+LIMIT = 4
+CHUNK_SIZE = 10000
+
+_encode = json.JSONEncoder().encode
+
+# The export workers inherit this when they are forked, so the recommenders
+# are never pickled.
+_EXPORT_STATE = None
+
+
+def build_recommenders(graph, rankings, limit=LIMIT, modes=None, model_file=None):
+    """Returns an ordered dict of normalization to the production recommender.
+
+    Only the normalizations in modes are built when it is supplied.  The
+    treated graphs and top-N tables stored in a model file are used as is
+    when it was compiled with the same treatments and limit.
+    """
+    logger = logging.getLogger('taarlite')
+    pipeline = build_treatment_pipeline(rankings, logger)
+    if modes is None:
+        modes = list(pipeline.branches)
+    unknown = [mode for mode in modes if mode not in pipeline.branches]
+    if unknown:
+        raise ValueError("Unknown normalizations [{}]".format(", ".join(unknown)))
+
+    treated_graphs, top_n_tables = stored_recommenders(model_file, pipeline, limit, logger)
+    return pipeline.build_recommenders(
+        graph,
+        treated_graphs=treated_graphs,
+        top_n_tables=top_n_tables,
+        names=modes,
+        tie_breaker_dict=rankings,
+        validate_raw_coinstall_dict=False,
+        precompute_limit=limit
+    )
+
+
+def _export_chunk(name, start, end):
+    """Returns the encoded recommendations of the guids start to end of a
+    recommender, in the parent process or a forked worker.
+    """
+    recommenders, guids, limit, output_format = _EXPORT_STATE
+    recommend = recommenders[name].recommend
+    chunk = guids[name][start:end]
+    results = [recommend(guid, limit) for guid in chunk]
+    recommendations = [[guid for guid, _ in result] for result in results]
+    weights = [[weight for _, weight in result] for result in results]
+    if output_format == FORMAT_PARQUET:
+        return chunk, recommendations, weights
+
+    lines = [
+        _encode(OrderedDict([('guid', guid), ('recommendations', recommended), ('weights', recommended_weights)]))
+        for guid, recommended, recommended_weights in zip(chunk, recommendations, weights)
+    ]
+    return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+
+def _exported_chunks(name, size, chunk_size, pool, max_pending):
+    """Yields the exported chunks of a recommender in order."""
+    bounds = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+    if pool is None:
+        for start, end in bounds:
+            yield _export_chunk(name, start, end)
+        return
+
+    pending = deque()
+    for start, end in bounds:
+        pending.append(pool.apply_async(_export_chunk, (name, start, end)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class _JsonLinesWriter:
+
+    def __init__(self, path):
+        self._fileobj = open(path, 'wb')
+
+    def write(self, chunk):
+        self._fileobj.write(chunk)
+
+    def close(self):
+        self._fileobj.close()
+
+
+class _ParquetWriter:
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ('guid', pyarrow.string()),
+            ('recommendations', pyarrow.list_(pyarrow.string())),
+            ('weights', pyarrow.list_(pyarrow.float64())),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, chunk):
+        # One row group per chunk
+        self._writer.write_table(self._pyarrow.Table.from_arrays(
+            [self._pyarrow.array(column, type=field.type) for column, field in zip(chunk, self._schema)],
+            schema=self._schema
+        ))
+
+    def close(self):
+        self._writer.close()
+
+
+def export_recommendation_graph(recommenders, output_dir, limit=LIMIT, output_format=FORMAT_JSONL,
+                                processes=None, chunk_size=CHUNK_SIZE):
+    """Writes the recommendations of every guid of each recommender to
+    <output_dir>/<name>.<output_format>, and returns an ordered dict of
+    name to path.
+
+    The guids are exported by processes forked workers, os.cpu_count() of
+    them by default, or in this process with processes of 0 or 1.  Each
+    file is written next to its path and renamed into place.
+    """
+    global _EXPORT_STATE
+
+    if output_format not in FORMATS:
+        raise ValueError("Unknown export format [{}]".format(output_format))
+    writer_class = _JsonLinesWriter
+    if output_format == FORMAT_PARQUET:
+        try:
+            import pyarrow.parquet  # noqa
+        except ImportError:
+            raise ValueError("Exporting to Parquet requires pyarrow")
+        writer_class = _ParquetWriter
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    logger = logging.getLogger('taarlite')
+    guids = {name: list(recommender.raw_coinstall_graph) for name, recommender in recommenders.items()}
+    _EXPORT_STATE = (recommenders, guids, limit, output_format)
+    pool = None
+    try:
+        if processes > 1:
+            pool = multiprocessing.get_context('fork').Pool(processes)
+
+        paths = OrderedDict()
+        for name in recommenders:
+            start = time.perf_counter()
+            path = os.path.join(output_dir, '{}.{}'.format(name, output_format))
+            tmp_path = '{}.tmp{}'.format(path, os.getpid())
+            writer = writer_class(tmp_path)
+            try:
+                for chunk in _exported_chunks(name, len(guids[name]), chunk_size, pool, 2 * processes):
+                    writer.write(chunk)
+            finally:
+                writer.close()
+            os.replace(tmp_path, path)
+            paths[name] = path
+            logger.info("Exported [%d] guids of [%s] to [%s] in %.3fs" %
+                        (len(guids[name]), name, path, time.perf_counter() - start))
+        return paths
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _EXPORT_STATE = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output_dir', help="the directory to write a file per normalization to")
+    models = parser.add_mutually_exclusive_group(required=True)
+    models.add_argument('--json', nargs=2, metavar=('COINSTALL_PATH', 'RANKING_PATH'),
+                        help="the guid_coinstallation.json and guid_install_ranking.json models")
+    models.add_argument('--model-file', help="a model file compiled with taarlite-compile-model")
+    parser.add_argument('--modes', help="comma separated normalizations to export, all of them by default")
+    parser.add_argument('--limit', type=int, default=LIMIT, help="recommendations per guid")
+    parser.add_argument('--format', dest='output_format', choices=FORMATS, default=FORMAT_JSONL)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes, the number of CPUs by default")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="guids per worker task")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    model_file = None
+    if args.model_file:
+        model_file = ModelFile(args.model_file)
+        graph, rankings = model_file.graph, model_file.rankings
+    else:
+        graph, rankings = load_json_models(*args.json)
+    modes = args.modes.split(',') if args.modes else None
+
+    try:
+        recommenders = build_recommenders(graph, rankings, args.limit, modes, model_file)
+        os.makedirs(args.output_dir, exist_ok=True)
+        export_recommendation_graph(recommenders, args.output_dir, args.limit, args.output_format,
+                                    args.processes, args.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
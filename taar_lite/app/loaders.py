@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Model loaders used by the production TAAR-lite resource."""
+import json
+import os
+import threading
+import time
+
+import boto3
+from srgutil.cache import LazyJSONLoader
+from srgutil.interfaces import IClock, IMozLogging
+
+from .metrics import NULL_SINK
+from ..recommenders.json_stream import graph_from_json_stream
+from ..recommenders.model_file import ModelFile
+
+
+class ETagJSONLoader(LazyJSONLoader):
+    """A LazyJSONLoader that only downloads an S3 object when its ETag changes.
+
+    When the TTL expires the object metadata is fetched first.  If the ETag
+    matches the cached copy the TTL is simply renewed and get reports the
+    cache as not refreshed.  The ETag of the cached copy is available from
+    the etag attribute so that consumers can tell model versions apart.
+
+    Subclasses may override _parse to decode the object differently.
+
+    The download and decoding times of each object are reported to metrics
+    as s3.<object>.download and s3.<object>.parse, where the object is the
+    name of the key without its extension.
+    """
+
+    def __init__(self, ctx, s3_bucket, s3_key, ttl=14400, metrics=NULL_SINK):
+        super().__init__(ctx, s3_bucket, s3_key, ttl)
+        self.etag = None
+        self._changed = False
+        self._metrics = metrics
+        self._metric_prefix = 's3.' + os.path.splitext(os.path.basename(s3_key))[0]
+
+    def get(self):
+        if not self.has_expired() and self._cached_copy is not None:
+            return self._cached_copy, False
+
+        with self._lock:
+            result = self._refresh_cache()
+            changed, self._changed = self._changed, False
+        return result, changed
+
+    def _refresh_cache(self):
+        with self._lock:
+            # See LazyJSONLoader._refresh_cache, requests racing the
+            # refresh are served the existing copy.
+            self._expiry_time = self._clock.time() + self._ttl
+
+            try:
+                s3_object = boto3.resource('s3').Object(self._s3_bucket, self._s3_key)
+                if self._cached_copy is not None and s3_object.e_tag == self.etag:
+                    self.logger.info("S3 object unchanged: {}".format(self._key_str))
+                    self._metrics.incr(self._metric_prefix + '.unchanged')
+                    return self._cached_copy
+
+                start = time.perf_counter()
+                response = s3_object.get()
+                body = _TimedBody(response['Body'], time.perf_counter() - start)
+                try:
+                    self._cached_copy = self._parse(body)
+                    self.logger.info("Loaded JSON from S3: {}".format(self._key_str))
+                    self.etag = response['ETag']
+                    self._changed = True
+                    self._report_load(time.perf_counter() - start, body)
+                except ValueError:
+                    # Retry on the next request and keep serving the
+                    # existing copy.
+                    self._expiry_time = 0
+                    self._metrics.incr(self._metric_prefix + '.errors')
+                    self.logger.error("Cannot parse JSON resource from S3", extra={
+                        "bucket": self._s3_bucket,
+                        "key": self._s3_key})
+
+                return self._cached_copy
+            except Exception:
+                self._expiry_time = 0
+                self._metrics.incr(self._metric_prefix + '.errors')
+                self.logger.exception("Failed to download from S3", extra={
+                    "bucket": self._s3_bucket,
+                    "key": self._s3_key})
+                return self._cached_copy
+
+    def _report_load(self, seconds, body):
+        # The time spent waiting for the response and its body is the
+        # download, whether the body was read at once or while decoding it.
+        self._metrics.timing(self._metric_prefix + '.download', body.read_seconds)
+        self._metrics.timing(self._metric_prefix + '.parse', seconds - body.read_seconds)
+        self._metrics.gauge(self._metric_prefix + '.bytes', body.size)
+
+    def _parse(self, body):
+        """Returns the object decoded from the S3 response body."""
+        return json.loads(body.read().decode('utf-8'))
+
+
+class _TimedBody:
+    """Wraps an S3 response body, adding up the time spent in read to the
+    time the response took.
+    """
+
+    def __init__(self, body, response_seconds):
+        self._body = body
+        self.read_seconds = response_seconds
+        self.size = 0
+
+    def read(self, *args):
+        start = time.perf_counter()
+        data = self._body.read(*args)
+        self.read_seconds += time.perf_counter() - start
+        self.size += len(data)
+        return data
+
+
+class StreamingGraphLoader(ETagJSONLoader):
+    """An ETagJSONLoader that parses the coinstallation JSON into a
+    CoinstallGraph while it is downloaded.
+
+    The document is never held in memory as a whole, neither as text nor as
+    a dict of dicts.  With a row filter set, ie. MinInstallPrune.row_filter,
+    the rows it rejects are skipped without being decoded.
+    """
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, ctx, s3_bucket, s3_key, ttl=14400, metrics=NULL_SINK):
+        super().__init__(ctx, s3_bucket, s3_key, ttl, metrics)
+        self._row_filter = None
+        self._row_filter_version = None
+        self._parsed_row_filter_version = None
+
+    def set_row_filter(self, row_filter, version):
+        """Sets the row filter of the next download.
+
+        The filter is identified by version; setting a new version forces
+        the object to be downloaded again on the next get, as the cached
+        graph was pruned with the previous filter.
+        """
+        with self._lock:
+            if version == self._row_filter_version:
+                return
+            self._row_filter = row_filter
+            self._row_filter_version = version
+            self._expiry_time = 0
+            self.etag = None
+
+    @property
+    def has_current_row_filter(self):
+        """Tells if the cached graph was parsed with the current row filter.
+
+        It was not when the download forced by a new row filter failed, and
+        the cached graph is still the one pruned with the previous filter.
+        """
+        return self._parsed_row_filter_version == self._row_filter_version
+
+    def _parse(self, body):
+        chunks = iter(lambda: body.read(self.CHUNK_SIZE), b'')
+        graph = graph_from_json_stream(chunks, self._row_filter)
+        self._parsed_row_filter_version = self._row_filter_version
+        return graph
+
+
+class ModelFileLoader:
+    """Loads a compiled model file, mapping it again when the file is replaced.
+
+    Follows the get and has_expired interface of LazyJSONLoader, with the
+    ModelFile as the cached copy.  Once the TTL expires the file is checked
+    with a stat call and only mapped again if it was replaced.
+    """
+
+    def __init__(self, ctx, path, ttl=14400):
+        self.logger = ctx[IMozLogging].get_logger('taarlite')
+        self._clock = ctx[IClock]
+        self._path = path
+        self._ttl = int(ttl)
+        self._expiry_time = 0
+        self._cached_copy = None
+        self._lock = threading.RLock()
+        self.etag = None
+
+    def has_expired(self):
+        return self._clock.time() > self._expiry_time
+
+    def get(self):
+        if not self.has_expired() and self._cached_copy is not None:
+            return self._cached_copy, False
+
+        with self._lock:
+            self._expiry_time = self._clock.time() + self._ttl
+            try:
+                if self._cached_copy is not None and ModelFile.file_id_of(self._path) == self.etag:
+                    return self._cached_copy, False
+
+                model_file = ModelFile(self._path)
+                self.logger.info("Loaded model file: {}".format(self._path))
+                self._cached_copy = model_file
+                self.etag = model_file.file_id
+                return model_file, True
+            except Exception:
+                self._expiry_time = 0
+                self.logger.exception("Failed to load model file", extra={"path": self._path})
+                return self._cached_copy, False
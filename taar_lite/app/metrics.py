@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Metrics sinks for the counters, gauges and timings of the TAAR-lite resource.
+
+The resource reports
+
+- s3.<object>.download, s3.<object>.parse: timings of each S3 download and
+  of decoding it, plus s3.<object>.bytes, s3.<object>.unchanged and
+  s3.<object>.errors
+- refresh.<stage>: the timings of the stages of the treatment pipeline,
+  ie. refresh.branch.row_sum, of lazily built modes, ie.
+  refresh.lazy.row_sum, and refresh.duration, plus refresh.errors
+- model.generation, model.<mode>.nodes and model.<mode>.edges: gauges of
+  the model generation and of the size of each treated graph
+- request.lookup, request.ranking, request.serialization, request.total:
+  the timings of each recommendation request, batch.lookup and
+  batch.ranking for batches, plus request.invalid_normalization,
+  response_cache.hits and response_cache.misses
+
+Timings are reported in seconds to the sink and in milliseconds to statsd,
+which aggregates them into histograms.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import socket
+import threading
+import time
+
+from decouple import config
+
+from ..recommenders.graph import CoinstallGraph
+
+# Send the metrics to the statsd daemon at TAAR_STATSD_HOST, prefixing
+# every name with TAAR_STATSD_PREFIX.  No metrics are sent without a host.
+TAAR_STATSD_HOST = config('TAAR_STATSD_HOST', default='')
+TAAR_STATSD_PORT = config('TAAR_STATSD_PORT', default=8125, cast=int)
+TAAR_STATSD_PREFIX = config('TAAR_STATSD_PREFIX', default='taarlite')
+
+
+class MetricsSink:
+    """A sink that drops every metric, and the interface of all sinks."""
+
+    def incr(self, name, value=1):
+        """Adds value to the counter name."""
+
+    def gauge(self, name, value):
+        """Sets the gauge name to value."""
+
+    def timing(self, name, seconds):
+        """Records a duration in the histogram name."""
+
+    @contextmanager
+    def timer(self, name):
+        """Records the duration of the with block in the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+
+NULL_SINK = MetricsSink()
+
+
+class InMemorySink(MetricsSink):
+    """Keeps every metric in memory, ie. for tests.
+
+    counters and gauges map each name to its value, and timings map each
+    name to the list of recorded durations.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.timings = defaultdict(list)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+
+class StatsdSink(MetricsSink):
+    """Sends every metric to a statsd daemon over UDP.
+
+    The host is resolved once.  Metrics that can not be sent are dropped, so
+    that reporting them never fails a request or a refresh.
+    """
+
+    def __init__(self, host, port=8125, prefix=''):
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self._address = address
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._prefix = prefix + '.' if prefix else ''
+
+    def _send(self, name, value, metric_type):
+        line = '{}{}:{}|{}'.format(self._prefix, name, value, metric_type)
+        try:
+            self._socket.sendto(line.encode('utf-8'), self._address)
+        except OSError:
+            pass
+
+    def incr(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+    def timing(self, name, seconds):
+        self._send(name, '%.3f' % (seconds * 1000), 'ms')
+
+
+def sink_from_config():
+    """Returns the sink configured by TAAR_STATSD_HOST."""
+    if not TAAR_STATSD_HOST:
+        return NULL_SINK
+    return StatsdSink(TAAR_STATSD_HOST, TAAR_STATSD_PORT, TAAR_STATSD_PREFIX)
+
+
+def graph_size(graph):
+    """Returns the number of rows and of edges of a coinstall graph."""
+    if isinstance(graph, CoinstallGraph):
+        return len(graph), int(graph.matrix.nnz)
+    return len(graph), sum(len(coinstalls) for coinstalls in graph.values())
+
+
+def report_graph_size(metrics, mode, graph):
+    nodes, edges = graph_size(graph)
+    metrics.gauge('model.%s.nodes' % mode, nodes)
+    metrics.gauge('model.%s.edges' % mode, edges)
@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+from collections.abc import Mapping
+import threading
+import time
+
+from .metrics import NULL_SINK, report_graph_size
+
+# Which normalization modes are built on first use instead of with every
+# model generation, and how many seconds a lazily built mode may stay
+# unused before it is dropped.  An idle_seconds of 0 never drops one.
+ModePolicy = namedtuple('ModePolicy', ['lazy_modes', 'idle_seconds'])
+
+
+class ModeRecommenders(Mapping):
+    """The recommenders of a model generation, by normalization mode.
+
+    The eager recommenders are built with the generation.  The lazy ones
+    are built by the pipeline, from the prefix output it kept, on their
+    first lookup, and dropped by evict_idle once unused for idle_seconds,
+    to be built again on their next lookup.
+
+    The build time of a lazy mode is reported to metrics as
+    refresh.lazy.<name>, along with the size of its treated graph.
+
+    Building a mode holds a lock, so concurrent first lookups build it once.
+    A built recommender is never mutated, so requests that looked it up
+    keep using it after it was dropped.
+    """
+
+    def __init__(self, recommenders, pipeline, lazy_modes, recommender_kwargs,
+                 idle_seconds=0, logger=None, clock=time.monotonic, metrics=NULL_SINK):
+        self._recommenders = recommenders
+        self._pipeline = pipeline
+        self._lazy = {name: None for name in lazy_modes}
+        self._recommender_kwargs = recommender_kwargs
+        self._idle_seconds = idle_seconds
+        self._logger = logger
+        self._clock = clock
+        self._metrics = metrics
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._names = [name for name in pipeline.branches if name in recommenders or name in self._lazy]
+
+    def __getitem__(self, name):
+        recommender = self._recommenders.get(name)
+        if recommender is not None:
+            return recommender
+        if name not in self._lazy:
+            raise KeyError(name)
+
+        self._last_used[name] = self._clock()
+        recommender = self._lazy[name]
+        if recommender is None:
+            with self._lock:
+                recommender = self._lazy[name]
+                if recommender is None:
+                    recommender = self._build(name)
+        return recommender
+
+    def _build(self, name):
+        # Must be called with the lock held
+        start = time.perf_counter()
+        recommender = self._pipeline.build_recommender(name, **self._recommender_kwargs)
+        self._lazy[name] = recommender
+        seconds = time.perf_counter() - start
+        if self._logger is not None:
+            self._logger.info("Built lazy normalization [%s] in %.3fs" % (name, seconds))
+        self._metrics.timing('refresh.lazy.' + name, seconds)
+        report_graph_size(self._metrics, name, recommender.treated_graph)
+        return recommender
+
+    def __contains__(self, name):
+        return name in self._recommenders or name in self._lazy
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def lazy_modes(self):
+        return list(self._lazy)
+
+    def built_modes(self):
+        """Returns the modes whose recommender is currently built."""
+        return [name for name in self._names if name in self._recommenders or self._lazy[name] is not None]
+
+    def evict_idle(self):
+        """Drops the lazily built recommenders unused for idle_seconds.
+
+        Returns the modes that were dropped.
+        """
+        if not self._idle_seconds:
+            return []
+        evicted = []
+        with self._lock:
+            now = self._clock()
+            for name, recommender in self._lazy.items():
+                if recommender is not None and now - self._last_used.get(name, now) >= self._idle_seconds:
+                    self._lazy[name] = None
+                    evicted.append(name)
+        if evicted and self._logger is not None:
+            self._logger.info("Dropped idle normalizations [%s]" % ", ".join(evicted))
+        return evicted
@@ -3,20 +3,43 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from decouple import config
-from flask import request
+from flask import abort, request
 import json
+import threading
+import time
 
 # TAAR specific libraries
+from .encoding import ResponseEncoder, encode_json
 from .production import TaarLiteAppResource
+from .response_cache import ResponseCache
 from srgutil.context import default_context
 
 # These are configurations that are specific to the TAAR library
 TAAR_MAX_RESULTS = config('TAAR_MAX_RESULTS', default=4, cast=int)
 
+# Construct the resource, and so download and precompute the models, when
+# the plugin is configured instead of on the first request.
+TAAR_EAGER_INIT = config('TAAR_EAGER_INIT', default=False, cast=bool)
+
+# Maximum number of guids accepted by a single batch request.
+TAAR_MAX_BATCH_SIZE = config('TAAR_MAX_BATCH_SIZE', default=100, cast=int)
+
+# Number of serialized single addon responses kept in the LRU response
+# cache.  Set to 0 to disable the cache.
+TAAR_RESPONSE_CACHE_SIZE = config('TAAR_RESPONSE_CACHE_SIZE', default=4096, cast=int)
+
+# Encode the results of every addon when the models are loaded, for the
+# normalizations with a precomputed top-N table, so that their responses
+# are assembled from the encoded bytes.  The response encoder is picked
+# with TAAR_JSON_ENCODER, see taar_lite.app.encoding.
+TAAR_PREENCODE_RESPONSES = config('TAAR_PREENCODE_RESPONSES', default=False, cast=bool)
+
 
 class ResourceProxy(object):
     def __init__(self):
         self._resource = None
+        self._lock = threading.Lock()
+        self._warm_up_thread = None
 
     def setResource(self, rsrc):
         self._resource = rsrc
@@ -24,8 +47,115 @@ class ResourceProxy(object):
     def getResource(self):
         return self._resource
 
+    def getOrCreateResource(self, factory):
+        """Return the resource, constructing it with factory on first use.
+
+        Construction is single flight: concurrent callers on a cold start
+        wait for the one thread that builds the resource.
+        """
+        resource = self._resource
+        if resource is None:
+            with self._lock:
+                resource = self._resource
+                if resource is None:
+                    resource = factory()
+                    self._resource = resource
+        return resource
+
+    def warmUpInBackground(self, factory):
+        """Start constructing the resource in a background thread, or
+        refreshing it when it exists but has no models, ie. as the first
+        load failed.
+
+        Does nothing if the resource is ready or is already warming up.
+        """
+        with self._lock:
+            resource = self._resource
+            if (resource is not None and resource.is_ready()) or self._warm_up_thread is not None:
+                return
+            self._warm_up_thread = threading.Thread(target=self._warm_up, args=(factory,), daemon=True)
+            self._warm_up_thread.start()
+
+    def _warm_up(self, factory):
+        try:
+            resource = self.getOrCreateResource(factory)
+            if not resource.is_ready():
+                resource.refresh()
+        finally:
+            # Allow a later readiness check to retry a failed warm up
+            self._warm_up_thread = None
+
 
 PROXY_MANAGER = ResourceProxy()
+RESPONSE_CACHE = ResponseCache(TAAR_RESPONSE_CACHE_SIZE)
+
+
+def create_resource():
+    ctx = default_context()
+
+    # Lock the context down after we've got basic bits installed
+    root_ctx = ctx.child()
+
+    response_encoder = None
+    if TAAR_PREENCODE_RESPONSES:
+        response_encoder = ResponseEncoder(TAAR_MAX_RESULTS, encode_results)
+    return TaarLiteAppResource(root_ctx, response_encoder=response_encoder)
+
+
+def strip_weights(recommendations):
+    """Return only the guids of a full set of TAAR_MAX_RESULTS recommendations.
+
+    Weights are stripped to maintain compatibility with TAAR 1.0, and
+    incomplete sets are not returned at all.
+    """
+    if len(recommendations) != TAAR_MAX_RESULTS:
+        return []
+    return [x[0] for x in recommendations]
+
+
+def encode_results(recommendations):
+    """Return the JSON bytes of the results of a set of recommendations."""
+    return encode_json(strip_weights(recommendations))
+
+
+def results_body(encoded_results):
+    """Return the response body wrapping encoded results."""
+    return b'{"results":' + encoded_results + b'}'
+
+
+def recommendations_body(instance, client_dict, response_cache):
+    """Return the response body of the recommendations for client_dict.
+
+    The body is assembled from the results the resource encoded ahead of
+    time when it did, or else looked up in response_cache or computed.
+    Requests served from response_cache are still logged and timed by the
+    resource.
+    """
+    start = time.perf_counter()
+    metrics = instance.metrics
+    encoded_results = instance.encoded_recommendations(client_dict, limit=TAAR_MAX_RESULTS)
+    if encoded_results is not None:
+        metrics.incr('request.preencoded')
+        return results_body(encoded_results)
+
+    # Responses are cached for the model generation that computed them,
+    # along with the recommendations they encode
+    cache_token = (id(instance), instance.current_generation())
+    cache_key = (client_dict['guid'], client_dict.get('normalize'), TAAR_MAX_RESULTS)
+    cached = response_cache.get(cache_token, cache_key)
+    if cached is None:
+        metrics.incr('response_cache.misses')
+        recommendations = instance.recommend(client_data=client_dict,
+                                             limit=TAAR_MAX_RESULTS)
+
+        with metrics.timer('request.serialization'):
+            body = results_body(encode_results(recommendations))
+        response_cache.put(cache_token, cache_key, (body, recommendations))
+    else:
+        metrics.incr('response_cache.hits')
+        body, recommendations = cached
+        instance.record_request(client_dict, recommendations, time.perf_counter() - start)
+    return body
 
 
 def configure_plugin(app):
@@ -33,40 +163,91 @@ def configure_plugin(app):
     This is a factory function that configures all the routes for
     flask given a particular library.
     """
+    if TAAR_EAGER_INIT:
+        PROXY_MANAGER.getOrCreateResource(create_resource)
+
+    @app.route('/taarlite/api/v1/ready')
+    def ready():
+        """Return 200 once the models are loaded and precomputed, 503 until then.
+
+        Load balancers should only route traffic to workers that are ready.
+        A worker that has not loaded its models yet starts loading them in
+        the background, or retries when its first load failed.
+        """
+        instance = PROXY_MANAGER.getResource()
+        is_ready = instance is not None and instance.is_ready()
+        if not is_ready:
+            PROXY_MANAGER.warmUpInBackground(create_resource)
+
+        response = app.response_class(
+                response=json.dumps({'ready': is_ready}),
+                status=200 if is_ready else 503,
+                mimetype='application/json'
+                )
+        return response
+
     @app.route('/taarlite/api/v1/addon_recommendations/<string:guid>/')
     def recommendations(guid):
         """Return a list of recommendations provided a telemetry client_id."""
         # Use the module global PROXY_MANAGER
         global PROXY_MANAGER
 
-        if PROXY_MANAGER.getResource() is None:
-            ctx = default_context()
-
-            # Lock the context down after we've got basic bits installed
-            root_ctx = ctx.child()
-
-            instance = TaarLiteAppResource(root_ctx)
-            PROXY_MANAGER.setResource(instance)
-
-        instance = PROXY_MANAGER.getResource()
+        start = time.perf_counter()
+        instance = PROXY_MANAGER.getOrCreateResource(create_resource)
+        metrics = instance.metrics
 
         client_dict = {'guid': guid}
         normalization_type = request.args.get('normalize', None)
         if normalization_type is not None:
             client_dict['normalize'] = normalization_type
 
-        recommendations = instance.recommend(client_data=client_dict,
-                                             limit=TAAR_MAX_RESULTS)
+        body = recommendations_body(instance, client_dict, RESPONSE_CACHE)
+        response = app.response_class(
+                response=body,
+                status=200,
+                mimetype='application/json'
+                )
+        metrics.timing('request.total', time.perf_counter() - start)
+        return response
+
+    @app.route('/taarlite/api/v1/cache_stats')
+    def cache_stats():
+        """Return the hit, miss and eviction counters of the response cache."""
+        response = app.response_class(
+                response=json.dumps(RESPONSE_CACHE.stats()),
+                status=200,
+                mimetype='application/json'
+                )
+        return response
+
+    @app.route('/taarlite/api/v1/addon_recommendations/', methods=['POST'])
+    def batch_recommendations():
+        """Return recommendations for a batch of addons.
+
+        The request body is a JSON object with a list of guids and an
+        optional normalization, ie. {"guids": ["guid_a", "guid_b"], "normalize": "row_sum"}.
+        The response maps each guid to the same results the single addon
+        route would return, ie. {"results": {"guid_a": [...], "guid_b": [...]}}.
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        guids = body.get('guids')
+        if not isinstance(guids, list) or not all(isinstance(guid, str) for guid in guids):
+            abort(400)
+        if len(guids) > TAAR_MAX_BATCH_SIZE:
+            abort(400)
 
-        if len(recommendations) != TAAR_MAX_RESULTS:
-            recommendations = []
+        instance = PROXY_MANAGER.getOrCreateResource(create_resource)
+        batch = instance.recommend_many(guids,
+                                        normalize=body.get('normalize'),
+                                        limit=TAAR_MAX_RESULTS)
 
-        # Strip out weights from TAAR results to maintain compatibility
-        # with TAAR 1.0
-        jdata = {"results": [x[0] for x in recommendations]}
+        jdata = {"results": {guid: strip_weights(recommendations)
+                             for guid, recommendations in batch.items()}}
 
         response = app.response_class(
-                response=json.dumps(jdata),
+                response=encode_json(jdata),
                 status=200,
                 mimetype='application/json'
                 )
@@ -84,5 +265,6 @@ def configure_plugin(app):
             global PROXY_MANAGER
             if 'PROXY_RESOURCE' in config_options:
                 PROXY_MANAGER._resource = config_options['PROXY_RESOURCE']
+                RESPONSE_CACHE.clear()
 
     return MyPlugin()
@@ -6,12 +6,24 @@
 
 Adds in the S3 context with the help of the srgutil Context.
 """
-from decouple import config
+from collections import OrderedDict, namedtuple
+import json
+import threading
+import time
+
+from decouple import Csv, config
 from srgutil.interfaces import IS3Data, IMozLogging
-from srgutil.cache import LazyJSONLoader
 
-from ..recommenders.guidguid import GuidGuidCoinstallRecommender
+from .encoding import encode_top_n
+from .loaders import ETagJSONLoader, ModelFileLoader, StreamingGraphLoader
+from .metrics import report_graph_size, sink_from_config
+from .mode_recommenders import ModePolicy, ModeRecommenders
+from .request_log import RequestLog, log_asynchronously
+from ..recommenders.graph import CoinstallGraph
+from ..recommenders.guidguid import AsymmetricCoinstallError, GuidGuidCoinstallRecommender
+from ..recommenders.pipeline import TreatmentPipeline
 from ..recommenders.treatments import (
+    Guidception,
     NoTreatment,
     MinInstallPrune,
     RowCount,
@@ -26,19 +38,178 @@ GUID_RANKING_KEY = 'taar/lite/guid_install_ranking.json'
 ADDON_DL_ERR = "Cannot download addon coinstallation file {}".format(ADDON_LIST_KEY)   # noqa
 TAAR_CACHE_EXPIRY = config('TAAR_CACHE_EXPIRY', default=14400, cast=int)
 
+# Depth of the per-guid recommendation table precomputed at model load.
+# Requests with a larger limit fall back to sorting the treated row.
+# Set to 0 to disable precomputation.
+TAAR_PRECOMPUTE_LIMIT = config('TAAR_PRECOMPUTE_LIMIT', default=10, cast=int)
+
+# Keep the coinstallation model as a CoinstallGraph, with interned guids
+# and array backed rows shared by all treatments, instead of dicts.  The
+# recommendations are the same in both representations.
+TAAR_COMPACT_MODEL = config('TAAR_COMPACT_MODEL', default=True, cast=bool)
+
+# Path of a model file compiled with taar_lite.app.compile_model.  When set
+# the models are mapped from that file instead of downloaded from S3, and
+# the file is checked for replacement every TAAR_CACHE_EXPIRY seconds.
+TAAR_MODEL_FILE = config('TAAR_MODEL_FILE', default='')
+
+# Check that the coinstallations are symmetric on every refresh.  A model
+# that fails the check is not published, the current generation keeps
+# serving requests and the offending guid pairs are logged.
+TAAR_VALIDATE_COINSTALLS = config('TAAR_VALIDATE_COINSTALLS', default=True, cast=bool)
+
+# 'inline' reloads expired models on the request that notices the expiry.
+# 'background' reloads them from a refresher thread every
+# TAAR_REFRESH_INTERVAL seconds while requests keep using the current model.
+REFRESH_MODE_INLINE = 'inline'
+REFRESH_MODE_BACKGROUND = 'background'
+TAAR_REFRESH_MODE = config('TAAR_REFRESH_MODE', default=REFRESH_MODE_INLINE)
+TAAR_REFRESH_INTERVAL = config('TAAR_REFRESH_INTERVAL', default=60, cast=int)
+
+# Serve the multi-hop Guidception treatment as the 'guidception'
+# normalization, propagating over TAAR_GUIDCEPTION_DEPTH hops damped by
+# TAAR_GUIDCEPTION_DAMPING.  A depth of 0 leaves it out of the refresh.
+TAAR_GUIDCEPTION_DEPTH = config('TAAR_GUIDCEPTION_DEPTH', default=0, cast=int)
+TAAR_GUIDCEPTION_DAMPING = config('TAAR_GUIDCEPTION_DAMPING', default=Guidception.DAMPING, cast=float)
+
+# Build the recommenders of each normalization in parallel in a pool of
+# this many processes, which are handed the pruned coinstallations.
+# 0 or 1 builds them one after another in the refreshing thread.
+TAAR_TREATMENT_PROCESSES = config('TAAR_TREATMENT_PROCESSES', default=0, cast=int)
+
+# Normalizations built on their first request instead of with every model
+# generation, ie. 'none,row_count,row_sum'.  A lazily built normalization
+# is dropped once unused for TAAR_LAZY_MODE_IDLE_SECONDS, or kept until the
+# next generation when that is 0.  Recommenders read from a model file are
+# always built with the generation, as they only map the stored tables.
+TAAR_LAZY_MODES = config('TAAR_LAZY_MODES', default='', cast=Csv())
+TAAR_LAZY_MODE_IDLE_SECONDS = config('TAAR_LAZY_MODE_IDLE_SECONDS', default=0, cast=int)
+
+# Log the recommendations of 1 in TAAR_REQUEST_LOG_SAMPLE_RATE requests;
+# 1 logs every request and 0 none.  With TAAR_ASYNC_LOGGING the records of
+# the resource are queued, up to TAAR_LOG_QUEUE_SIZE of them, and emitted
+# by a background thread, so requests never wait on the log handlers.
+TAAR_REQUEST_LOG_SAMPLE_RATE = config('TAAR_REQUEST_LOG_SAMPLE_RATE', default=1, cast=int)
+TAAR_ASYNC_LOGGING = config('TAAR_ASYNC_LOGGING', default=False, cast=bool)
+TAAR_LOG_QUEUE_SIZE = config('TAAR_LOG_QUEUE_SIZE', default=10000, cast=int)
+
 NORM_MODE_ROWNORMSUM = 'rownorm_sum'
 NORM_MODE_ROWCOUNT = 'row_count'
 NORM_MODE_ROWSUM = 'row_sum'
+NORM_MODE_GUIDCEPTION = 'guidception'
 
 
 class LoggingMinInstallPrune(MinInstallPrune):
 
     def treat(self, input_dict, **kwargs):
         output_dict = super().treat(input_dict, **kwargs)
+        self._warn_low_threshold(**kwargs)
+        return output_dict
+
+    def treat_graph(self, graph, **kwargs):
+        output_graph = super().treat_graph(graph, **kwargs)
+        self._warn_low_threshold(**kwargs)
+        return output_graph
+
+    def _warn_low_threshold(self, **kwargs):
         if self.min_installs < 100:
             logger = kwargs['logger']
             logger.warn("minimum installs threshold low: [%s]" % self.min_installs)
-        return output_dict
+
+
+# A model generation is never mutated once published.  Swapping in a new
+# generation is a single attribute assignment, so a request always sees all
+# recommenders of one generation.  The version identifies the pair of JSON
+# models the recommenders were built from.  encoded maps each normalization
+# encoded by a ResponseEncoder to a dict of guid to its encoded results.
+ModelGeneration = namedtuple('ModelGeneration', [
+    'generation',
+    'version',
+    'coinstallations',
+    'rankings',
+    'recommenders',
+    'created_at',
+    'encoded',
+])
+
+
+def build_treatment_pipeline(rankings, logger, guidception_depth=None, processes=None):
+    """Returns the TreatmentPipeline computing the production recommenders."""
+    if guidception_depth is None:
+        guidception_depth = TAAR_GUIDCEPTION_DEPTH
+    if processes is None:
+        processes = TAAR_TREATMENT_PROCESSES
+    branches = OrderedDict([
+        ('none', NoTreatment()),
+        (NORM_MODE_ROWCOUNT, RowCount()),
+        (NORM_MODE_ROWSUM, RowSum()),
+        (NORM_MODE_ROWNORMSUM, RowNormSum()),
+    ])
+    if guidception_depth:
+        branches[NORM_MODE_GUIDCEPTION] = Guidception(guidception_depth, TAAR_GUIDCEPTION_DAMPING)
+    return TreatmentPipeline(
+        prefix=[LoggingMinInstallPrune()],
+        branches=branches,
+        treatment_kwargs={
+            'ranking_dict': rankings,
+            'logger': logger,
+        },
+        processes=processes
+    )
+
+
+def model_parameters(pipeline, precompute_limit):
+    """Returns the parameters stored in a model file with the recommenders
+    of pipeline, ie. by compile_model.
+    """
+    return OrderedDict([
+        ('treatments', pipeline.parameters),
+        ('precompute_limit', precompute_limit or None),
+    ])
+
+
+def stored_recommenders(model_file, pipeline, precompute_limit, logger):
+    """Returns the treated graphs and top-N tables of a model file that can
+    be used with pipeline, as the treated_graphs and top_n_tables arguments
+    of its build_recommenders.
+
+    The treated graphs are only used when the file was compiled with the
+    same treatments and parameters, and the top-N tables when it also was
+    compiled with the same precompute limit.  Either is None otherwise, and
+    the recommenders are recomputed.
+    """
+    if model_file is None or not model_file.treated_graphs:
+        return None, None
+    stored = model_file.parameters or {}
+    expected = json.loads(json.dumps(model_parameters(pipeline, precompute_limit)))
+    if stored.get('treatments') != expected['treatments']:
+        logger.warn("Model file recommenders [%s] were built with other treatments, recomputing them" %
+                    ", ".join(model_file.treated_graphs))
+        return None, None
+
+    treated_graphs = model_file.treated_graphs
+    if stored.get('precompute_limit') != expected['precompute_limit']:
+        logger.warn("Model file top-N tables were built with precompute limit [%s], recomputing them" %
+                    stored.get('precompute_limit'))
+        return treated_graphs, None
+    return treated_graphs, {name: model_file.top_n_table(name) for name in treated_graphs}
+
+
+class ModelRefresher(threading.Thread):
+    """Periodically refreshes a TaarLiteAppResource off the request path."""
+
+    def __init__(self, resource, interval):
+        super().__init__(name='taarlite-refresher', daemon=True)
+        self._resource = resource
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self._resource.refresh()
+
+    def stop(self):
+        self._stopped.set()
 
 
 class TaarLiteAppResource:
@@ -52,45 +223,107 @@ class TaarLiteAppResource:
 
     This recommender will drive recommendations
     surfaced on addons.mozilla.org
+
+    Each set of recommenders is published as a numbered ModelGeneration.
+    In background refresh mode the models are reloaded by a ModelRefresher
+    and requests are served from the current generation until the next one
+    is ready.
+
+    Concurrency model:
+
+    - Readers take no lock.  A request reads self._model once and uses that
+      generation for its whole duration.  Nothing reachable from a published
+      generation is mutated, and publishing is a single attribute assignment.
+      The one exception are the lazy normalizations of a ModePolicy: their
+      ModeRecommenders builds each once under its own lock, and dropping an
+      idle one leaves the requests that already looked it up unaffected.
+    - Rebuilds are single flight.  refresh() returns immediately while the
+      loaders have not expired.  Otherwise a thread takes the refresh lock
+      without blocking; if another thread already holds it, the request is
+      served from the current generation.  Only while no generation exists
+      yet do threads wait for the lock.
+
+    Refresh and request metrics are reported to the metrics sink of the
+    context, or to the one configured by TAAR_STATSD_HOST, see
+    taar_lite.app.metrics.
     """
 
     _addons_coinstallations = None
-    _recommenders = {}
+    _model = None
+    _refresher = None
 
     # Define recursion levels for guid-ception
     RECURSION_LEVELS = 3
 
-    def __init__(self, ctx):
+    def __init__(self, ctx, refresh_mode=TAAR_REFRESH_MODE, refresh_interval=TAAR_REFRESH_INTERVAL,
+                 compact_model=TAAR_COMPACT_MODEL, model_file=TAAR_MODEL_FILE,
+                 mode_policy=ModePolicy(frozenset(TAAR_LAZY_MODES), TAAR_LAZY_MODE_IDLE_SECONDS),
+                 request_log_sample_rate=TAAR_REQUEST_LOG_SAMPLE_RATE, response_encoder=None):
         self._ctx = ctx
+        self._request_log_sample_rate = request_log_sample_rate
+        self._response_encoder = response_encoder
         assert IS3Data in self._ctx
+        if 'metrics' in self._ctx:
+            self._metrics = self._ctx['metrics']
+        else:
+            self._metrics = sink_from_config()
+        assert refresh_mode in (REFRESH_MODE_INLINE, REFRESH_MODE_BACKGROUND)
+        self._compact_model = compact_model
+        self._mode_policy = mode_policy
+        self._refresh_lock = threading.Lock()
+        # The version of the last models that failed validation, with the
+        # models so that the ids in their version are not reused
+        self._rejected_model = None
+        self._refresh_status = {
+            'last_refresh_time': None,
+            'last_refresh_duration': None,
+            'last_error': None,
+        }
+
+        self._model_file_loader = None
+        if 'model_file_loader' in self._ctx:
+            self._model_file_loader = self._ctx['model_file_loader']
+        elif model_file:
+            self._model_file_loader = ModelFileLoader(self._ctx, model_file, TAAR_CACHE_EXPIRY)
 
         if 'coinstall_loader' in self._ctx:
             self._addons_coinstall_loader = self._ctx['coinstall_loader']
         else:
-            self._addons_coinstall_loader = LazyJSONLoader(self._ctx,
-                                                           ADDON_LIST_BUCKET,
-                                                           ADDON_LIST_KEY,
-                                                           TAAR_CACHE_EXPIRY)
+            # The compact graph is built row by row while the JSON is
+            # downloaded, so the raw dict is never materialised.
+            loader_class = StreamingGraphLoader if compact_model else ETagJSONLoader
+            self._addons_coinstall_loader = loader_class(self._ctx,
+                                                         ADDON_LIST_BUCKET,
+                                                         ADDON_LIST_KEY,
+                                                         TAAR_CACHE_EXPIRY,
+                                                         self._metrics)
 
         if 'ranking_loader' in self._ctx:
             self._guid_ranking_loader = self._ctx['ranking_loader']
         else:
-            self._guid_ranking_loader = LazyJSONLoader(self._ctx,
+            self._guid_ranking_loader = ETagJSONLoader(self._ctx,
                                                        ADDON_LIST_BUCKET,
                                                        GUID_RANKING_KEY,
-                                                       TAAR_CACHE_EXPIRY)
+                                                       TAAR_CACHE_EXPIRY,
+                                                       self._metrics)
         self._init_from_ctx()
-        # Force access to the JSON models for each request at
-        # recommender construction.  This was lifted out of the
-        # constructor for the LazyJSONLoader so that the
-        # precomputation of the normalization tables can be done in
-        # the recommender.
-        _ = self._addons_coinstallations  # noqa
-        _ = self._guid_rankings           # noqa
+
+        if refresh_mode == REFRESH_MODE_BACKGROUND:
+            self._refresher = ModelRefresher(self, refresh_interval)
+            self._refresher.start()
         self.logger.info("GUIDBasedRecommender is initialized")
 
     def _init_from_ctx(self):
         self.logger = self._ctx[IMozLogging].get_logger('taarlite')
+        if TAAR_ASYNC_LOGGING:
+            log_asynchronously(self.logger, TAAR_LOG_QUEUE_SIZE)
+        self._request_log = RequestLog(self.logger, self._request_log_sample_rate)
+
+        # Force access to the JSON models at recommender construction.
+        # This was lifted out of the constructor for the LazyJSONLoader
+        # so that the precomputation of the normalization tables can be
+        # done in the recommender.
+        self.refresh()
 
         if self._addons_coinstallations is None:
             self.logger.error(ADDON_DL_ERR)
@@ -99,58 +332,359 @@ class TaarLiteAppResource:
 
     @property
     def _addons_coinstallations(self):  # noqa
-        result, refreshed = self._addons_coinstall_loader.get()
-        if refreshed:
-            self.logger.info("Refreshing guid_maps for normalization")
-            self._precompute_recommenders()
-        return result
+        model = self._model
+        if model is None:
+            return None
+        return model.coinstallations
 
     @property
     def _guid_rankings(self):
-        result, refreshed = self._guid_ranking_loader.get()
-        if refreshed:
-            self.logger.info("Refreshing guid_maps for normalization")
-            self._precompute_recommenders()
-        return result
-
-    def _precompute_recommenders(self):
-        def get_recommender(treatment):
-            return GuidGuidCoinstallRecommender(
-                raw_coinstall_dict=self._addons_coinstallations,
-                treatments=[LoggingMinInstallPrune(), treatment],
-                treatment_kwargs={
-                    'ranking_dict': self._guid_rankings,
-                    'logger': self.logger,
-                },
-                tie_breaker_dict=self._guid_rankings,
-                validate_raw_coinstall_dict=False
-            )
-        self._recommenders = {
-            'none': get_recommender(NoTreatment()),
-            NORM_MODE_ROWCOUNT: get_recommender(RowCount()),
-            NORM_MODE_ROWSUM: get_recommender(RowSum()),
-            NORM_MODE_ROWNORMSUM: get_recommender(RowNormSum()),
+        model = self._model
+        if model is None:
+            return None
+        return model.rankings
+
+    @staticmethod
+    def _model_version(loader, data):
+        # Prefer the S3 ETag.  Loaders without one hand back the same
+        # object until they reload, and the current generation holds a
+        # reference to it so its id can not be reused.
+        etag = getattr(loader, 'etag', None)
+        if etag is not None:
+            return etag
+        return id(data)
+
+    @property
+    def _loaders(self):
+        if self._model_file_loader is not None:
+            return (self._model_file_loader,)
+        return (self._addons_coinstall_loader, self._guid_ranking_loader)
+
+    def _sync_models(self):
+        """Fetches both JSON models and rebuilds the recommenders once if
+        either of them changed since the current generation was built.
+        """
+        if self._model_file_loader is not None:
+            self._sync_model_file()
+            return
+
+        rankings, _ = self._guid_ranking_loader.get()
+        if rankings is None:
+            return
+        set_row_filter = getattr(self._addons_coinstall_loader, 'set_row_filter', None)
+        if set_row_filter is not None:
+            # Rows below the install threshold are pruned while parsing
+            set_row_filter(MinInstallPrune().row_filter(rankings),
+                           self._model_version(self._guid_ranking_loader, rankings))
+        coinstallations, _ = self._addons_coinstall_loader.get()
+        if coinstallations is None:
+            return
+        if not getattr(self._addons_coinstall_loader, 'has_current_row_filter', True):
+            # The graph was pruned for the previous rankings and could not
+            # be downloaded again, keep serving the current generation
+            return
+
+        version = (
+            self._model_version(self._addons_coinstall_loader, coinstallations),
+            self._model_version(self._guid_ranking_loader, rankings),
+        )
+        model = self._model
+        if model is not None and model.version == version:
+            return
+        if self._is_rejected(version):
+            return
+
+        self.logger.info("Refreshing guid_maps for normalization")
+        self._precompute_recommenders(coinstallations, rankings, version)
+
+    def _is_rejected(self, version):
+        """Tells if the models of version failed validation.  They are not
+        validated again until a loader returns another version.
+        """
+        return self._rejected_model is not None and self._rejected_model[0] == version
+
+    def _sync_model_file(self):
+        """Maps the compiled model file and builds the recommenders if the
+        file was replaced since the current generation was built.
+
+        Treated graphs and top-N tables stored in the file are used as is.
+        """
+        model_file, _ = self._model_file_loader.get()
+        if model_file is None:
+            return
+
+        version = (self._model_version(self._model_file_loader, model_file),)
+        model = self._model
+        if model is not None and model.version == version:
+            return
+        if self._is_rejected(version):
+            return
+
+        self.logger.info("Refreshing guid_maps from model file [%s]" % model_file.path)
+        self._precompute_recommenders(model_file.graph, model_file.rankings, version, model_file)
+
+    @property
+    def metrics(self):
+        """Returns the metrics sink of the resource."""
+        return self._metrics
+
+    @property
+    def _recommenders(self):
+        model = self._model
+        if model is None:
+            return {}
+        return model.recommenders
+
+    def is_ready(self):
+        """Returns True once a model generation is serving requests."""
+        return self._model is not None
+
+    @property
+    def generation(self):
+        """Returns the id of the model generation serving requests, or None."""
+        model = self._model
+        if model is None:
+            return None
+        return model.generation
+
+    def current_generation(self):
+        """Returns the id of the generation that will serve the next request.
+
+        In inline refresh mode expired models are reloaded first.
+        """
+        if self._refresher is None:
+            self.refresh()
+        return self.generation
+
+    def refresh_status(self):
+        """Returns the generation id and the outcome of the last model refresh.
+
+        last_refresh_time and last_refresh_duration describe the last
+        successful rebuild, last_error holds the error of the last failed
+        refresh, or None once a refresh succeeds.
+        """
+        status = dict(self._refresh_status)
+        status['generation'] = self.generation
+        status['refresh_mode'] = REFRESH_MODE_BACKGROUND if self._refresher else REFRESH_MODE_INLINE
+        recommenders = self._recommenders
+        if isinstance(recommenders, ModeRecommenders):
+            status['built_modes'] = recommenders.built_modes()
+        else:
+            status['built_modes'] = list(recommenders)
+        return status
+
+    def refresh(self):
+        """Reloads the JSON models if they expired, publishing a new generation.
+
+        Errors are logged and recorded in the refresh status, and the
+        current generation keeps serving requests.
+        """
+        recommenders = self._recommenders
+        if isinstance(recommenders, ModeRecommenders):
+            recommenders.evict_idle()
+
+        # Without a model, requests wait for the first rebuild, unless the
+        # models were rejected and are not reloaded until the loaders expire
+        settled = self._model is not None or self._rejected_model is not None
+        if settled and not self._loaders_expired():
+            return
+
+        if not self._refresh_lock.acquire(blocking=not settled):
+            # Another thread is already rebuilding
+            return
+        try:
+            self._sync_models()
+        except Exception as e:
+            self.logger.exception("Model refresh failed")
+            self._metrics.incr('refresh.errors')
+            self._refresh_status = dict(self._refresh_status, last_error=repr(e))
+        finally:
+            self._refresh_lock.release()
+
+    def _loaders_expired(self):
+        for loader in self._loaders:
+            has_expired = getattr(loader, 'has_expired', None)
+            if has_expired is None or has_expired():
+                return True
+        return False
+
+    def stop_refresher(self):
+        if self._refresher is not None:
+            self._refresher.stop()
+
+    def _precompute_recommenders(self, coinstallations, rankings, version, model_file=None):
+        start = time.perf_counter()
+        raw_graph = coinstallations
+        if self._compact_model and not isinstance(raw_graph, CoinstallGraph):
+            raw_graph = CoinstallGraph.from_dict(raw_graph)
+
+        if TAAR_VALIDATE_COINSTALLS:
+            try:
+                GuidGuidCoinstallRecommender.validate_coinstall_dict(raw_graph)
+            except AsymmetricCoinstallError:
+                self._rejected_model = (version, coinstallations, rankings)
+                raise
+
+        pipeline = build_treatment_pipeline(rankings, self.logger)
+        treated_graphs, top_n_tables = stored_recommenders(model_file, pipeline, TAAR_PRECOMPUTE_LIMIT,
+                                                           self.logger)
+
+        lazy_modes = []
+        if treated_graphs is None:
+            lazy_modes = [name for name in pipeline.branches if name in self._mode_policy.lazy_modes]
+        recommender_kwargs = {
+            'tie_breaker_dict': rankings,
+            'validate_raw_coinstall_dict': False,
+            'precompute_limit': TAAR_PRECOMPUTE_LIMIT or None,
         }
+        recommenders = pipeline.build_recommenders(
+            raw_graph,
+            treated_graphs=treated_graphs,
+            top_n_tables=top_n_tables,
+            names=[name for name in pipeline.branches if name not in lazy_modes],
+            **recommender_kwargs
+        )
+        if lazy_modes:
+            recommenders = ModeRecommenders(recommenders, pipeline, lazy_modes, recommender_kwargs,
+                                            self._mode_policy.idle_seconds, self.logger,
+                                            metrics=self._metrics)
+        encoded = self._encode_responses(recommenders)
+        generation = 1 if self._model is None else self._model.generation + 1
+        self._model = ModelGeneration(generation, version, coinstallations, rankings, recommenders, time.time(),
+                                      encoded)
+        self._refresh_status = {
+            'last_refresh_time': self._model.created_at,
+            'last_refresh_duration': time.perf_counter() - start,
+            'last_error': None,
+        }
+
+        stage_timings = ", ".join("%s=%.3fs" % item for item in pipeline.timings.items())
+        self.logger.info("Precomputed recommenders for generation [%s]: [%s]" % (generation, stage_timings))
+        self._report_refresh(pipeline, recommenders)
+
+    def _report_refresh(self, pipeline, recommenders):
+        metrics = self._metrics
+        for stage, seconds in pipeline.timings.items():
+            metrics.timing('refresh.' + stage, seconds)
+        metrics.timing('refresh.duration', self._refresh_status['last_refresh_duration'])
+        metrics.gauge('model.generation', self._model.generation)
+        if isinstance(recommenders, ModeRecommenders):
+            built_modes = recommenders.built_modes()
+        else:
+            built_modes = list(recommenders)
+        for mode in built_modes:
+            report_graph_size(metrics, mode, recommenders[mode].treated_graph)
+
+    def _encode_responses(self, recommenders):
+        """Encodes the results of every guid, for the eagerly built
+        recommenders whose top-N table holds response_encoder.limit of them.
+        """
+        response_encoder = self._response_encoder
+        if response_encoder is None:
+            return {}
+        start = time.perf_counter()
+        encoded = {}
+        built_modes = recommenders.built_modes() if isinstance(recommenders, ModeRecommenders) else recommenders
+        for mode in built_modes:
+            recommender = recommenders[mode]
+            if recommender.top_n_table is not None and response_encoder.limit <= recommender.precompute_limit:
+                encoded[mode] = encode_top_n(recommender.top_n_table, response_encoder)
+        self._metrics.timing('refresh.encode', time.perf_counter() - start)
+        return encoded
+
+    def encoded_recommendations(self, client_data, limit=4):
+        """Returns the encoded results that the response encoder computed
+        for the recommendations of client_data, or None when they were not
+        encoded ahead of time, ie. for another limit or normalization.
+
+        Requests served this way are logged and timed as recommend does.
+        The logged recommendations are sliced from the top-N table only once
+        a sampled record is emitted.
+        """
+        if self._refresher is None:
+            self.refresh()
+
+        start = time.perf_counter()
+        model = self._model
+        if model is None or self._response_encoder is None or limit != self._response_encoder.limit:
+            return None
+        normalize = client_data.get('normalize', NORM_MODE_ROWNORMSUM)
+        encoded = model.encoded.get(normalize)
+        if encoded is None:
+            return None
+        addon_guid = client_data.get('guid')
+        body = encoded.get(addon_guid)
+        if body is None:
+            body = self._response_encoder.encode([])
+        self._metrics.timing('request.lookup', time.perf_counter() - start)
+        # The recommendations are only ranked if the record is emitted
+        self._request_log.log_deferred(addon_guid, model.recommenders[normalize].recommend, addon_guid, limit)
+        return body
 
     def recommend(self, client_data, limit=4):
         """
         TAAR lite will yield 4 recommendations for the AMO page
         """
 
-        # Force access to the JSON models for each request at the
-        # start of the request to update normalization tables if
-        # required.
-        _ = self._addons_coinstallations  # noqa
-        _ = self._guid_rankings           # noqa
+        if self._refresher is None:
+            # Check the JSON models for each request at the start of
+            # the request to update normalization tables if required.
+            self.refresh()
 
+        # Inline refreshes are timed by refresh.duration, not request.lookup
+        start = time.perf_counter()
+        recommenders = self._recommenders
         addon_guid = client_data.get('guid')
         normalize = client_data.get('normalize', NORM_MODE_ROWNORMSUM)
-        if normalize not in self._recommenders:
+        if normalize not in recommenders:
             # Yield no results if the normalization method is not specified
             self.logger.warn("Invalid normalization parameter detected: [%s]" % normalize)
+            self._metrics.incr('request.invalid_normalization')
             return []
 
-        result_list = self._recommenders[normalize].recommend(addon_guid, limit)
-        log_data = (str(addon_guid), [str(r) for r in result_list])
-        self.logger.info("Addon: [%s] triggered these recommendation guids: [%s]" % log_data)
+        recommender = recommenders[normalize]
+        looked_up = time.perf_counter()
+        result_list = recommender.recommend(addon_guid, limit)
+        self._metrics.timing('request.lookup', looked_up - start)
+        self._metrics.timing('request.ranking', time.perf_counter() - looked_up)
+        self._request_log.log(addon_guid, result_list)
         return result_list
+
+    def record_request(self, client_data, result_list, lookup_seconds):
+        """Reports a request served without calling recommend, ie. from a
+        response cache, as recommend would have: the request.lookup timing
+        and the request log, or the invalid normalization.
+        """
+        normalize = client_data.get('normalize', NORM_MODE_ROWNORMSUM)
+        if normalize not in self._recommenders:
+            self.logger.warn("Invalid normalization parameter detected: [%s]" % normalize)
+            self._metrics.incr('request.invalid_normalization')
+            return
+        self._metrics.timing('request.lookup', lookup_seconds)
+        self._request_log.log(client_data.get('guid'), result_list)
+
+    def recommend_many(self, guids, normalize=None, limit=4):
+        """Returns a dict of guid to recommendations for a batch of guids.
+
+        All guids are served from the same model generation, and the models
+        are checked for expiry once for the whole batch.
+        """
+        if self._refresher is None:
+            self.refresh()
+
+        start = time.perf_counter()
+        recommenders = self._recommenders
+        if normalize is None:
+            normalize = NORM_MODE_ROWNORMSUM
+        if normalize not in recommenders:
+            self.logger.warn("Invalid normalization parameter detected: [%s]" % normalize)
+            self._metrics.incr('request.invalid_normalization')
+            return {guid: [] for guid in guids}
+
+        recommender = recommenders[normalize]
+        looked_up = time.perf_counter()
+        results = recommender.recommend_many(guids, limit)
+        self._metrics.timing('batch.lookup', looked_up - start)
+        self._metrics.timing('batch.ranking', time.perf_counter() - looked_up)
+        self.logger.info("Batch of [%d] addons triggered recommendations" % len(results))
+        return results
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Per-request logging of the TAAR-lite resource.
+
+Request records are formatted lazily, by the handler that emits them, so
+that a record the logger drops costs no formatting at all.  They can be
+sampled, and handed to a background thread with log_asynchronously.
+"""
+import atexit
+import itertools
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+
+
+class _Recommendations:
+    """Formats a list of recommendations as the request log always did,
+    once the record is emitted.
+    """
+
+    __slots__ = ('_result_list',)
+
+    def __init__(self, result_list):
+        self._result_list = result_list
+
+    def __str__(self):
+        return str([str(r) for r in self._result_list])
+
+
+class _DeferredRecommendations:
+    """Computes a list of recommendations, and formats it as
+    _Recommendations does, once the record is emitted.
+    """
+
+    __slots__ = ('_recommend', '_args')
+
+    def __init__(self, recommend, args):
+        self._recommend = recommend
+        self._args = args
+
+    def __str__(self):
+        return str(_Recommendations(self._recommend(*self._args)))
+
+
+class RequestLog:
+    """Logs the recommendations returned for 1 in sample_rate requests.
+
+    A sample_rate of 1 logs every request and 0 none of them.
+    """
+
+    def __init__(self, logger, sample_rate=1):
+        self._logger = logger
+        self._sample_rate = sample_rate
+        self._requests = itertools.count()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    def _sampled(self):
+        if not self._sample_rate:
+            return False
+        # next() on a count is atomic, concurrent requests each get their own number
+        return self._sample_rate == 1 or not next(self._requests) % self._sample_rate
+
+    def log(self, addon_guid, result_list):
+        if self._sampled():
+            self._logger.info("Addon: [%s] triggered these recommendation guids: [%s]",
+                              addon_guid, _Recommendations(result_list))
+
+    def log_deferred(self, addon_guid, recommend, *args):
+        """Logs the recommendations recommend(*args) returns, calling it only
+        once a sampled record is emitted.  recommend must give the same
+        result whenever it is called, ie. from an immutable recommender.
+        """
+        if self._sampled():
+            self._logger.info("Addon: [%s] triggered these recommendation guids: [%s]",
+                              addon_guid, _DeferredRecommendations(recommend, args))
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queues records without formatting them, and drops them when the
+    queue is full rather than blocking the logging thread.
+
+    The records are formatted by the handlers of the listener thread, so
+    their arguments must not be mutated once logged.  Request records only
+    hold the guid and the result list, which are never mutated.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(QueueListener):
+
+    def enqueue_sentinel(self):
+        # Wait for the thread to make room rather than lose the sentinel
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+_async_lock = threading.Lock()
+
+
+def log_asynchronously(logger, queue_size=10000):
+    """Moves the handlers that the records of logger reach, its own and
+    those of its ancestors, to a background thread fed by a bounded queue.
+
+    Records are dropped when queue_size records are waiting.  Calling it
+    again for the same logger has no effect.  Returns the handler queueing
+    the records.
+    """
+    with _async_lock:
+        for handler in logger.handlers:
+            if isinstance(handler, _DeferredQueueHandler):
+                return handler
+
+        handlers = []
+        current = logger
+        while current is not None:
+            handlers.extend(current.handlers)
+            if not current.propagate:
+                break
+            current = current.parent
+
+        queue_handler = _DeferredQueueHandler(queue.Queue(queue_size))
+        listener = _QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        # Emit the records still queued at exit
+        atexit.register(listener.stop)
+
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        queue_handler.listener = listener
+        return queue_handler
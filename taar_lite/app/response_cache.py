@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import threading
+
+
+class ResponseCache:
+    """A bounded LRU cache of responses.
+
+    Every lookup carries the token of the model that would compute the
+    response, ie. the model generation.  When the token changes all cached
+    responses are dropped, so a response is never served from a previous
+    model generation.
+
+    A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._token = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def _check_token(self, token):
+        # Must be called with the lock held
+        if token != self._token:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._token = token
+
+    def get(self, token, key):
+        """Returns the cached response for key, or None."""
+        if self._max_size <= 0:
+            return None
+        with self._lock:
+            self._check_token(token)
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, token, key, value):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._check_token(token)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._token = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Deltas between two versions of the coinstallation and ranking models.
+
+The upstream job rewrites the models daily but only a fraction of the rows
+change.  A CoinstallDelta describes those changes, so that
+GuidGuidCoinstallRecommender.with_delta can recompute only what they affect.
+"""
+from .graph import CoinstallGraph
+
+
+class CoinstallDelta:
+    """The rows and rankings that changed between two model versions.
+
+    Accepts:
+        - a dict of guid to coinstalls for the rows that were added or
+          changed
+        - the guids whose rows were removed
+        - a dict of guid to ranking for the rankings that were added or
+          changed
+        - the guids whose rankings were removed
+    """
+
+    def __init__(self, changed_rows=None, removed_rows=(), rankings=None, removed_rankings=()):
+        self._changed_rows = changed_rows or {}
+        self._removed_rows = frozenset(removed_rows)
+        self._rankings = rankings or {}
+        self._removed_rankings = frozenset(removed_rankings)
+        if self._removed_rows & set(self._changed_rows):
+            raise ValueError("Rows can not be both changed and removed")
+        if self._removed_rankings & set(self._rankings):
+            raise ValueError("Rankings can not be both changed and removed")
+
+    @classmethod
+    def between(cls, previous_graph, graph, previous_rankings=None, rankings=None):
+        """Returns the delta turning previous_graph and previous_rankings
+        into graph and rankings.  Rankings are compared only when both are
+        supplied.
+        """
+        changed_rows = {guid: coinstalls for guid, coinstalls in graph.items()
+                        if guid not in previous_graph or previous_graph[guid] != coinstalls}
+        removed_rows = [guid for guid in previous_graph if guid not in graph]
+        changed_rankings = {}
+        removed_rankings = []
+        if previous_rankings is not None and rankings is not None:
+            changed_rankings = {guid: rank for guid, rank in rankings.items()
+                                if guid not in previous_rankings or previous_rankings[guid] != rank}
+            removed_rankings = [guid for guid in previous_rankings if guid not in rankings]
+        return cls(changed_rows, removed_rows, changed_rankings, removed_rankings)
+
+    @property
+    def changed_rows(self):
+        return self._changed_rows
+
+    @property
+    def removed_rows(self):
+        return self._removed_rows
+
+    @property
+    def rankings(self):
+        return self._rankings
+
+    @property
+    def removed_rankings(self):
+        return self._removed_rankings
+
+    @property
+    def row_guids(self):
+        """Returns the guids whose rows were added, changed or removed."""
+        return self._removed_rows.union(self._changed_rows)
+
+    @property
+    def ranking_guids(self):
+        """Returns the guids whose rankings were added, changed or removed."""
+        return self._removed_rankings.union(self._rankings)
+
+    def __len__(self):
+        return len(self._changed_rows) + len(self._removed_rows) + len(self._rankings) + len(self._removed_rankings)
+
+    def apply_to_graph(self, graph):
+        """Returns a new coinstall graph with the delta applied.
+
+        Rows keep their position, and added rows are appended in the order
+        of changed_rows.
+        """
+        if isinstance(graph, CoinstallGraph):
+            return graph.with_rows(self._changed_rows, self._removed_rows)
+        graph = dict(graph)
+        for guid in self._removed_rows:
+            graph.pop(guid, None)
+        graph.update(self._changed_rows)
+        return graph
+
+    def apply_to_rankings(self, rankings):
+        """Returns a new ranking dict with the delta applied."""
+        if not self._rankings and not self._removed_rankings:
+            return rankings
+        rankings = dict(rankings)
+        for guid in self._removed_rankings:
+            rankings.pop(guid, None)
+        rankings.update(self._rankings)
+        return rankings
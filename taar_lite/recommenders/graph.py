@@ -0,0 +1,396 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""A columnar representation of the coinstallation graph.
+
+The dict of dicts format used throughout taar-lite keeps a Python float and a
+dict entry per edge.  CoinstallGraph holds the same information as a guid
+vocabulary and a scipy.sparse CSR matrix so that treatments can be expressed as
+vectorised operations over the edge arrays.
+"""
+from array import array
+from collections.abc import Mapping
+import sys
+
+import numpy as np
+from scipy import sparse
+
+
+class CoinstallGraph(Mapping):
+    """A coinstallation graph backed by a guid vocabulary and a CSR matrix.
+
+    Row i of the matrix holds the edges of vocabulary[i], and the column
+    indices of each row point back into the vocabulary.  A guid that only
+    appears as a coinstalled addon has an index but no row; row_mask records
+    which guids have a row.
+
+    The graph is a read-only Mapping, so it can stand in for the dict format:
+
+        graph['guid_a'] == {'guid_b': 10.0, 'guid_c': 13.0}
+
+    Treated graphs derived with with_data or select_rows share the
+    vocabulary, the vectors computed from it, and with_data also shares the
+    index arrays.  A model with several treatments therefore only holds one
+    copy of the guids and one weight array per treatment.
+    """
+
+    def __init__(self, vocabulary, matrix, row_mask, index=None, vectors=None):
+        if index is None:
+            index = {guid: i for i, guid in enumerate(vocabulary)}
+        if vectors is None:
+            vectors = {}
+        self._vocabulary = vocabulary
+        self._index = index
+        self._matrix = matrix
+        self._row_mask = row_mask
+        self._row_count = int(np.count_nonzero(row_mask))
+        self._vectors = vectors
+
+    @classmethod
+    def from_dict(cls, coinstall_dict):
+        """Builds a graph from the dict of dicts coinstall format.
+
+        Row keys are indexed first, in dict order, followed by guids that
+        only appear as coinstalled addons.  Edge order within a row is kept.
+        The guids are interned, so the graph holds a single string per guid
+        however many rows it appears in.
+        """
+        builder = CoinstallGraphBuilder()
+        for guid in coinstall_dict:
+            builder.add_guid(guid)
+        for guid, coinstalls in coinstall_dict.items():
+            builder.add_row(guid, coinstalls)
+        return builder.build()
+
+    @property
+    def vocabulary(self):
+        """Returns the list of guids, in index order."""
+        return self._vocabulary
+
+    @property
+    def index(self):
+        """Returns a dict mapping each guid to its vocabulary index."""
+        return self._index
+
+    @property
+    def matrix(self):
+        """Returns the scipy.sparse CSR matrix of edge weights."""
+        return self._matrix
+
+    @property
+    def row_mask(self):
+        """Returns a boolean array flagging the guids that have a row."""
+        return self._row_mask
+
+    def __getitem__(self, guid):
+        i = self._index.get(guid)
+        if i is None or not self._row_mask[i]:
+            raise KeyError(guid)
+        indices, weights = self._row_slice(i)
+        vocabulary = self._vocabulary
+        return {vocabulary[j]: w for j, w in zip(indices.tolist(), weights.tolist())}
+
+    def __contains__(self, guid):
+        i = self._index.get(guid)
+        return i is not None and bool(self._row_mask[i])
+
+    def __iter__(self):
+        vocabulary = self._vocabulary
+        for i in np.flatnonzero(self._row_mask).tolist():
+            yield vocabulary[i]
+
+    def __len__(self):
+        return self._row_count
+
+    def _row_slice(self, i):
+        matrix = self._matrix
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        return matrix.indices[start:end], matrix.data[start:end]
+
+    def row(self, guid):
+        """Returns the (indices, weights) arrays for the row of guid."""
+        if guid not in self:
+            raise KeyError(guid)
+        return self._row_slice(self._index[guid])
+
+    def row_ids(self):
+        """Returns the row index of every stored edge, aligned with matrix.data."""
+        return np.repeat(np.arange(self._matrix.shape[0]), np.diff(self._matrix.indptr))
+
+    def vector(self, values, default=0):
+        """Returns a float array aligned with the vocabulary from a guid keyed dict.
+
+        The array is computed once per dict for all graphs sharing this
+        vocabulary, so values must not be mutated afterwards.
+        """
+        key = (id(values), default)
+        cached = self._vectors.get(key)
+        # The dict is kept with its vector so that its id can not be reused
+        if cached is None or cached[0] is not values:
+            vector = np.array([values.get(guid, default) for guid in self._vocabulary], dtype=np.float64)
+            cached = self._vectors[key] = (values, vector)
+        return cached[1]
+
+    def with_matrix(self, matrix, row_mask):
+        """Returns a graph over the same vocabulary with another matrix and row mask."""
+        return self.__class__(self._vocabulary, matrix, row_mask, self._index, self._vectors)
+
+    def with_data(self, data):
+        """Returns a graph with the same edges and new edge weights."""
+        matrix = sparse.csr_matrix(
+            (data, self._matrix.indices, self._matrix.indptr),
+            shape=self._matrix.shape,
+            copy=False
+        )
+        return self.with_matrix(matrix, self._row_mask)
+
+    def select_rows(self, row_mask):
+        """Returns a graph keeping only the rows flagged in row_mask."""
+        row_mask = self._row_mask & row_mask
+        matrix = self._matrix
+        counts = np.diff(matrix.indptr)
+        edge_mask = np.repeat(row_mask, counts)
+        indptr = np.zeros(len(counts) + 1, dtype=matrix.indptr.dtype)
+        np.cumsum(counts * row_mask, out=indptr[1:])
+        matrix = sparse.csr_matrix(
+            (matrix.data[edge_mask], matrix.indices[edge_mask], indptr),
+            shape=matrix.shape,
+            copy=False
+        )
+        return self.with_matrix(matrix, row_mask)
+
+    def with_rows(self, changed_rows, removed_rows=()):
+        """Returns a graph with rows replaced, added or removed.
+
+        Accepts a dict of guid to coinstalls for the rows to add or replace
+        and the guids of the rows to remove.  New guids are appended to a
+        copy of the vocabulary, so existing guids keep their index.
+        """
+        vocabulary = list(self._vocabulary)
+        index = dict(self._index)
+        builder = CoinstallGraphBuilder(vocabulary, index)
+        for guid, coinstalls in changed_rows.items():
+            builder.add_row(guid, coinstalls)
+        size = len(vocabulary)
+
+        replaced = np.zeros(size, dtype=bool)
+        replaced[[index[guid] for guid in removed_rows if guid in index]] = True
+        replaced[[index[guid] for guid in changed_rows]] = True
+        old_row_ids = self.row_ids()
+        kept = ~replaced[old_row_ids]
+        new_row_ids, new_indices, new_data = builder.edges()
+
+        row_ids = np.concatenate([old_row_ids[kept], new_row_ids])
+        # A stable sort keeps the edge order within each row
+        order = np.argsort(row_ids, kind='mergesort')
+        indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(row_ids, minlength=size), out=indptr[1:])
+        matrix = sparse.csr_matrix(
+            (np.concatenate([self._matrix.data[kept], new_data])[order],
+             np.concatenate([self._matrix.indices[kept], new_indices])[order],
+             indptr),
+            shape=(size, size)
+        )
+        row_mask = np.zeros(size, dtype=bool)
+        row_mask[:len(self._row_mask)] = self._row_mask & ~replaced[:len(self._row_mask)]
+        row_mask[[index[guid] for guid in changed_rows]] = True
+        return self.__class__(vocabulary, matrix, row_mask, index)
+
+    def asymmetric_pairs(self):
+        """Returns the pairs of guids with a row whose edges are not symmetric.
+
+        Each pair is reported once as (guid_a, guid_b, weight_ab, weight_ba),
+        where a missing edge has a weight of None.  Weights are compared with
+        numpy.isclose, and NaN weights match each other and missing edges.
+        Edges to guids without a row are not checked.
+
+        Edges are matched through sorted int64 edge keys, so the check takes
+        O(edges) memory.
+        """
+        matrix = self._matrix
+        size = matrix.shape[0]
+        rows = self.row_ids()
+        columns = matrix.indices.astype(np.int64)
+        checked = self._row_mask[columns]
+        rows, columns, weights = rows[checked], columns[checked], matrix.data[checked]
+
+        keys = rows * size + columns
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        transposed_keys = columns * size + rows
+        transposed = np.minimum(np.searchsorted(sorted_keys, transposed_keys), len(keys) - 1)
+        found = np.zeros(len(keys), dtype=bool)
+        transposed_weights = np.full(len(keys), np.nan)
+        if len(keys):
+            found = sorted_keys[transposed] == transposed_keys
+            transposed_weights[found] = weights[order[transposed[found]]]
+
+        # As in a dense matrix, a NaN weight matches a missing edge
+        close = (np.isclose(weights, transposed_weights, equal_nan=True) &
+                 np.isclose(transposed_weights, weights, equal_nan=True))
+        # Report matched pairs from the lower index, and unmatched edges as
+        # they are found.
+        reported = ~close & (~found | (rows <= columns))
+        vocabulary = self._vocabulary
+        pairs = []
+        for i in np.flatnonzero(reported).tolist():
+            pairs.append((
+                vocabulary[rows[i]],
+                vocabulary[columns[i]],
+                weights[i].item(),
+                transposed_weights[i].item() if found[i] else None,
+            ))
+        return pairs
+
+    def to_dict(self):
+        """Returns the graph in the dict of dicts coinstall format."""
+        return {guid: self[guid] for guid in self}
+
+
+class CoinstallGraphBuilder:
+    """Builds a CoinstallGraph one row at a time.
+
+    Edges are accumulated in compact typed arrays, so rows can be added as
+    they are parsed without keeping the dict of dicts.  Rows may be added
+    in any order, and guids are indexed in the order they are first seen,
+    after those of an optional existing vocabulary and index.
+    """
+
+    def __init__(self, vocabulary=None, index=None):
+        if vocabulary is None:
+            vocabulary, index = [], {}
+        self._vocabulary = vocabulary
+        self._index = index
+        self._rows = set()
+        self._row_ids = array('i')
+        self._indices = array('i')
+        self._data = array('d')
+
+    def add_guid(self, guid):
+        """Returns the vocabulary index of guid, indexing it if it is new."""
+        i = self._index.get(guid)
+        if i is None:
+            guid = sys.intern(guid)
+            i = self._index[guid] = len(self._vocabulary)
+            self._vocabulary.append(guid)
+        return i
+
+    def add_row(self, guid, coinstalls):
+        """Adds the row of guid from a dict of coinstalled guid to weight."""
+        i = self.add_guid(guid)
+        if i in self._rows:
+            raise ValueError("Duplicate row for guid [{}]".format(guid))
+        self._rows.add(i)
+        add_guid = self.add_guid
+        self._indices.extend([add_guid(coinstall_guid) for coinstall_guid in coinstalls])
+        self._data.extend(coinstalls.values())
+        self._row_ids.extend([i] * len(coinstalls))
+
+    def edges(self):
+        """Returns the row ids, column indices and weights of the added edges."""
+        return (np.frombuffer(self._row_ids, dtype=np.intc).astype(np.int32),
+                np.frombuffer(self._indices, dtype=np.intc).astype(np.int32),
+                np.frombuffer(self._data, dtype=np.float64).copy())
+
+    def build(self):
+        size = len(self._vocabulary)
+        row_ids, indices, data = self.edges()
+        if np.any(row_ids[1:] < row_ids[:-1]):
+            # A stable sort keeps the edge order within each row
+            order = np.argsort(row_ids, kind='mergesort')
+            indices = indices[order]
+            data = data[order]
+
+        indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(row_ids, minlength=size), out=indptr[1:])
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(size, size))
+        row_mask = np.zeros(size, dtype=bool)
+        row_mask[list(self._rows)] = True
+        return CoinstallGraph(self._vocabulary, matrix, row_mask, self._index)
+
+
+class TopNTable(Mapping):
+    """Precomputed recommendations for the rows of a CoinstallGraph.
+
+    The vocabulary indices and weights of the top n recommendations of every
+    row are stored in two dense (len(vocabulary), n) arrays, instead of a
+    list of tuples per guid.  Looking up a guid returns the same sorted
+    result list a recommender would, built from the vocabulary on access.
+
+    An optional formatter(guid, weight) replaces the weights in the results.
+    """
+
+    def __init__(self, graph, indices, weights, lengths, formatter=None):
+        self._vocabulary = graph.vocabulary
+        self._index = graph.index
+        self._row_mask = graph.row_mask
+        self._row_count = len(graph)
+        self._indices = indices
+        self._weights = weights
+        self._lengths = lengths
+        self._formatter = formatter
+
+    @classmethod
+    def build(cls, graph, limit, rank_row, formatter=None):
+        """Builds the table with rank_row(indices, weights, limit), which must
+        return the ranked (indices, weights) arrays of a row of graph.
+        """
+        size = len(graph.vocabulary)
+        indices = np.zeros((size, limit), dtype=np.int32)
+        weights = np.zeros((size, limit), dtype=np.float64)
+        lengths = np.zeros(size, dtype=np.int32)
+        matrix = graph.matrix
+        for i in np.flatnonzero(graph.row_mask).tolist():
+            start, end = matrix.indptr[i], matrix.indptr[i + 1]
+            ranked_indices, ranked_weights = rank_row(matrix.indices[start:end], matrix.data[start:end], limit)
+            length = len(ranked_indices)
+            indices[i, :length] = ranked_indices
+            weights[i, :length] = ranked_weights
+            lengths[i] = length
+        return cls(graph, indices, weights, lengths, formatter)
+
+    @property
+    def limit(self):
+        """Returns the number of recommendations stored per guid."""
+        return self._indices.shape[1]
+
+    @property
+    def indices(self):
+        """Returns the (len(vocabulary), limit) array of recommended guid indices."""
+        return self._indices
+
+    @property
+    def weights(self):
+        """Returns the (len(vocabulary), limit) array of recommendation weights."""
+        return self._weights
+
+    @property
+    def lengths(self):
+        """Returns the number of recommendations of each guid."""
+        return self._lengths
+
+    def __getitem__(self, guid):
+        i = self._index.get(guid)
+        if i is None or not self._row_mask[i]:
+            raise KeyError(guid)
+        length = self._lengths[i]
+        vocabulary = self._vocabulary
+        results = [
+            (vocabulary[j], w)
+            for j, w in zip(self._indices[i, :length].tolist(), self._weights[i, :length].tolist())
+        ]
+        if self._formatter is not None:
+            results = [(guid, self._formatter(guid, weight)) for guid, weight in results]
+        return results
+
+    def __contains__(self, guid):
+        i = self._index.get(guid)
+        return i is not None and bool(self._row_mask[i])
+
+    def __iter__(self):
+        vocabulary = self._vocabulary
+        for i in np.flatnonzero(self._row_mask).tolist():
+            yield vocabulary[i]
+
+    def __len__(self):
+        return self._row_count
@@ -1,20 +1,51 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import copy
+import heapq
+
 import numpy as np
-import pandas as pd
 
-from .treatments import BaseTreatment
+from .graph import CoinstallGraph, TopNTable
+from .treatments import BaseTreatment, ColumnStats, apply_treatment
+
+# with_delta rebuilds every treated graph when more than this fraction of
+# the rows changed, as the incremental bookkeeping then costs more than it
+# saves.
+DELTA_REBUILD_FRACTION = 0.25
+
+
+class AsymmetricCoinstallError(AssertionError):
+    """Raised when a coinstall graph is not symmetric.
+
+    pairs holds every offending (guid_a, guid_b, weight_ab, weight_ba), with
+    None for a missing edge.  It subclasses AssertionError, which the check
+    used to raise.
+    """
+
+    MAX_REPORTED_PAIRS = 10
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        reported = ", ".join("{} -> {}: {} != {}".format(*pair) for pair in pairs[:self.MAX_REPORTED_PAIRS])
+        if len(pairs) > self.MAX_REPORTED_PAIRS:
+            reported += ", ..."
+        super().__init__("{} asymmetric coinstall pairs: {}".format(len(pairs), reported))
 
 
 class GuidGuidCoinstallRecommender:
     """ A recommender class that returns top N addons based on a
     passed addon identifier.
     Accepts:
-        - a dict containing coinstalled addons
+        - a dict containing coinstalled addons, or the equivalent CoinstallGraph
         - a dict of addon rankins
         - a list of treatments that transform the original coinstall dict, and will
           be applied in the order supplied
+        - an optional precompute_limit; when set, the top precompute_limit
+          recommendations for every addon are materialised when the treatment
+          graph is built so that recommend becomes a lookup
+        - an optional lex_scores flag; when set, recommendations carry the
+          legacy lex ranking string instead of the numeric weight
 
     Provides a recommend method to then return recommendations for a supplied addon.
     Can also return the complete recommendation graph.
@@ -27,7 +58,9 @@ class GuidGuidCoinstallRecommender:
             treatment_kwargs=None,
             tie_breaker_dict=None,
             apply_treatment_on_init=True,
-            validate_raw_coinstall_dict=True):
+            validate_raw_coinstall_dict=True,
+            precompute_limit=None,
+            lex_scores=False):
 
         for treatment in treatments:
             assert isinstance(treatment, BaseTreatment)
@@ -46,16 +79,29 @@ class GuidGuidCoinstallRecommender:
         self._treatment_kwargs = treatment_kwargs
         self._treatments = treatments
         self._treated_graph = dict()
+        self._precompute_limit = precompute_limit
+        self._top_n_table = None
+        self._lex_scores = lex_scores
+        self._tie_breaker_vector = None
+        # The input, output and column stats of each treatment, kept for
+        # with_delta when the treatments were applied to a dict here.
+        self._steps = None
 
         if apply_treatment_on_init:
             self.build_treatment_graph()
 
     @classmethod
     def validate_coinstall_dict(cls, coinstalls):
-        sorted_guids = sorted(list(coinstalls.keys()))
-        df = pd.DataFrame(coinstalls, index=sorted_guids, columns=sorted_guids)
-        as_matrix = df.values
-        assert np.allclose(as_matrix, as_matrix.T, equal_nan=True)
+        """Raises AsymmetricCoinstallError unless the coinstallations are symmetric.
+
+        Only edges between guids that have a row are checked.  The check
+        runs on a CoinstallGraph, converting a dict first, in O(edges) memory.
+        """
+        if not isinstance(coinstalls, CoinstallGraph):
+            coinstalls = CoinstallGraph.from_dict(coinstalls)
+        pairs = coinstalls.asymmetric_pairs()
+        if pairs:
+            raise AsymmetricCoinstallError(pairs)
 
     @property
     def raw_coinstall_graph(self):
@@ -70,6 +116,9 @@ class GuidGuidCoinstallRecommender:
             }
 
         It must be symmetric.
+
+        When the recommender was built from a CoinstallGraph, that graph is
+        returned instead.  It behaves as a read-only version of the dict.
         """
         return self._raw_coinstall_graph
 
@@ -92,9 +141,31 @@ class GuidGuidCoinstallRecommender:
 
         Recommendation graph is in the same format as the coinstall graph but the
         numerical values are the weightings as a result of the treatment.
+        It is a CoinstallGraph when the raw coinstall graph is one.
         """
         return self._treated_graph
 
+    @property
+    def precompute_limit(self):
+        """Returns the depth of the precomputed recommendation table, or None."""
+        return self._precompute_limit
+
+    @property
+    def top_n_table(self):
+        """Returns the precomputed recommendations.
+
+        A dict with the same keys as the treated graph, where each value is the
+        sorted result list for that guid truncated to precompute_limit items.
+        A TopNTable, which behaves as a read-only version of that dict, when the
+        treated graph is a CoinstallGraph.  None when precomputation is disabled.
+        """
+        return self._top_n_table
+
+    @property
+    def lex_scores(self):
+        """Returns True if recommendations carry the legacy lex ranking string."""
+        return self._lex_scores
+
     @property
     def treatments(self):
         """Return the list of treatments."""
@@ -106,61 +177,247 @@ class GuidGuidCoinstallRecommender:
 
     def get_recommendation_graph(self, limit):
         """The recommendation graph is the full output for all addons"""
-        rec_graph = {}
-        for guid in self.raw_coinstall_graph:
-            rec_graph[guid] = self.recommend(guid, limit)
-        return rec_graph
+        return self.recommend_many(self.raw_coinstall_graph, limit)
+
+    def recommend_many(self, for_guids, limit):
+        """Returns a dict of guid to the result of recommend for each supplied guid."""
+        recommend = self.recommend
+        return {guid: recommend(guid, limit) for guid in for_guids}
 
     def build_treatment_graph(self):
         """Does the work to compute and then set the recommendation graph.
         Sub classes may wish to override if more complex computation is required.
         """
         new_graph = self.raw_coinstall_graph
+        if isinstance(new_graph, CoinstallGraph):
+            for treatment in self.treatments:
+                new_graph = apply_treatment(treatment, new_graph, **self.treatment_kwargs)
+            self.set_treated_graph(new_graph)
+            return
+
+        steps = []
         for treatment in self.treatments:
-            new_graph = treatment.treat(new_graph, **self.treatment_kwargs)
-        self._treated_graph = new_graph
+            column_stats = ColumnStats(new_graph)
+            treatment_kwargs = dict(self.treatment_kwargs, column_stats=column_stats)
+            treated_graph = treatment.treat(new_graph, **treatment_kwargs)
+            steps.append(self._treatment_step(new_graph, treated_graph, column_stats))
+            new_graph = treated_graph
+        self.set_treated_graph(new_graph)
+        self._steps = steps
+
+    @staticmethod
+    def _treatment_step(input_graph, output_graph, column_stats):
+        # Stats that no treatment computed are not worth keeping
+        return input_graph, output_graph, column_stats if column_stats.is_computed() else None
+
+    def with_delta(self, delta, max_changed_fraction=DELTA_REBUILD_FRACTION):
+        """Returns a new recommender for the models with a CoinstallDelta applied.
+
+        The delta rankings are applied to the tie breakers and to the
+        'ranking_dict' treatment kwarg.  When the treatments were applied to
+        a dict by build_treatment_graph, only the rows and column aggregates
+        the delta affects are treated again, and only the changed rows are
+        ranked again unless a ranking changed.  Otherwise, or when more than
+        max_changed_fraction of the rows changed, the treated graph is
+        rebuilt from scratch.  Either way the result is the same as that of
+        a recommender built from the updated models.
+
+        The updated coinstallations are not validated.  This recommender and
+        its treatments are left unchanged.
+        """
+        raw_graph = delta.apply_to_graph(self.raw_coinstall_graph)
+        tie_breaker_dict = delta.apply_to_rankings(self.tie_breaker_dict)
+        treatment_kwargs = dict(self.treatment_kwargs)
+        previous_ranking_dict = treatment_kwargs.get('ranking_dict')
+        if previous_ranking_dict is self.tie_breaker_dict:
+            treatment_kwargs['ranking_dict'] = tie_breaker_dict
+        elif previous_ranking_dict is not None:
+            treatment_kwargs['ranking_dict'] = delta.apply_to_rankings(previous_ranking_dict)
+
+        recommender = self.__class__(
+            raw_graph,
+            [copy.copy(treatment) for treatment in self.treatments],
+            treatment_kwargs=treatment_kwargs,
+            tie_breaker_dict=tie_breaker_dict,
+            apply_treatment_on_init=False,
+            validate_raw_coinstall_dict=False,
+            precompute_limit=self.precompute_limit,
+            lex_scores=self.lex_scores
+        )
+        changed_rows = delta.row_guids
+        if (self._steps is None or isinstance(raw_graph, CoinstallGraph)
+                or len(changed_rows) > max_changed_fraction * len(self.raw_coinstall_graph)):
+            recommender.build_treatment_graph()
+            return recommender
+
+        delta_kwargs = dict(treatment_kwargs,
+                            previous_ranking_dict=previous_ranking_dict,
+                            changed_rankings=delta.ranking_guids)
+        new_graph = raw_graph
+        steps = []
+        for treatment, (previous_input, previous_output, previous_stats) in zip(recommender.treatments,
+                                                                                self._steps):
+            column_stats = ColumnStats(new_graph, previous_stats, changed_rows)
+            delta_kwargs['column_stats'] = column_stats
+            treated_graph, changed_rows = treatment.treat_delta(
+                previous_input, new_graph, previous_output, changed_rows, **delta_kwargs)
+            steps.append(self._treatment_step(new_graph, treated_graph, column_stats))
+            new_graph = treated_graph
+
+        recommender._treated_graph = new_graph
+        recommender._steps = steps
+        rankings_changed = bool(delta.ranking_guids)
+        if self._top_n_table is None or rankings_changed:
+            recommender._top_n_table = recommender._build_top_n_table()
+        else:
+            recommender._top_n_table = recommender._update_top_n_table(self._top_n_table, changed_rows)
+        return recommender
+
+    def set_treated_graph(self, treated_graph, top_n_table=None):
+        """Sets a recommendation graph that was computed elsewhere.
+
+        Used when the treatments were applied by a TreatmentPipeline shared
+        between several recommenders, or loaded from a model file.  A top-N
+        table built for the same graph and tie breakers may be supplied too;
+        a TopNTable then sets precompute_limit.
+        """
+        self._treated_graph = treated_graph
+        self._steps = None
+        if isinstance(treated_graph, CoinstallGraph):
+            self._tie_breaker_vector = treated_graph.vector(self.tie_breaker_dict)
+        if top_n_table is not None:
+            if isinstance(top_n_table, TopNTable):
+                self._precompute_limit = top_n_table.limit
+            self._top_n_table = top_n_table
+        else:
+            self._top_n_table = self._build_top_n_table()
+
+    def _build_top_n_table(self):
+        if self.precompute_limit is None:
+            return None
+        if isinstance(self.treated_graph, CoinstallGraph):
+            formatter = self._lex_score if self.lex_scores else None
+            return TopNTable.build(self.treated_graph, self.precompute_limit, self._rank_row, formatter)
+        top_n_table = {}
+        for guid in self.treated_graph:
+            top_n_table[guid] = self._rank(guid, self.precompute_limit)
+        return top_n_table
+
+    def _update_top_n_table(self, previous_top_n_table, changed_rows):
+        """Returns the top-N table of a dict treated graph that differs from
+        the one previous_top_n_table was built for in changed_rows only.
+        """
+        limit = self.precompute_limit
+        top_n_table = {}
+        for guid in self.treated_graph:
+            if guid in changed_rows:
+                top_n_table[guid] = self._rank(guid, limit)
+            else:
+                top_n_table[guid] = previous_top_n_table[guid]
+        return top_n_table
 
     def recommend(self, for_guid, limit):
         """Returns a list of sorted recommendations of length 0 - limit for supplied guid.
 
-        Result list is a list of tuples with the lex ranking string. e.g.
+        Result list is a list of tuples with the treated weight. e.g.
+            [
+                ('guid_a', 3.2),
+                ('guid_c', 1.2),
+                ('guid_b', 1.2),
+            ]
+
+        With lex_scores set, the weight is replaced by the lex ranking string. e.g.
             [
                 ('guid_a', '000003.000002.0001000'),
                 ('guid_c', '000001.000002.0001000'),
                 ('guid_b', '000001.000002.0000010'),
             ]
 
+        When a top-N table has been precomputed and limit does not exceed its
+        depth, the result is sliced from the table instead of being sorted.
         """
+        if self._top_n_table is not None and limit is not None and limit <= self.precompute_limit:
+            return self._top_n_table.get(for_guid, [])[:limit]
         if for_guid not in self.treated_graph:
             return []
-        raw_recommendations = self.treated_graph[for_guid]
-        result_list = self._build_sorted_result_list(raw_recommendations)
-        return result_list[:limit]
+        return self._rank(for_guid, limit)
+
+    def _rank(self, for_guid, limit):
+        if isinstance(self.treated_graph, CoinstallGraph):
+            indices, weights = self.treated_graph.row(for_guid)
+            return self._build_sorted_result_array(indices, weights, limit)
+        return self._build_sorted_result_list(self.treated_graph[for_guid], limit)
 
-    def _build_sorted_result_list(self, unranked_recommendations):
+    def _build_sorted_result_list(self, unranked_recommendations, limit=None):
         """Takes a dictionary with a format matching the values in the coinstall_dict
-        and return a sorted list of results
+        and return a sorted list of at most limit results
 
             In: {'guid_b': 10, 'guid_c': 13}
             Out:
                 [
-                    ('guid_c', '000013.000000.0001000'),
-                    ('guid_b', '000010.000000.0000010'),
+                    ('guid_c', 13),
+                    ('guid_b', 10),
                 ]
 
+        Results are ordered by weight, then by the tie breaker value, both
+        descending.  When a limit is supplied only the top limit items are
+        selected and ordered.
         """
-        # Augment the result_dict with the installation counts
-        # and then we can sort using lexical sorting of strings.
-        # The idea here is to get something in the form of
-        #    0000.0000.0000
-        # The computed weight takes the first and second segments of
-        # integers.  The third segment is the installation count of
-        # the addon but is zero padded.
-
-        result_dict = {}
-        for k, v in unranked_recommendations.items():
-            lex_value = "{0:020.10f}.{1:010d}".format(v, self.tie_breaker_dict.get(k, 0))
-            result_dict[k] = lex_value
-        # Sort the result dictionary in descending order by weight
-        result_list = sorted(result_dict.items(), key=lambda x: x[1], reverse=True)
+        tie_breaker_dict = self.tie_breaker_dict
+
+        def rank_key(item):
+            return (item[1], tie_breaker_dict.get(item[0], 0))
+
+        if limit is None:
+            result_list = sorted(unranked_recommendations.items(), key=rank_key, reverse=True)
+        else:
+            result_list = heapq.nlargest(limit, unranked_recommendations.items(), key=rank_key)
+
+        if self.lex_scores:
+            result_list = [(guid, self._lex_score(guid, weight)) for guid, weight in result_list]
+        return result_list
+
+    def _build_sorted_result_array(self, indices, weights, limit=None):
+        """The CoinstallGraph counterpart of _build_sorted_result_list.
+
+        Takes the vocabulary indices and weights of a treated row and returns
+        the same result list.
+        """
+        ranked_indices, ranked_weights = self._rank_row(indices, weights, limit)
+        vocabulary = self.treated_graph.vocabulary
+        result_list = [(vocabulary[i], w) for i, w in zip(ranked_indices.tolist(), ranked_weights.tolist())]
+        if self.lex_scores:
+            result_list = [(guid, self._lex_score(guid, weight)) for guid, weight in result_list]
         return result_list
+
+    def _rank_row(self, indices, weights, limit=None):
+        """Returns the indices and weights of the top limit items of a row, in
+        the order of _build_sorted_result_list.
+
+        numpy.partition discards every candidate below the limit-th largest
+        weight before the remaining ones are sorted.
+        """
+        if limit is not None and limit < len(weights):
+            if limit <= 0:
+                return indices[:0], weights[:0]
+            kth_weight = np.partition(weights, len(weights) - limit)[len(weights) - limit]
+            candidates = np.flatnonzero(weights >= kth_weight)
+        else:
+            candidates = np.arange(len(weights))
+
+        candidate_indices = indices[candidates]
+        candidate_weights = weights[candidates]
+        tie_breakers = self._tie_breaker_vector[candidate_indices]
+        # lexsort is stable, so candidates that fully tie keep their row order
+        # just as they do in the dict implementation.
+        order = np.lexsort((-tie_breakers, -candidate_weights))[:limit]
+        return candidate_indices[order], candidate_weights[order]
+
+    def _lex_score(self, guid, weight):
+        """Returns the legacy lex ranking string for a recommendation.
+
+        Something in the form of 0000.0000.0000 where the weight takes the
+        first and second segments and the third segment is the zero padded
+        tie breaker value of the addon.
+        """
+        return "{0:020.10f}.{1:010d}".format(weight, self.tie_breaker_dict.get(guid, 0))
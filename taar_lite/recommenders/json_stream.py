@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Incremental parsing of the coinstallation JSON.
+
+json.loads needs the whole document in memory and returns the whole object
+tree.  The coinstallation model is a single JSON object of rows, so it can
+instead be parsed one row at a time from chunks of text, keeping only the
+current row in memory.  Rows that are filtered out are skipped over without
+being decoded.
+"""
+import codecs
+import json
+import re
+
+from .graph import CoinstallGraphBuilder
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# A complete string, the opening quote of a string that is cut off by the
+# end of the buffer, or a bracket.
+_SKIP_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]]')
+_DECODER = json.JSONDecoder()
+
+
+class _Incomplete(Exception):
+    """The buffer ends before the current token does."""
+
+
+class _Reader:
+    """A text buffer over an iterable of text or UTF-8 encoded chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+
+    def fill(self, min_size=1):
+        """Appends at least min_size characters, or the rest of the chunks,
+        dropping the consumed text.  Returns False if no text was appended.
+        """
+        parts = []
+        size = 0
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._decoder.decode(chunk)
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= min_size:
+                break
+        if not size:
+            return False
+        self.text = self.text[self.pos:] + ''.join(parts)
+        self.pos = 0
+        return True
+
+    def parse(self, parser):
+        """Runs parser(text, pos) -> (value, end), reading more chunks while
+        the buffer ends before the value does.
+        """
+        while True:
+            try:
+                value, self.pos = parser(self.text, self.pos)
+                return value
+            except _Incomplete:
+                # Grow the buffer geometrically, so that a value spanning
+                # many chunks is not parsed again for every chunk.
+                if not self.fill(len(self.text) - self.pos):
+                    raise ValueError("Malformed or truncated JSON at [{}]".format(self.pos))
+
+    def skip_whitespace(self):
+        self.pos = _WHITESPACE.match(self.text, self.pos).end()
+        while self.pos == len(self.text) and self.fill():
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+
+    def expect(self, characters):
+        """Consumes and returns the next non whitespace character, which
+        must be one of characters.
+        """
+        self.skip_whitespace()
+        if self.pos == len(self.text):
+            raise ValueError("Unexpected end of JSON document")
+        character = self.text[self.pos]
+        if character not in characters:
+            raise ValueError("Expected one of [{}] at [{}], found [{}]".format(
+                characters, self.pos, character))
+        self.pos += 1
+        return character
+
+
+def _decode_value(text, pos):
+    try:
+        value, end = _DECODER.raw_decode(text, pos)
+    except json.JSONDecodeError:
+        raise _Incomplete()
+    if end == len(text):
+        # A number may continue in the next chunk
+        raise _Incomplete()
+    return value, end
+
+
+def _skip_value(text, pos):
+    if text[pos] not in '{[':
+        return _decode_value(text, pos)
+    depth = 0
+    for match in _SKIP_TOKEN.finditer(text, pos):
+        token = match.group()
+        if token in '{[':
+            depth += 1
+        elif token in '}]':
+            depth -= 1
+            if depth == 0:
+                return None, match.end()
+        elif token == '"':
+            break
+    raise _Incomplete()
+
+
+def iter_object_items(chunks, keep=None):
+    """Yields the (key, value) pairs of a JSON object parsed from chunks.
+
+    Accepts:
+        - an iterable of text or UTF-8 encoded byte chunks holding a single
+          JSON object
+        - an optional keep(key) predicate.  The values of other keys are
+          skipped without being decoded, and are not yielded.
+
+    Raises ValueError if the document is not a JSON object.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    reader.skip_whitespace()
+    if reader.pos < len(reader.text) and reader.text[reader.pos] == '}':
+        reader.pos += 1
+    else:
+        while True:
+            reader.skip_whitespace()
+            key = reader.parse(_decode_value)
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key, found [{}]".format(key))
+            reader.expect(':')
+            reader.skip_whitespace()
+            if keep is None or keep(key):
+                yield key, reader.parse(_decode_value)
+            else:
+                reader.parse(_skip_value)
+            if reader.expect(',}') == '}':
+                break
+
+    reader.skip_whitespace()
+    if reader.pos != len(reader.text):
+        raise ValueError("Extra data after the JSON object at [{}]".format(reader.pos))
+
+
+def graph_from_json_stream(chunks, keep_row=None):
+    """Builds a CoinstallGraph from chunks of the coinstallation JSON.
+
+    Rows are added to the graph as they are parsed.  With a keep_row(guid)
+    predicate, ie. MinInstallPrune.row_filter, the rows of other guids are
+    never decoded; those guids are still indexed if they are coinstalled
+    with a kept guid.
+    """
+    builder = CoinstallGraphBuilder()
+    for guid, coinstalls in iter_object_items(chunks, keep_row):
+        if not isinstance(coinstalls, dict):
+            raise ValueError("The row of [{}] is not an object".format(guid))
+        builder.add_row(guid, coinstalls)
+    return builder.build()
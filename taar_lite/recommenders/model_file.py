@@ -0,0 +1,356 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""A versioned binary file format for compiled coinstallation models.
+
+The file holds the guid vocabulary, the CSR arrays of the raw coinstallation
+graph, the install rankings of every guid and, optionally, the treated graphs and top-N
+tables of a set of recommenders.  ModelFile maps it read-only, so the edge
+arrays are never copied: every process mapping the same file shares a single
+page cache copy, and loading a model does not parse any JSON.
+
+Layout, all integers little endian:
+
+    magic       8 bytes, b'TAARLITE'
+    version     uint32, FORMAT_VERSION
+    header_size uint32
+    header      header_size bytes of UTF-8 JSON describing the sections
+    sections    the arrays, each starting on an 8 byte boundary, from the
+                first 8 byte boundary after the header
+
+The header records the offset, dtype and shape of each section, and which
+sections make up each graph.  Graphs that share arrays, such as treated
+graphs derived with CoinstallGraph.with_data, share sections.
+"""
+from collections import OrderedDict
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from .graph import CoinstallGraph, TopNTable
+
+MAGIC = b'TAARLITE'
+FORMAT_VERSION = 2
+
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 8
+
+
+class ModelFileError(ValueError):
+    """Raised when a model file is malformed or has an unsupported version."""
+
+
+def _padding(offset):
+    return -offset % _ALIGNMENT
+
+
+class _SectionWriter:
+    """Lays out arrays as sections, storing arrays that share memory once."""
+
+    def __init__(self):
+        self.sections = OrderedDict()
+        self._arrays = OrderedDict()
+        self._by_address = {}
+
+    def add(self, name, array):
+        array = np.ascontiguousarray(array)
+        key = (array.__array_interface__['data'][0], array.dtype.str, array.shape)
+        existing = self._by_address.get(key)
+        if existing is not None and array.size:
+            return existing
+        self._arrays[name] = array
+        self._by_address[key] = name
+        return name
+
+    def add_graph(self, prefix, graph):
+        matrix = graph.matrix
+        return {
+            'indptr': self.add(prefix + '.indptr', matrix.indptr),
+            'indices': self.add(prefix + '.indices', matrix.indices),
+            'data': self.add(prefix + '.data', matrix.data),
+            'row_mask': self.add(prefix + '.row_mask', graph.row_mask),
+        }
+
+    def layout(self):
+        """Returns the sections, with offsets relative to the first section."""
+        offset = 0
+        for name, array in self._arrays.items():
+            offset += _padding(offset)
+            self.sections[name] = {
+                'offset': offset,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+            }
+            offset += array.nbytes
+        return self.sections
+
+    def write(self, fileobj):
+        start = fileobj.tell()
+        for name, array in self._arrays.items():
+            fileobj.write(b'\0' * (start + self.sections[name]['offset'] - fileobj.tell()))
+            fileobj.write(array.tobytes())
+
+
+def _file_id(stat):
+    return '{}-{}-{}'.format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _check_ranking(guid, value):
+    if int(value) != value:
+        raise ModelFileError("Ranking of [{}] is not an integer: [{}]".format(guid, value))
+
+
+def _rankings_arrays(graph, rankings):
+    """Returns the rankings of the vocabulary, with a mask of the guids that
+    have one, and the guids and rankings of the other ranked guids.
+    """
+    index = graph.index
+    values = np.zeros(len(graph.vocabulary), dtype=np.int64)
+    present = np.zeros(len(graph.vocabulary), dtype=bool)
+    extra_guids = []
+    extra_values = []
+    for guid, value in rankings.items():
+        _check_ranking(guid, value)
+        i = index.get(guid)
+        if i is None:
+            extra_guids.append(guid)
+            extra_values.append(value)
+        else:
+            values[i] = value
+            present[i] = True
+    return values, present, extra_guids, np.array(extra_values, dtype=np.int64)
+
+
+def _encode_guids(guids):
+    if any('\n' in guid for guid in guids):
+        raise ModelFileError("Guids can not contain newlines")
+    return np.frombuffer('\n'.join(guids).encode('utf-8'), dtype=np.uint8)
+
+
+def write_model_file(path, graph, rankings, recommenders=None, parameters=None):
+    """Compiles a model into a binary model file at path.
+
+    Accepts:
+        - the raw coinstallation graph, a CoinstallGraph
+        - the dict of guid install rankings, which must be integers.  The
+          rankings of guids outside the graph are stored too, as treatments
+          such as MinInstallPrune derive their thresholds from all of them.
+        - optionally, an ordered dict of name to recommender built from the
+          graph.  Their treated graphs, and their top-N tables when they
+          have one, are stored so that loading them applies no treatment.
+        - optionally, a JSON serializable dict of the parameters the
+          recommenders were built with, which readers compare to their own
+          before using the stored recommenders.
+
+    The file is written next to path and renamed into place, so processes
+    that mapped a previous version keep reading a consistent copy.
+    """
+    vocabulary = graph.vocabulary
+    writer = _SectionWriter()
+    writer.add('vocabulary', _encode_guids(vocabulary))
+    rankings_values, rankings_present, extra_guids, extra_values = _rankings_arrays(graph, rankings)
+    header = OrderedDict([
+        ('size', len(vocabulary)),
+        ('vocabulary', 'vocabulary'),
+        ('rankings', writer.add('rankings', rankings_values)),
+        ('rankings_present', writer.add('rankings_present', rankings_present)),
+        ('extra_rankings', {
+            'guids': writer.add('extra_rankings.guids', _encode_guids(extra_guids)),
+            'rankings': writer.add('extra_rankings.rankings', extra_values),
+        }),
+        ('graph', writer.add_graph('graph', graph)),
+        ('parameters', parameters),
+        ('recommenders', OrderedDict()),
+    ])
+
+    for name, recommender in (recommenders or {}).items():
+        treated_graph = recommender.treated_graph
+        if not isinstance(treated_graph, CoinstallGraph) or treated_graph.vocabulary is not vocabulary:
+            raise ModelFileError("Recommender [{}] was not built from the model graph".format(name))
+        entry = OrderedDict([('graph', writer.add_graph('{}.graph'.format(name), treated_graph))])
+        top_n_table = recommender.top_n_table
+        if isinstance(top_n_table, TopNTable):
+            entry['top_n'] = {
+                'indices': writer.add('{}.top_n.indices'.format(name), top_n_table.indices),
+                'weights': writer.add('{}.top_n.weights'.format(name), top_n_table.weights),
+                'lengths': writer.add('{}.top_n.lengths'.format(name), top_n_table.lengths),
+            }
+        header['recommenders'][name] = entry
+
+    _write(path, header, writer)
+
+
+def write_array_file(path, arrays, guids=None):
+    """Writes arrays to path in the model file layout, for ArrayFile to map.
+
+    Accepts an ordered dict of name to array, and optionally a dict of name
+    to list of guids.  Arrays that share memory are stored once.
+    """
+    writer = _SectionWriter()
+    header = OrderedDict([
+        ('arrays', OrderedDict((name, writer.add(name, array)) for name, array in arrays.items())),
+        ('guids', OrderedDict(
+            (name, writer.add('guids.' + name, _encode_guids(values))) for name, values in (guids or {}).items()
+        )),
+    ])
+    _write(path, header, writer)
+
+
+def _write(path, header, writer):
+    header['sections'] = writer.layout()
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fileobj:
+        fileobj.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        fileobj.write(header_bytes)
+        fileobj.write(b'\0' * _padding(fileobj.tell()))
+        writer.write(fileobj)
+    os.replace(tmp_path, path)
+
+
+class _MappedFile:
+    """Maps a file in the model file layout read-only and parses its header."""
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as fileobj:
+            self._file_id = _file_id(os.fstat(fileobj.fileno()))
+            self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _PREAMBLE.size:
+            raise ModelFileError("Model file is truncated: {}".format(path))
+        magic, version, header_size = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ModelFileError("Not a taar-lite model file: {}".format(path))
+        if version != FORMAT_VERSION:
+            raise ModelFileError("Unsupported model file version [{}]: {}".format(version, path))
+        header_end = _PREAMBLE.size + header_size
+        self._header = json.loads(self._mmap[_PREAMBLE.size:header_end].decode('utf-8'),
+                                  object_pairs_hook=OrderedDict)
+        self._sections_start = header_end + _padding(header_end)
+
+    def _section(self, name):
+        section = self._header['sections'][name]
+        dtype = np.dtype(section['dtype'])
+        shape = tuple(section['shape'])
+        count = int(np.prod(shape))
+        offset = self._sections_start + section['offset']
+        if offset + count * dtype.itemsize > len(self._mmap):
+            raise ModelFileError("Model file is truncated: {}".format(self._path))
+        array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+        return array.reshape(shape)
+
+    def _guids(self, name):
+        guids_bytes = self._section(name).tobytes()
+        if not guids_bytes:
+            return []
+        return [sys.intern(guid) for guid in guids_bytes.decode('utf-8').split('\n')]
+
+
+class ArrayFile(_MappedFile):
+    """A file written by write_array_file, mapped read-only.
+
+    The arrays are read-only views into the mapping, so every process
+    mapping the file shares one page cache copy of them.
+    """
+
+    def __getitem__(self, name):
+        return self._section(self._header['arrays'][name])
+
+    def guids(self, name):
+        """Returns the list of guids stored as name."""
+        return self._guids(self._header['guids'][name])
+
+
+class ModelFile(_MappedFile):
+    """A compiled model file, mapped read-only.
+
+    The CSR arrays of the graphs and the top-N tables are views into the
+    mapping.  The vocabulary, its index and the rankings dict are rebuilt
+    in memory, as the recommenders return guid strings and rank by dict.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        vocabulary = self._guids(self._header['vocabulary'])
+        self._graph = self._load_graph(vocabulary, self._header['graph'])
+
+        rankings = self._section(self._header['rankings']).tolist()
+        present = self._section(self._header['rankings_present'])
+        self._rankings = {vocabulary[i]: rankings[i] for i in np.flatnonzero(present).tolist()}
+        extra_rankings = self._header['extra_rankings']
+        self._rankings.update(zip(self._guids(extra_rankings['guids']),
+                                  self._section(extra_rankings['rankings']).tolist()))
+
+        self._treated_graphs = OrderedDict()
+        for name, entry in self._header['recommenders'].items():
+            self._treated_graphs[name] = self._load_graph(vocabulary, entry['graph'], self._graph)
+
+    def _load_graph(self, vocabulary, sections, base=None):
+        size = self._header['size']
+        matrix = sparse.csr_matrix(
+            (self._section(sections['data']),
+             self._section(sections['indices']),
+             self._section(sections['indptr'])),
+            shape=(size, size),
+            copy=False
+        )
+        row_mask = self._section(sections['row_mask'])
+        if base is None:
+            return CoinstallGraph(vocabulary, matrix, row_mask)
+        return base.with_matrix(matrix, row_mask)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def file_id(self):
+        """Returns a string that changes when the file at path is replaced."""
+        return self._file_id
+
+    @staticmethod
+    def file_id_of(path):
+        """Returns the file_id a ModelFile of path would have now."""
+        return _file_id(os.stat(path))
+
+    @property
+    def graph(self):
+        """Returns the raw coinstallation graph."""
+        return self._graph
+
+    @property
+    def rankings(self):
+        """Returns the dict of guid install rankings."""
+        return self._rankings
+
+    @property
+    def parameters(self):
+        """Returns the parameters the stored recommenders were built with,
+        or None when they were not recorded.
+        """
+        return self._header.get('parameters')
+
+    @property
+    def treated_graphs(self):
+        """Returns an ordered dict of recommender name to treated graph."""
+        return self._treated_graphs
+
+    def top_n_table(self, name, formatter=None):
+        """Returns the stored top-N table of a recommender, or None."""
+        sections = self._header['recommenders'][name].get('top_n')
+        if sections is None:
+            return None
+        return TopNTable(
+            self._treated_graphs[name],
+            self._section(sections['indices']),
+            self._section(sections['weights']),
+            self._section(sections['lengths']),
+            formatter
+        )
@@ -0,0 +1,375 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from collections import OrderedDict, namedtuple
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from scipy import sparse
+
+from .graph import CoinstallGraph, TopNTable
+from .guidguid import GuidGuidCoinstallRecommender
+from .model_file import ArrayFile, write_array_file
+from .treatments import ColumnStats, apply_treatment
+
+# The prefix output of the pipeline, in the process of a branch worker
+_WORKER_STATE = None
+
+# Stands for a logger in the kwargs handed to a branch worker, as loggers
+# can not be pickled before Python 3.7.  The worker gets the logger of the
+# same name.
+_LoggerName = namedtuple('_LoggerName', ['name'])
+
+# The prefix output handed to a branch worker as an array file at path and
+# the treatment kwargs other than the column stats.
+_SharedPrefixOutput = namedtuple('_SharedPrefixOutput', ['path', 'kwargs'])
+
+_COLUMN_STATS = ('sums', 'counts', 'row_norms', 'row_normalized')
+
+
+class TreatmentPipeline:
+    """Builds several recommenders that share a prefix of treatments.
+
+    Accepts:
+        - a list of prefix treatments, applied once in the order supplied
+        - an ordered dict of branch name to treatment, each applied to the
+          output of the prefix
+        - treatment kwargs passed to every treatment
+
+    The column aggregates used by the normalization treatments are computed
+    once on the output of the prefix and handed to every branch.
+
+    With processes above 1, build_recommenders builds the branch
+    recommenders in a pool of that many processes, one branch per task.
+    The workers are handed the prefix output when they start and only send
+    the treated weights and top-N tables back.  They are forked, inheriting
+    the prefix output without pickling it, when the calling process runs a
+    single thread.  Forking a process running other threads could copy the
+    locks they hold, ie. of the logging module, so they are started by a
+    forkserver otherwise.  The arrays of a CoinstallGraph prefix output,
+    with its column aggregates, are then written to a temporary array file
+    that every worker maps, so they are neither pickled nor copied; the
+    rest of the treatment kwargs is pickled, with loggers passed by name.
+
+    The duration of each stage of the last run, in seconds, is available
+    from timings.  Stages are named 'prefix.<treatment class>',
+    'column_stats', 'branch.<name>' and 'recommender.<name>', plus
+    'branches' for the wall time of the pool.
+    """
+
+    def __init__(self, prefix, branches, treatment_kwargs=None, processes=0):
+        if not treatment_kwargs:
+            treatment_kwargs = dict()
+
+        self._prefix = prefix
+        self._branches = branches
+        self._treatment_kwargs = treatment_kwargs
+        self._processes = processes
+        self._timings = OrderedDict()
+        self._prefix_output = None
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def branches(self):
+        return self._branches
+
+    @property
+    def treatment_kwargs(self):
+        return self._treatment_kwargs
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @property
+    def parameters(self):
+        """Returns a JSON serializable description of the treatments, which
+        tells whether treated graphs were computed by an equivalent pipeline.
+        """
+        def describe(treatment):
+            return OrderedDict([('treatment', type(treatment).__name__), ('parameters', treatment.parameters())])
+
+        return OrderedDict([
+            ('prefix', [describe(treatment) for treatment in self.prefix]),
+            ('branches', OrderedDict((name, describe(treatment)) for name, treatment in self.branches.items())),
+        ])
+
+    @property
+    def timings(self):
+        return self._timings
+
+    def _timed(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self._timings[stage] = time.perf_counter() - start
+        return result
+
+    def _run_prefix(self, raw_graph):
+        self._timings = OrderedDict()
+
+        graph = raw_graph
+        for treatment in self.prefix:
+            stage = 'prefix.{}'.format(type(treatment).__name__)
+            graph = self._timed(stage, apply_treatment, treatment, graph, **self.treatment_kwargs)
+
+        column_stats = self._timed('column_stats', ColumnStats(graph).compute)
+        branch_kwargs = dict(self.treatment_kwargs, column_stats=column_stats)
+        self._prefix_output = (raw_graph, graph, branch_kwargs)
+        return graph, branch_kwargs
+
+    def _branch_names(self, names):
+        if names is None:
+            return list(self.branches)
+        return [name for name in self.branches if name in names]
+
+    def run(self, raw_graph, names=None):
+        """Returns an ordered dict of branch name to treated graph, for the
+        branches in names or for all of them.
+        """
+        graph, branch_kwargs = self._run_prefix(raw_graph)
+
+        treated_graphs = OrderedDict()
+        for name in self._branch_names(names):
+            stage = 'branch.{}'.format(name)
+            treated_graphs[name] = self._timed(stage, apply_treatment, self.branches[name], graph, **branch_kwargs)
+        return treated_graphs
+
+    def build_recommenders(self, raw_graph, treated_graphs=None, top_n_tables=None, names=None,
+                           **recommender_kwargs):
+        """Runs the pipeline and returns an ordered dict of branch name to recommender.
+
+        Each recommender lists the prefix and its branch treatment as its
+        treatments, and is constructed with the supplied keyword arguments.
+        Only the branches in names are built when it is supplied; the others
+        can be built later with build_recommender.
+
+        Treated graphs, and optionally top-N tables, that were computed
+        ahead of time by the same pipeline, ie. loaded from a model file,
+        can be supplied by branch name; the pipeline then is not run.
+        """
+        names = self._branch_names(names)
+        if treated_graphs is None and self.processes > 1 and len(names) > 1:
+            return self._build_recommenders_forked(raw_graph, names, recommender_kwargs)
+        if treated_graphs is None:
+            treated_graphs = self.run(raw_graph, names)
+        else:
+            self._timings = OrderedDict()
+        if top_n_tables is None:
+            top_n_tables = {}
+
+        recommenders = OrderedDict()
+        for name in names:
+            recommender = self._recommender(name, raw_graph, recommender_kwargs)
+            stage = 'recommender.{}'.format(name)
+            self._timed(stage, recommender.set_treated_graph, treated_graphs[name], top_n_tables.get(name))
+            recommenders[name] = recommender
+        return recommenders
+
+    def build_recommender(self, name, **recommender_kwargs):
+        """Builds the recommender of one branch from the prefix output of
+        the last run, ie. one that build_recommenders left out.
+        """
+        if self._prefix_output is None:
+            raise ValueError("The pipeline has not been run")
+        raw_graph, graph, branch_kwargs = self._prefix_output
+        stage = 'branch.{}'.format(name)
+        treated_graph = self._timed(stage, apply_treatment, self.branches[name], graph, **branch_kwargs)
+        recommender = self._recommender(name, raw_graph, recommender_kwargs)
+        self._timed('recommender.{}'.format(name), recommender.set_treated_graph, treated_graph)
+        return recommender
+
+    def _recommender(self, name, raw_graph, recommender_kwargs):
+        return GuidGuidCoinstallRecommender(
+            raw_coinstall_dict=raw_graph,
+            treatments=list(self.prefix) + [self.branches[name]],
+            treatment_kwargs=self.treatment_kwargs,
+            apply_treatment_on_init=False,
+            **recommender_kwargs
+        )
+
+    def _build_recommenders_forked(self, raw_graph, names, recommender_kwargs):
+        graph, branch_kwargs = self._run_prefix(raw_graph)
+        start = time.perf_counter()
+        context = _pool_context()
+        with tempfile.TemporaryDirectory(prefix='taarlite-') as directory:
+            prefix_output = (raw_graph, graph, _picklable_kwargs(branch_kwargs))
+            if context.get_start_method() != 'fork' and _can_share(raw_graph, graph):
+                prefix_output = _share_prefix_output(os.path.join(directory, 'prefix'), *prefix_output)
+            state = (self.prefix, self.branches, _picklable_kwargs(self.treatment_kwargs), prefix_output,
+                     _picklable_kwargs(recommender_kwargs))
+            with context.Pool(min(self.processes, len(names)), initializer=_init_worker,
+                              initargs=(state,)) as pool:
+                results = pool.map(_build_branch, names, chunksize=1)
+
+        recommenders = OrderedDict()
+        for name, (treated, top_n, timings) in zip(names, results):
+            self._timings.update(timings)
+            recommender = self._recommender(name, raw_graph, recommender_kwargs)
+            treated_graph = _import_graph(graph, treated)
+            top_n_table = None
+            if isinstance(treated_graph, CoinstallGraph) and top_n is not None:
+                formatter = recommender._lex_score if recommender.lex_scores else None
+                top_n_table = TopNTable(treated_graph, *top_n, formatter=formatter)
+            elif top_n is not None:
+                top_n_table = top_n
+            recommender.set_treated_graph(treated_graph, top_n_table)
+            recommenders[name] = recommender
+        self._timings['branches'] = time.perf_counter() - start
+        return recommenders
+
+
+def _same_array(array, other):
+    """Returns True if other views the same memory as array, ie. once
+    scipy has wrapped it in a new array object.
+    """
+    return (array.__array_interface__['data'][0] == other.__array_interface__['data'][0]
+            and array.dtype == other.dtype and array.shape == other.shape)
+
+
+def _export_graph(graph, treated_graph):
+    """Returns what a worker sends back for a treated graph: the dict, or
+    the CSR arrays of a CoinstallGraph, with None for the arrays it shares
+    with the graph it was treated from, or None for that graph itself.
+    """
+    if treated_graph is graph:
+        return None
+    if not isinstance(treated_graph, CoinstallGraph):
+        return treated_graph
+    matrix, treated_matrix = graph.matrix, treated_graph.matrix
+    return tuple(
+        None if _same_array(array, treated_array) else treated_array
+        for array, treated_array in [
+            (matrix.data, treated_matrix.data),
+            (matrix.indices, treated_matrix.indices),
+            (matrix.indptr, treated_matrix.indptr),
+            (graph.row_mask, treated_graph.row_mask),
+        ]
+    )
+
+
+def _import_graph(graph, exported):
+    if exported is None:
+        return graph
+    if not isinstance(graph, CoinstallGraph):
+        return exported
+    data, indices, indptr, row_mask = [
+        array if array is not None else default
+        for array, default in zip(exported, (graph.matrix.data, graph.matrix.indices,
+                                             graph.matrix.indptr, graph.row_mask))
+    ]
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=graph.matrix.shape, copy=False)
+    return graph.with_matrix(matrix, row_mask)
+
+
+def _pool_context():
+    """Returns the multiprocessing context of the branch workers: fork when
+    the calling process runs a single thread, and forkserver, or spawn
+    where it is not available, otherwise.
+    """
+    if threading.active_count() == 1:
+        return multiprocessing.get_context('fork')
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _picklable_kwargs(kwargs):
+    return {
+        key: _LoggerName(value.name) if isinstance(value, logging.Logger) else value
+        for key, value in kwargs.items()
+    }
+
+
+def _worker_kwargs(kwargs):
+    return {
+        key: logging.getLogger(value.name) if isinstance(value, _LoggerName) else value
+        for key, value in kwargs.items()
+    }
+
+
+def _can_share(raw_graph, graph):
+    return (isinstance(raw_graph, CoinstallGraph) and isinstance(graph, CoinstallGraph)
+            and graph.vocabulary is raw_graph.vocabulary)
+
+
+def _graph_arrays(prefix, graph):
+    matrix = graph.matrix
+    return [
+        (prefix + '.data', matrix.data),
+        (prefix + '.indices', matrix.indices),
+        (prefix + '.indptr', matrix.indptr),
+        (prefix + '.row_mask', graph.row_mask),
+    ]
+
+
+def _mapped_matrix(arrays, prefix, size):
+    matrix = sparse.csr_matrix(
+        (arrays[prefix + '.data'], arrays[prefix + '.indices'], arrays[prefix + '.indptr']),
+        shape=(size, size),
+        copy=False
+    )
+    return matrix, arrays[prefix + '.row_mask']
+
+
+def _share_prefix_output(path, raw_graph, graph, branch_kwargs):
+    """Writes the arrays of the prefix output to an array file at path, and
+    returns what a branch worker needs to map them.
+    """
+    column_stats = branch_kwargs['column_stats']
+    arrays = OrderedDict(_graph_arrays('raw', raw_graph) + _graph_arrays('graph', graph))
+    for name in _COLUMN_STATS:
+        arrays['column_stats.' + name] = getattr(column_stats, name)
+    write_array_file(path, arrays, {'vocabulary': raw_graph.vocabulary})
+    kwargs = {key: value for key, value in branch_kwargs.items() if key != 'column_stats'}
+    return _SharedPrefixOutput(path, kwargs)
+
+
+def _map_prefix_output(shared):
+    arrays = ArrayFile(shared.path)
+    vocabulary = arrays.guids('vocabulary')
+    raw_graph = CoinstallGraph(vocabulary, *_mapped_matrix(arrays, 'raw', len(vocabulary)))
+    graph = raw_graph.with_matrix(*_mapped_matrix(arrays, 'graph', len(vocabulary)))
+    column_stats = ColumnStats.computed(graph, *[arrays['column_stats.' + name] for name in _COLUMN_STATS])
+    return raw_graph, graph, dict(shared.kwargs, column_stats=column_stats)
+
+
+def _init_worker(state):
+    """Sets the state of a branch worker: a pipeline of the branches, the
+    prefix output, mapped from its array file when it was shared, and the
+    recommender kwargs.
+    """
+    global _WORKER_STATE
+    prefix, branches, treatment_kwargs, prefix_output, recommender_kwargs = state
+    pipeline = TreatmentPipeline(prefix, branches, _worker_kwargs(treatment_kwargs))
+    if isinstance(prefix_output, _SharedPrefixOutput):
+        prefix_output = _map_prefix_output(prefix_output)
+    raw_graph, graph, branch_kwargs = prefix_output
+    _WORKER_STATE = (pipeline, raw_graph, graph, _worker_kwargs(branch_kwargs), _worker_kwargs(recommender_kwargs))
+
+
+def _build_branch(name):
+    """Treats the prefix output with a branch and builds its top-N table, in
+    a branch worker.
+    """
+    pipeline, raw_graph, graph, branch_kwargs, recommender_kwargs = _WORKER_STATE
+    timings = OrderedDict()
+
+    start = time.perf_counter()
+    treated_graph = apply_treatment(pipeline.branches[name], graph, **branch_kwargs)
+    timings['branch.{}'.format(name)] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    recommender = pipeline._recommender(name, raw_graph, recommender_kwargs)
+    recommender.set_treated_graph(treated_graph)
+    top_n_table = recommender.top_n_table
+    if isinstance(top_n_table, TopNTable):
+        top_n_table = (top_n_table.indices, top_n_table.weights, top_n_table.lengths)
+    timings['recommender.{}'.format(name)] = time.perf_counter() - start
+    return _export_graph(graph, treated_graph), top_n_table, timings
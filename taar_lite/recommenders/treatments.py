@@ -4,9 +4,21 @@ GuidGuidCoinstallRecommender.
 Note (Bird Sep '18): In future may want to think about how to structure this
 so the coupling is clear. I think the structure roughly makes sense, but the
 implementation could be tidier / less error prone.
+
+Each treatment has a dict implementation (treat) and a vectorised
+implementation over a CoinstallGraph (treat_graph).
 """
 import numpy as np
 
+from .graph import CoinstallGraph
+
+
+def apply_treatment(treatment, graph, **kwargs):
+    """Applies treatment with the implementation matching the graph format."""
+    if isinstance(graph, CoinstallGraph):
+        return treatment.treat_graph(graph, **kwargs)
+    return treatment.treat(graph, **kwargs)
+
 
 class BaseTreatment:
 
@@ -26,12 +38,46 @@ class BaseTreatment:
         """
         raise NotImplementedError
 
+    def treat_graph(self, graph, **kwargs):
+        """Accept a CoinstallGraph, and returns a treated CoinstallGraph.
+
+        This is the vectorised counterpart of treat, and must produce the same
+        weights as treat does for the equivalent dict.
+        """
+        raise NotImplementedError
+
+    def treat_delta(self, previous_input, input_dict, previous_output, changed_rows, **kwargs):
+        """Treats input_dict given the output of this treatment for previous_input.
+
+        input_dict is previous_input with the rows in changed_rows added,
+        replaced or removed.  Returns the treated graph, which must be the
+        same as treat(input_dict) returns, and the set of rows of the
+        treated graph that may differ from previous_output.
+
+        This implementation treats input_dict from scratch.  Treatments that
+        can limit the work to the changed rows override it.
+        """
+        output_dict = self.treat(input_dict, **kwargs)
+        return output_dict, set(output_dict).union(previous_output)
+
+    def parameters(self):
+        """Returns a JSON serializable dict of the settings the treated
+        graphs depend on, besides the treatment kwargs.
+        """
+        return {}
+
 
 class NoTreatment(BaseTreatment):
     """Returns the original coinstallation dict"""
     def treat(self, input_dict, *args, **kwargs):
         return input_dict
 
+    def treat_graph(self, graph, *args, **kwargs):
+        return graph
+
+    def treat_delta(self, previous_input, input_dict, previous_output, changed_rows, **kwargs):
+        return input_dict, set(changed_rows)
+
 
 class MinInstallPrune(BaseTreatment):
     """Takes a coinstall dictionary with a format matching the
@@ -45,11 +91,57 @@ class MinInstallPrune(BaseTreatment):
         Out: {'guid_b': 10, 'guid_c': 13}
     """
     min_installs = 0
+    _ranking_total = None
+    _ranking_count = None
 
     def _set_min_install_threshold(self, ranking_dict):
         # Compute the floor install incidence that recommended addons
         # must satisfy.  Take 5% of the mean of all installed addons.
-        self.min_installs = np.mean(list(ranking_dict.values())) * 0.05
+        rankings = list(ranking_dict.values())
+        self.min_installs = np.mean(rankings) * 0.05
+
+        # Integer rankings are summed exactly, so that the threshold can be
+        # updated for a delta and still equal np.mean.
+        self._ranking_total = None
+        self._ranking_count = len(rankings)
+        if all(isinstance(rank, int) for rank in rankings):
+            self._ranking_total = sum(rankings)
+
+    def _update_min_install_threshold(self, ranking_dict, previous_ranking_dict, changed_rankings):
+        """Updates the threshold for the rankings in changed_rankings that
+        changed between previous_ranking_dict and ranking_dict.
+        """
+        total, count = self._ranking_total, self._ranking_count
+        if total is None or previous_ranking_dict is None:
+            self._set_min_install_threshold(ranking_dict)
+            return
+        for guid in changed_rankings:
+            if guid in previous_ranking_dict:
+                total -= previous_ranking_dict[guid]
+                count -= 1
+            if guid in ranking_dict:
+                rank = ranking_dict[guid]
+                if not isinstance(rank, int):
+                    self._set_min_install_threshold(ranking_dict)
+                    return
+                total += rank
+                count += 1
+        if not count or abs(total) >= 2 ** 53:
+            # np.mean sums in float64, which is exact below 2 ** 53
+            self._set_min_install_threshold(ranking_dict)
+            return
+        self._ranking_total, self._ranking_count = total, count
+        self.min_installs = np.float64(total) / count * 0.05
+
+    def row_filter(self, ranking_dict):
+        """Returns a predicate telling if the row of a guid is kept.
+
+        Used to prune rows while the coinstallations are parsed, before any
+        treatment runs.
+        """
+        self._set_min_install_threshold(ranking_dict)
+        min_installs = self.min_installs
+        return lambda guid: ranking_dict.get(guid, 0) >= min_installs
 
     def treat(self, input_dict, **kwargs):
         ranking_dict = kwargs['ranking_dict']
@@ -60,31 +152,300 @@ class MinInstallPrune(BaseTreatment):
                 cleaned_dict[k] = v
         return cleaned_dict
 
+    def treat_graph(self, graph, **kwargs):
+        ranking_dict = kwargs['ranking_dict']
+        self._set_min_install_threshold(ranking_dict)
+        return graph.select_rows(graph.vector(ranking_dict) >= self.min_installs)
+
+    def treat_delta(self, previous_input, input_dict, previous_output, changed_rows, **kwargs):
+        """Updates the threshold with the rankings listed in the
+        changed_rankings kwarg, compared to the previous_ranking_dict kwarg,
+        and prunes the rows again.
 
-class RowSum(BaseTreatment):
-    """This normalization normalizes the weights for the suggested
-    coinstallation GUIDs based on the sum of the weights for the
-    coinstallation GUIDs.
+        Pruning only copies row references, so it is not limited to the
+        changed rows; rows whose pruning flips with the threshold are
+        reported as changed.
+        """
+        ranking_dict = kwargs['ranking_dict']
+        self._update_min_install_threshold(ranking_dict,
+                                           kwargs.get('previous_ranking_dict'),
+                                           kwargs.get('changed_rankings', ()))
+        min_installs = self.min_installs
+        output_dict = {k: v for k, v in input_dict.items() if ranking_dict.get(k, 0) >= min_installs}
+        changed = {guid for guid in changed_rows if guid in output_dict or guid in previous_output}
+        changed.update(output_dict.keys() ^ previous_output.keys())
+        return output_dict, changed
+
+
+class ColumnStats:
+    """The column aggregates the normalization treatments divide by.
+
+    All aggregates are computed together in a single pass over the graph, so
+    that RowSum, RowCount and RowNormSum applied to the same graph can share
+    one instance through the column_stats treatment kwarg.
+
+    For a dict graph the aggregates are guid keyed dicts.  For a
+    CoinstallGraph they are arrays aligned with the vocabulary, and
+    row_normalized additionally holds the row normalized weight of every edge.
+
+    For a dict graph that is the graph of computed previous stats with the
+    rows in changed_rows added, replaced or removed, only the aggregates of
+    the columns of those rows are recomputed.  They are listed in
+    changed_columns, which is None after a full pass.
+    """
+
+    def __init__(self, graph, previous=None, changed_rows=None):
+        if previous is not None and not previous.is_computed():
+            previous = None
+        self._graph = graph
+        self._previous = previous
+        self._changed_rows = changed_rows
+        self._sums = None
+        self._counts = None
+        self._row_norms = None
+        self._row_normalized = None
+        self._column_rows = None
+        self._changed_columns = None
+
+    @classmethod
+    def computed(cls, graph, sums, counts, row_norms, row_normalized):
+        """Returns the stats of a CoinstallGraph from aggregates computed
+        for it elsewhere, ie. in another process.
+        """
+        column_stats = cls(graph)
+        column_stats._sums, column_stats._counts, column_stats._row_norms = sums, counts, row_norms
+        column_stats._row_normalized = row_normalized
+        return column_stats
+
+    @classmethod
+    def for_graph(cls, graph, **kwargs):
+        """Returns the column_stats kwarg if it was computed for graph, or new stats."""
+        column_stats = kwargs.get('column_stats')
+        if column_stats is None or column_stats.graph is not graph:
+            column_stats = cls(graph)
+        return column_stats
+
+    @property
+    def graph(self):
+        return self._graph
+
+    @property
+    def sums(self):
+        """The sum of the coinstall weights in each column."""
+        self.compute()
+        return self._sums
+
+    @property
+    def counts(self):
+        """The number of rows each guid is coinstalled in."""
+        self.compute()
+        return self._counts
+
+    @property
+    def row_norms(self):
+        """The sum of the row normalized coinstall weights in each column."""
+        self.compute()
+        return self._row_norms
+
+    @property
+    def row_normalized(self):
+        """The row normalized weight of every edge of a CoinstallGraph."""
+        self.compute()
+        return self._row_normalized
+
+    @property
+    def changed_columns(self):
+        """The columns whose aggregates were recomputed for a delta, or None."""
+        self.compute()
+        return self._changed_columns
+
+    def is_computed(self):
+        return self._sums is not None
+
+    def compute(self):
+        if self._sums is not None:
+            return self
+        previous, self._previous = self._previous, None
+        if isinstance(self._graph, CoinstallGraph):
+            self._compute_graph()
+        elif previous is not None and previous.is_computed() and not isinstance(previous.graph, CoinstallGraph):
+            self._compute_dict_delta(previous)
+        else:
+            self._compute_dict()
+        return self
+
+    def column_rows(self):
+        """Returns a dict of column guid to the rows it appears in, in row order.
+
+        Only available for a dict graph.  Built on first use, and carried
+        over to the stats of later deltas.
+        """
+        if self._column_rows is None:
+            column_rows = {}
+            for guid, coinstalls in self._graph.items():
+                for coinstall_guid in coinstalls:
+                    rows = column_rows.get(coinstall_guid)
+                    if rows is None:
+                        rows = column_rows[coinstall_guid] = []
+                    rows.append(guid)
+            self._column_rows = column_rows
+        return self._column_rows
+
+    def rows_with_columns(self, columns):
+        """Returns the set of rows containing any of columns."""
+        column_rows = self.column_rows()
+        rows = set()
+        for column in columns:
+            rows.update(column_rows.get(column, ()))
+        return rows
+
+    def _compute_dict(self):
+        sums = {}
+        counts = {}
+        row_norms = {}
+        for coinstalls in self._graph.values():
+            rowsum = sum(coinstalls.values())
+            for coinstall_guid, coinstall_count in coinstalls.items():
+                sums[coinstall_guid] = sums.get(coinstall_guid, 0) + coinstall_count
+                counts[coinstall_guid] = counts.get(coinstall_guid, 0) + 1
+                row_norms[coinstall_guid] = row_norms.get(coinstall_guid, 0) + 1.0 * coinstall_count / rowsum
+        self._sums, self._counts, self._row_norms = sums, counts, row_norms
+
+    def _compute_dict_delta(self, previous):
+        graph, previous_graph = self._graph, previous.graph
+        changed_rows = self._changed_rows
+
+        changed_columns = set()
+        added_rows = {}
+        for guid in changed_rows:
+            if guid in previous_graph:
+                changed_columns.update(previous_graph[guid])
+            if guid in graph:
+                changed_columns.update(graph[guid])
+                for coinstall_guid in graph[guid]:
+                    added_rows.setdefault(coinstall_guid, []).append(guid)
+
+        previous_column_rows = previous.column_rows()
+        column_rows = dict(previous_column_rows)
+        sums = dict(previous.sums)
+        counts = dict(previous.counts)
+        row_norms = dict(previous.row_norms)
+        positions = None
+        rowsums = {}
+
+        for column in changed_columns:
+            rows = [guid for guid in previous_column_rows.get(column, ()) if guid not in changed_rows]
+            if column in added_rows:
+                if positions is None:
+                    positions = {guid: i for i, guid in enumerate(graph)}
+                rows.extend(added_rows[column])
+                rows.sort(key=positions.__getitem__)
+            if not rows:
+                for aggregates in (column_rows, sums, counts, row_norms):
+                    aggregates.pop(column, None)
+                continue
+
+            # Accumulate in row order, exactly as _compute_dict does
+            column_sum = 0
+            column_count = 0
+            column_row_norm = 0
+            for guid in rows:
+                coinstalls = graph[guid]
+                rowsum = rowsums.get(guid)
+                if rowsum is None:
+                    rowsum = rowsums[guid] = sum(coinstalls.values())
+                coinstall_count = coinstalls[column]
+                column_sum = column_sum + coinstall_count
+                column_count = column_count + 1
+                column_row_norm = column_row_norm + 1.0 * coinstall_count / rowsum
+            column_rows[column] = rows
+            sums[column], counts[column], row_norms[column] = column_sum, column_count, column_row_norm
+
+        self._sums, self._counts, self._row_norms = sums, counts, row_norms
+        self._column_rows = column_rows
+        self._changed_columns = changed_columns
+
+    def _compute_graph(self):
+        matrix = self._graph.matrix
+        row_ids = self._graph.row_ids()
+        row_sums = np.bincount(row_ids, weights=matrix.data, minlength=matrix.shape[0])
+        row_normalized = matrix.data / row_sums[row_ids]
+        size = matrix.shape[1]
+        self._sums = np.bincount(matrix.indices, weights=matrix.data, minlength=size)
+        self._counts = np.bincount(matrix.indices, minlength=size)
+        self._row_norms = np.bincount(matrix.indices, weights=row_normalized, minlength=size)
+        self._row_normalized = row_normalized
+
+
+class ColumnNormalization(BaseTreatment):
+    """Base for the treatments dividing each coinstall weight by an
+    aggregate of its column.
+
+    Sub classes return the aggregates from _column_aggregates and treat a
+    row given them in _treat_row.  treat_delta then only treats again the
+    rows that changed or that hold a column whose aggregate changed.
     """
+
+    def _column_aggregates(self, column_stats):
+        raise NotImplementedError
+
+    def _treat_row(self, coinstalls, column_aggregates):
+        raise NotImplementedError
+
     def treat(self, input_dict, **kwargs):
-        guid_count_map = {}
+        column_aggregates = self._column_aggregates(ColumnStats.for_graph(input_dict, **kwargs))
+        treatment_dict = {}
         for guidkey, coinstalls in input_dict.items():
-            for coinstall_guid, coinstall_count in coinstalls.items():
-                guid_count_map.setdefault(coinstall_guid, 0)
-                guid_count_map[coinstall_guid] += coinstall_count
+            treatment_dict[guidkey] = self._treat_row(coinstalls, column_aggregates)
+        return treatment_dict
+
+    def treat_delta(self, previous_input, input_dict, previous_output, changed_rows, **kwargs):
+        """Treats the rows affected by changed_rows, reusing the other rows
+        of previous_output.
 
+        The column_stats kwarg must be the ColumnStats of input_dict derived
+        from those of previous_input, otherwise every row is treated again.
+        """
+        column_stats = ColumnStats.for_graph(input_dict, **kwargs)
+        if column_stats.changed_columns is None:
+            kwargs['column_stats'] = column_stats
+            return super().treat_delta(previous_input, input_dict, previous_output, changed_rows, **kwargs)
+
+        column_aggregates = self._column_aggregates(column_stats)
+        affected = {guid for guid in changed_rows if guid in input_dict}
+        affected.update(column_stats.rows_with_columns(column_stats.changed_columns))
         treatment_dict = {}
         for guidkey, coinstalls in input_dict.items():
-            output_dict = {}
-            for guid, guid_weight in coinstalls.items():
-                norm_guid_weight = guid_weight * 1.0 / guid_count_map[guid]
-                output_dict[guid] = norm_guid_weight
-            treatment_dict[guidkey] = output_dict
+            if guidkey in affected:
+                treatment_dict[guidkey] = self._treat_row(coinstalls, column_aggregates)
+            else:
+                treatment_dict[guidkey] = previous_output[guidkey]
+        affected.update(guid for guid in changed_rows if guid in previous_output)
+        return treatment_dict, affected
 
-        return treatment_dict
 
+class RowSum(ColumnNormalization):
+    """This normalization normalizes the weights for the suggested
+    coinstallation GUIDs based on the sum of the weights for the
+    coinstallation GUIDs.
+    """
+    def _column_aggregates(self, column_stats):
+        return column_stats.sums
+
+    def _treat_row(self, coinstalls, guid_count_map):
+        output_dict = {}
+        for guid, guid_weight in coinstalls.items():
+            norm_guid_weight = guid_weight * 1.0 / guid_count_map[guid]
+            output_dict[guid] = norm_guid_weight
+        return output_dict
+
+    def treat_graph(self, graph, **kwargs):
+        column_sums = ColumnStats.for_graph(graph, **kwargs).sums
+        matrix = graph.matrix
+        return graph.with_data(matrix.data / column_sums[matrix.indices])
 
-class RowCount(BaseTreatment):
+
+class RowCount(ColumnNormalization):
     """This normalization method counts the unique times that a
     GUID is coinstalled with any other GUID.
 
@@ -92,21 +453,19 @@ class RowCount(BaseTreatment):
     proportional to it's overall popularity.
     """
 
-    def treat(self, input_dict, **kwargs):
-        row_count = {}
-        for guidkey, coinstalls in input_dict.items():
-            for coinstall_guid, _ in coinstalls.items():
-                row_count.setdefault(coinstall_guid, 0)
-                row_count[coinstall_guid] += 1
+    def _column_aggregates(self, column_stats):
+        return column_stats.counts
 
-        treatment_dict = {}
-        for guidkey, coinstalls in input_dict.items():
-            output_dict = {}
-            for result_guid, result_count in coinstalls.items():
-                output_dict[result_guid] = 1.0 * result_count / row_count[result_guid]
-            treatment_dict[guidkey] = output_dict
+    def _treat_row(self, coinstalls, row_count):
+        output_dict = {}
+        for result_guid, result_count in coinstalls.items():
+            output_dict[result_guid] = 1.0 * result_count / row_count[result_guid]
+        return output_dict
 
-        return treatment_dict
+    def treat_graph(self, graph, **kwargs):
+        column_counts = ColumnStats.for_graph(graph, **kwargs).counts
+        matrix = graph.matrix
+        return graph.with_data(matrix.data / column_counts[matrix.indices])
 
 
 class RowNormalizationMixin():
@@ -123,35 +482,111 @@ class RowNormalizationMixin():
         return tmp_dict
 
 
-class RowNormSum(BaseTreatment, RowNormalizationMixin):
+class RowNormSum(ColumnNormalization, RowNormalizationMixin):
     """This normalization is the same as norm_row_sum, but we also
     divide the result by the sum of
     (addon coinstall instances)/(addon coinstall total instances)
 
     The testcase for this scenario lays out the math more
     explicitly.
+
+    The denominator for each GUID is accumulated once, as a single scalar,
+    while streaming over the rows.
     """
 
-    def _build_guid_row_norm(self, input_dict):
-        guid_row_norm = {}
-        for _, coinstalls in input_dict.items():
-            rowsum = sum(coinstalls.values())
-            for coinstall_guid, coinstall_count in coinstalls.items():
-                if coinstall_guid not in guid_row_norm:
-                    guid_row_norm[coinstall_guid] = []
-                guid_row_norm[coinstall_guid].append(1.0 * coinstall_count / rowsum)
-        return guid_row_norm
+    def _column_aggregates(self, column_stats):
+        return column_stats.row_norms
+
+    def _treat_row(self, coinstalls, guid_row_norm):
+        output_dict = {}
+        tmp_dict = self._normalize_row_weights(coinstalls)
+        for output_guid, output_guid_weight in tmp_dict.items():
+            output_dict[output_guid] = output_guid_weight / guid_row_norm[output_guid]
+        return output_dict
+
+    def treat_graph(self, graph, **kwargs):
+        column_stats = ColumnStats.for_graph(graph, **kwargs)
+        matrix = graph.matrix
+        return graph.with_data(column_stats.row_normalized / column_stats.row_norms[matrix.indices])
+
+
+class Guidception(BaseTreatment, RowNormalizationMixin):
+    """A multi-hop treatment crediting each coinstalled guid with the random
+    walks that can continue from it.
+
+    With P the row normalized coinstall graph read as a transition matrix,
+    n the number of guids coinstalled with guid r and ones a vector of 1,
+    the weight of guid g in the row of r is
+
+        n * P[r, g] + sum(damping ** (k - 1) * (P ** k . ones)[g] for k in 1 .. depth - 1)
+
+    normalized over the row.  (P ** k . ones)[g] is the probability that a
+    walk of k steps from g never reaches a guid without a row, ie. one
+    pruned by MinInstallPrune.  It is computed by depth - 1 matrix vector
+    products, so the cost is O(depth * edges) and P ** k is never formed.
+
+    The default depth of 2 reproduces the original recursive Guidception.
+    It normalized every level, so each level past the first added exactly
+    1 for a guid with a row, whatever its recursion depth.
+
+    Expected guid-2 results based on mock_data
+
+    guid2 = {
+        'guid-1': 0.2666666666666667,
+        'guid-3': 0.23333333333333334,
+        'guid-4': 0.16666666666666666,
+        'guid-8': 0.2,
+        'guid-9': 0.13333333333333333
+    }
+
+    """
+
+    DEPTH = 2
+    DAMPING = 0.5
+
+    def __init__(self, depth=DEPTH, damping=DAMPING):
+        if depth < 1:
+            raise ValueError("Guidception depth must be at least 1, got [{}]".format(depth))
+        self.depth = depth
+        self.damping = damping
+
+    def parameters(self):
+        return {'depth': self.depth, 'damping': self.damping}
 
     def treat(self, input_dict, **kwargs):
-        guid_row_norm = self._build_guid_row_norm(input_dict)
-        treatment_dict = {}
-        for guidkey, coinstalls in input_dict.items():
-            output_dict = {}
-            tmp_dict = self._normalize_row_weights(coinstalls)
-            for output_guid, output_guid_weight in tmp_dict.items():
-                guid_row_norm_list = guid_row_norm.get(output_guid, [])
-                norm_sum = sum(guid_row_norm_list)
-                output_dict[output_guid] = output_guid_weight / norm_sum
-            treatment_dict[guidkey] = output_dict
+        normalized = {guid: self._normalize_row_weights(coinstalls) for guid, coinstalls in input_dict.items()}
+
+        onward = {}
+        mass = None
+        for k in range(1, self.depth):
+            # mass is P ** k . ones; guids without a row have none
+            if mass is None:
+                mass = {guid: sum(row.values()) for guid, row in normalized.items()}
+            else:
+                mass = {guid: sum(weight * mass.get(coinstall_guid, 0) for coinstall_guid, weight in row.items())
+                        for guid, row in normalized.items()}
+            factor = self.damping ** (k - 1)
+            for guid, guid_mass in mass.items():
+                onward[guid] = onward.get(guid, 0) + factor * guid_mass
 
+        treatment_dict = {}
+        for guidkey, row in normalized.items():
+            row_count = len(row)
+            tmp_dict = {guid: row_count * weight + onward.get(guid, 0) for guid, weight in row.items()}
+            treatment_dict[guidkey] = self._normalize_row_weights(tmp_dict)
         return treatment_dict
+
+    def treat_graph(self, graph, **kwargs):
+        row_normalized = ColumnStats.for_graph(graph, **kwargs).row_normalized
+        transition = graph.with_data(row_normalized).matrix
+
+        onward = np.zeros(transition.shape[1])
+        mass = np.ones(transition.shape[1])
+        for k in range(1, self.depth):
+            mass = transition.dot(mass)
+            onward += self.damping ** (k - 1) * mass
+
+        row_ids = graph.row_ids()
+        weights = np.diff(transition.indptr)[row_ids] * row_normalized + onward[transition.indices]
+        row_sums = np.bincount(row_ids, weights=weights, minlength=transition.shape[0])
+        return graph.with_data(weights / row_sums[row_ids])
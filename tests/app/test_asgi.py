@@ -0,0 +1,193 @@
+import asyncio
+import json
+import threading
+
+from flask import Flask
+from mock import MagicMock, patch
+import pytest
+
+from taar_lite.app import plugin
+from taar_lite.app.asgi import TaarLiteASGIApp
+from taar_lite.app.production import REFRESH_MODE_BACKGROUND, TaarLiteAppResource
+from taar_lite.app.response_cache import ResponseCache
+
+
+async def call(app, path, method='GET', query_string=b''):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string}
+    await app(scope, None, send)
+    start, body = messages
+    assert start['type'] == 'http.response.start'
+    assert dict(start['headers'])[b'content-length'] == str(len(body['body'])).encode('ascii')
+    return start['status'], json.loads(body['body'].decode('utf-8'))
+
+
+def run(coroutine):
+    # asyncio.run is not available on Python 3.6
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def get(app, path, **kwargs):
+    return run(call(app, path, **kwargs))
+
+
+@pytest.fixture
+def flask_client(test_context):
+    app = Flask('test')
+    app.taar_plugin = plugin.configure_plugin(app)
+    app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+    yield app.test_client()
+    plugin.PROXY_MANAGER.setResource(None)
+
+
+@pytest.mark.parametrize('refresh_mode', ['inline', REFRESH_MODE_BACKGROUND])
+def test_asgi_matches_the_flask_route(test_context, flask_client, refresh_mode):
+    resources = []
+
+    def factory():
+        resources.append(TaarLiteAppResource(test_context, refresh_mode=refresh_mode, refresh_interval=3600))
+        return resources[-1]
+
+    app = TaarLiteASGIApp(factory, response_cache=ResponseCache(16))
+    with patch.object(plugin, 'TAAR_MAX_RESULTS', 1):
+        for guid in ['a', 'b', 'z']:
+            for query in ['', 'normalize=row_sum', 'normalize=nope']:
+                status, body = get(app, '/taarlite/api/v1/addon_recommendations/{}/'.format(guid),
+                                   query_string=query.encode('ascii'))
+                expected = flask_client.get('/taarlite/api/v1/addon_recommendations/{}/?{}'.format(guid, query))
+                assert status == 200
+                assert body == expected.get_json()
+    assert body == {'results': []}
+    assert len(resources) == 1
+    resources[0].stop_refresher()
+
+
+def test_concurrent_first_requests_construct_the_resource_once(test_context):
+    constructed = []
+    release = threading.Event()
+
+    def factory():
+        release.wait(5)
+        constructed.append(TaarLiteAppResource(test_context))
+        return constructed[-1]
+
+    app = TaarLiteASGIApp(factory)
+
+    async def requests():
+        calls = [call(app, '/taarlite/api/v1/addon_recommendations/a/') for _ in range(50)]
+        tasks = [asyncio.ensure_future(c) for c in calls]
+        await asyncio.sleep(0.01)
+        # The event loop is not blocked while the resource is constructed
+        assert await call(app, '/taarlite/api/v1/ready') == (503, {'ready': False})
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    responses = run(requests())
+    assert len(constructed) == 1
+    assert all(status == 200 for status, _ in responses)
+    assert get(app, '/taarlite/api/v1/ready') == (200, {'ready': True})
+
+
+def test_lifespan_starts_loading_the_models(test_context):
+    app = TaarLiteASGIApp(lambda: TaarLiteAppResource(test_context))
+
+    async def lifespan():
+        received = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await received.put({'type': 'lifespan.startup'})
+        await received.put({'type': 'lifespan.shutdown'})
+        await app({'type': 'lifespan'}, received.get, send)
+        await app.resource()
+        return sent
+
+    assert run(lifespan()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+def test_ready_once_the_lifespan_load_completes(test_context):
+    loaded = threading.Event()
+
+    def factory():
+        resource = TaarLiteAppResource(test_context)
+        loaded.set()
+        return resource
+
+    app = TaarLiteASGIApp(factory)
+
+    async def probes():
+        received = asyncio.Queue()
+
+        async def send(message):
+            pass
+
+        await received.put({'type': 'lifespan.startup'})
+        lifespan = asyncio.ensure_future(app({'type': 'lifespan'}, received.get, send))
+        while not loaded.is_set():
+            await asyncio.sleep(0.01)
+        # Let the loop run the done callback of the load
+        await asyncio.sleep(0.01)
+        ready = await call(app, '/taarlite/api/v1/ready')
+        await received.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        return ready
+
+    assert run(probes()) == (200, {'ready': True})
+
+
+def test_ready_probes_alone_load_the_models(test_context):
+    app = TaarLiteASGIApp(lambda: TaarLiteAppResource(test_context))
+
+    async def probes():
+        statuses = []
+        for _ in range(100):
+            statuses.append((await call(app, '/taarlite/api/v1/ready'))[0])
+            if statuses[-1] == 200:
+                break
+            await asyncio.sleep(0.01)
+        return statuses
+
+    statuses = run(probes())
+    assert statuses[0] == 503
+    assert statuses[-1] == 200
+
+
+def test_ready_probes_refresh_an_inline_resource_that_failed_to_load():
+    resource = MagicMock()
+    resource.refresh_status.return_value = {'refresh_mode': 'inline'}
+    resource.is_ready.return_value = False
+    refreshed = threading.Event()
+
+    def refresh():
+        # The models load on the first retry
+        resource.is_ready.return_value = True
+        refreshed.set()
+    resource.refresh.side_effect = refresh
+
+    app = TaarLiteASGIApp(lambda: resource)
+
+    async def probes():
+        await app.resource()
+        first = await call(app, '/taarlite/api/v1/ready')
+        while not refreshed.is_set():
+            await asyncio.sleep(0.01)
+        return first, await call(app, '/taarlite/api/v1/ready')
+
+    assert run(probes()) == ((503, {'ready': False}), (200, {'ready': True}))
+
+
+def test_unknown_routes_and_methods(test_context):
+    app = TaarLiteASGIApp(lambda: TaarLiteAppResource(test_context))
+    assert get(app, '/taarlite/api/v1/addon_recommendations/a/b/')[0] == 404
+    assert get(app, '/taarlite/api/v1/addon_recommendations/a')[0] == 404
+    assert get(app, '/taarlite/api/v1/addon_recommendations/a/', method='POST')[0] == 405
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from taar_lite.app.encoding import ENCODERS, ResponseEncoder, encode_top_n, json_encoder
+from taar_lite.recommenders.graph import CoinstallGraph, TopNTable
+
+
+@pytest.mark.parametrize('name', list(ENCODERS))
+def test_encoders_agree(name):
+    if name != 'json':
+        pytest.importorskip(name)
+    value = {'results': ['guid-a@example.com', 'b/c', 'é'], 'n': 1.5}
+    encoded = json_encoder(name)(value)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded.decode('utf-8')) == value
+
+
+def test_auto_picks_an_installed_encoder():
+    assert json.loads(json_encoder('auto')([1, 2]).decode('utf-8')) == [1, 2]
+
+
+def test_unknown_encoder_is_rejected():
+    with pytest.raises(ValueError):
+        json_encoder('pickle')
+
+
+def test_encode_top_n_encodes_the_first_results_of_every_guid():
+    graph = CoinstallGraph.from_dict({'a': {'b': 2, 'c': 1}, 'b': {'a': 2}})
+
+    def rank_row(indices, weights, limit):
+        order = weights.argsort()[::-1][:limit]
+        return indices[order], weights[order]
+
+    table = TopNTable.build(graph, 2, rank_row)
+    encoder = ResponseEncoder(1, lambda results: json_encoder('json')([guid for guid, _ in results]))
+    assert encode_top_n(table, encoder) == {'a': b'["b"]', 'b': b'["a"]'}
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from taar_lite.app.compile_model import compile_model
+from taar_lite.app.export_graph import build_recommenders, export_recommendation_graph, main
+from taar_lite.app.production import NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM
+from taar_lite.recommenders.graph import CoinstallGraph
+
+COINSTALLS = {
+    'a': {'b': 3, 'c': 1, 'd': 2},
+    'b': {'a': 3, 'c': 2},
+    'c': {'a': 1, 'b': 2},
+    'd': {'a': 2},
+}
+RANKINGS = {'a': 1000, 'b': 800, 'c': 900, 'd': 700}
+
+
+def read_jsonl(path):
+    with open(path) as fileobj:
+        return [json.loads(line) for line in fileobj]
+
+
+def expected_lines(recommender, limit):
+    return [
+        {'guid': guid,
+         'recommendations': [recommended for recommended, _ in result],
+         'weights': [weight for _, weight in result]}
+        for guid, result in recommender.get_recommendation_graph(limit).items()
+    ]
+
+
+@pytest.fixture
+def json_models(tmp_path):
+    coinstall_path = tmp_path / 'coinstalls.json'
+    ranking_path = tmp_path / 'rankings.json'
+    coinstall_path.write_text(json.dumps(COINSTALLS))
+    ranking_path.write_text(json.dumps(RANKINGS))
+    return str(coinstall_path), str(ranking_path)
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_export_matches_the_recommendation_graph(tmp_path, processes):
+    recommenders = build_recommenders(CoinstallGraph.from_dict(COINSTALLS), RANKINGS, limit=2)
+    paths = export_recommendation_graph(recommenders, str(tmp_path), limit=2,
+                                        processes=processes, chunk_size=1)
+    assert list(paths) == list(recommenders)
+    for name, recommender in recommenders.items():
+        assert read_jsonl(paths[name]) == expected_lines(recommender, 2)
+
+
+def test_export_from_a_model_file(json_models, tmp_path):
+    model_path = str(tmp_path / 'taarlite.model')
+    compile_model(json_models[0], json_models[1], model_path)
+    main([str(tmp_path / 'from_file'), '--model-file', model_path, '--processes', '0'])
+    main([str(tmp_path / 'from_json'), '--json', json_models[0], json_models[1],
+          '--modes', '{},{}'.format(NORM_MODE_ROWSUM, NORM_MODE_ROWNORMSUM), '--processes', '2'])
+
+    from_json = sorted(path.name for path in (tmp_path / 'from_json').iterdir())
+    assert from_json == sorted('{}.jsonl'.format(name) for name in [NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM])
+    for name in from_json:
+        assert read_jsonl(str(tmp_path / 'from_json' / name)) == read_jsonl(str(tmp_path / 'from_file' / name))
+
+
+def test_unknown_normalizations_are_rejected():
+    with pytest.raises(ValueError):
+        build_recommenders(CoinstallGraph.from_dict(COINSTALLS), RANKINGS, modes=['nope'])
+
+
+def test_export_to_parquet(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    recommenders = build_recommenders(CoinstallGraph.from_dict(COINSTALLS), RANKINGS, modes=[NORM_MODE_ROWSUM])
+    paths = export_recommendation_graph(recommenders, str(tmp_path), output_format='parquet',
+                                        processes=0, chunk_size=2)
+    assert parquet.read_table(paths[NORM_MODE_ROWSUM]).to_pylist() == expected_lines(
+        recommenders[NORM_MODE_ROWSUM], 4)
@@ -0,0 +1,106 @@
+import json
+
+import boto3
+
+from taar_lite.app.loaders import ETagJSONLoader, ModelFileLoader, StreamingGraphLoader
+from taar_lite.app.metrics import InMemorySink
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.model_file import write_model_file
+
+
+def test_etag_loader_only_reloads_changed_objects(test_context):
+    loader = ETagJSONLoader(test_context, 'addon_list_bucket', 'addon_list_key')
+    data, refreshed = loader.get()
+    assert refreshed
+    assert data == {'a': {'b': 1}, 'b': {'a': 1}}
+    etag = loader.etag
+    assert etag is not None
+
+    # An expired but unchanged object is not downloaded again
+    loader._expiry_time = 0
+    same_data, refreshed = loader.get()
+    assert not refreshed
+    assert same_data is data
+    assert loader.etag == etag
+
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.Object('addon_list_bucket', 'addon_list_key').put(Body=json.dumps({'a': {}}))
+    loader._expiry_time = 0
+    new_data, refreshed = loader.get()
+    assert refreshed
+    assert new_data == {'a': {}}
+    assert loader.etag != etag
+
+
+def test_streaming_loader_parses_a_pruned_graph(test_context):
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.Object('addon_list_bucket', 'addon_list_key').put(
+        Body=json.dumps({'a': {'b': 1, 'c': 2}, 'b': {'a': 1}, 'c': {'a': 2}}))
+    loader = StreamingGraphLoader(test_context, 'addon_list_bucket', 'addon_list_key')
+    loader.set_row_filter(lambda guid: guid != 'b', 1)
+    graph, refreshed = loader.get()
+    assert refreshed
+    assert isinstance(graph, CoinstallGraph)
+    assert graph == {'a': {'b': 1, 'c': 2}, 'c': {'a': 2}}
+
+    # The same filter does not trigger a reload, a new one does
+    loader.set_row_filter(lambda guid: guid != 'b', 1)
+    assert loader.get() == (graph, False)
+    loader.set_row_filter(lambda guid: True, 2)
+    graph, refreshed = loader.get()
+    assert refreshed
+    assert graph == {'a': {'b': 1, 'c': 2}, 'b': {'a': 1}, 'c': {'a': 2}}
+    assert loader.has_current_row_filter
+
+
+def test_streaming_loader_tells_when_the_graph_was_pruned_with_another_filter(test_context):
+    loader = StreamingGraphLoader(test_context, 'addon_list_bucket', 'addon_list_key')
+    loader.set_row_filter(lambda guid: guid != 'b', 1)
+    graph, _ = loader.get()
+    assert loader.has_current_row_filter
+
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.Object('addon_list_bucket', 'addon_list_key').put(Body=b'{"a": ')
+    loader.set_row_filter(lambda guid: True, 2)
+    assert loader.get() == (graph, False)
+    assert not loader.has_current_row_filter
+
+
+def test_loader_reports_download_and_parse_metrics(test_context):
+    metrics = InMemorySink()
+    loader = StreamingGraphLoader(test_context, 'addon_list_bucket', 'addon_list_key', metrics=metrics)
+    loader.get()
+    assert len(metrics.timings['s3.addon_list_key.download']) == 1
+    assert len(metrics.timings['s3.addon_list_key.parse']) == 1
+    assert metrics.gauges['s3.addon_list_key.bytes'] == len(json.dumps({'a': {'b': 1}, 'b': {'a': 1}}))
+
+    loader._expiry_time = 0
+    loader.get()
+    assert metrics.counters['s3.addon_list_key.unchanged'] == 1
+
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.Object('addon_list_bucket', 'addon_list_key').put(Body=b'{"a": ')
+    loader._expiry_time = 0
+    loader.etag = None
+    loader.get()
+    assert metrics.counters['s3.addon_list_key.errors'] == 1
+
+
+def test_model_file_loader_maps_replaced_files_again(test_context, tmp_path):
+    path = str(tmp_path / 'taarlite.model')
+    write_model_file(path, CoinstallGraph.from_dict({'a': {'b': 1}, 'b': {'a': 1}}), {'a': 1})
+    loader = ModelFileLoader(test_context, path)
+    model_file, refreshed = loader.get()
+    assert refreshed
+    assert model_file.graph == {'a': {'b': 1}, 'b': {'a': 1}}
+
+    loader._expiry_time = 0
+    assert loader.get() == (model_file, False)
+
+    write_model_file(path, CoinstallGraph.from_dict({'a': {}}), {'a': 1})
+    loader._expiry_time = 0
+    new_model_file, refreshed = loader.get()
+    assert refreshed
+    assert new_model_file.graph == {'a': {}}
+    # The previous mapping stays readable
+    assert model_file.graph == {'a': {'b': 1}, 'b': {'a': 1}}
@@ -1,3 +1,7 @@
+import json
+import logging
+
+from taar_lite.app.encoding import ResponseEncoder
 from taar_lite.app.production import TaarLiteAppResource
 
 
@@ -9,3 +13,26 @@ def test_logging(test_context):
     app.logger.warn('bar')
     app.logger.info('foo')
     app.logger.debug('bar')
+
+
+def test_every_request_is_logged_by_default(test_context, caplog):
+    app = TaarLiteAppResource(test_context)
+    with caplog.at_level(logging.INFO):
+        app.recommend({'guid': 'a'}, limit=4)
+    assert "Addon: [a] triggered these recommendation guids: [[\"('b', 1.0)\"]]" in caplog.messages
+
+
+def test_sampled_request_logging(test_context, caplog):
+    app = TaarLiteAppResource(test_context, request_log_sample_rate=2)
+    with caplog.at_level(logging.INFO):
+        for _ in range(4):
+            app.recommend({'guid': 'a'}, limit=4)
+    assert sum('triggered these recommendation guids' in message for message in caplog.messages) == 2
+
+
+def test_preencoded_requests_are_logged(test_context, caplog):
+    encoder = ResponseEncoder(4, lambda results: json.dumps(results).encode('utf-8'))
+    app = TaarLiteAppResource(test_context, response_encoder=encoder)
+    with caplog.at_level(logging.INFO):
+        assert app.encoded_recommendations({'guid': 'a'}, limit=4) is not None
+    assert "Addon: [a] triggered these recommendation guids: [[\"('b', 1.0)\"]]" in caplog.messages
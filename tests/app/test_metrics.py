@@ -0,0 +1,44 @@
+import socket
+
+from taar_lite.app.metrics import InMemorySink, StatsdSink, graph_size
+from taar_lite.recommenders.graph import CoinstallGraph
+
+
+def test_in_memory_sink_records_every_metric():
+    sink = InMemorySink()
+    sink.incr('hits')
+    sink.incr('hits', 2)
+    sink.gauge('size', 3)
+    sink.gauge('size', 4)
+    with sink.timer('lookup'):
+        pass
+    sink.timing('lookup', 0.5)
+    assert sink.counters == {'hits': 3}
+    assert sink.gauges == {'size': 4}
+    assert len(sink.timings['lookup']) == 2
+    assert sink.timings['lookup'][1] == 0.5
+
+
+def test_statsd_sink_sends_statsd_lines():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    try:
+        sink = StatsdSink('127.0.0.1', server.getsockname()[1], 'taarlite')
+        sink.incr('hits')
+        sink.gauge('model.none.nodes', 12)
+        sink.timing('request.total', 0.0125)
+        lines = [server.recv(1024).decode('utf-8') for _ in range(3)]
+    finally:
+        server.close()
+    assert lines == [
+        'taarlite.hits:1|c',
+        'taarlite.model.none.nodes:12|g',
+        'taarlite.request.total:12.500|ms',
+    ]
+
+
+def test_graph_size_of_both_representations():
+    coinstalls = {'a': {'b': 1, 'c': 2}, 'b': {'a': 1}}
+    assert graph_size(coinstalls) == (2, 3)
+    assert graph_size(CoinstallGraph.from_dict(coinstalls)) == (2, 3)
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+import threading
+
+import pytest
+
+from taar_lite.app.mode_recommenders import ModeRecommenders
+from taar_lite.recommenders.pipeline import TreatmentPipeline
+from taar_lite.recommenders.treatments import MinInstallPrune, NoTreatment, RowCount, RowSum
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def coinstall_dict():
+    return {
+        'a': {'b': 10, 'c': 13},
+        'b': {'a': 10, 'c': 4},
+        'c': {'a': 13, 'b': 4},
+    }
+
+
+@pytest.fixture
+def ranking_dict():
+    return {'a': 100, 'b': 90, 'c': 80}
+
+
+@pytest.fixture
+def pipeline(ranking_dict):
+    return TreatmentPipeline(
+        prefix=[MinInstallPrune()],
+        branches=OrderedDict([
+            ('none', NoTreatment()),
+            ('row_count', RowCount()),
+            ('row_sum', RowSum()),
+        ]),
+        treatment_kwargs={'ranking_dict': ranking_dict}
+    )
+
+
+def get_mode_recommenders(pipeline, coinstall_dict, ranking_dict, idle_seconds=0, clock=None):
+    kwargs = {'tie_breaker_dict': ranking_dict, 'precompute_limit': 2}
+    recommenders = pipeline.build_recommenders(coinstall_dict, names=['row_sum'], **kwargs)
+    return ModeRecommenders(recommenders, pipeline, ['none', 'row_count'], kwargs,
+                            idle_seconds=idle_seconds, clock=clock or FakeClock())
+
+
+def test_lazy_modes_are_built_on_first_use(pipeline, coinstall_dict, ranking_dict):
+    recommenders = get_mode_recommenders(pipeline, coinstall_dict, ranking_dict)
+    assert list(recommenders) == ['none', 'row_count', 'row_sum']
+    assert 'row_count' in recommenders and 'rownorm_sum' not in recommenders
+    assert recommenders.built_modes() == ['row_sum']
+
+    row_count = recommenders['row_count']
+    assert recommenders['row_count'] is row_count
+    assert recommenders.built_modes() == ['row_count', 'row_sum']
+
+    expected = TreatmentPipeline(pipeline.prefix, pipeline.branches, pipeline.treatment_kwargs).build_recommenders(
+        coinstall_dict, tie_breaker_dict=ranking_dict, precompute_limit=2)['row_count']
+    assert row_count.treated_graph == expected.treated_graph
+    assert row_count.top_n_table == expected.top_n_table
+    with pytest.raises(KeyError):
+        recommenders['rownorm_sum']
+
+
+def test_idle_lazy_modes_are_evicted(pipeline, coinstall_dict, ranking_dict):
+    clock = FakeClock()
+    recommenders = get_mode_recommenders(pipeline, coinstall_dict, ranking_dict, idle_seconds=60, clock=clock)
+    none = recommenders['none']
+    clock.now = 30
+    recommenders['row_count']
+    clock.now = 70
+    assert recommenders.evict_idle() == ['none']
+    assert recommenders.built_modes() == ['row_count', 'row_sum']
+    # A request that looked it up keeps it, the next one builds it again
+    assert none.recommend('a', 2) == recommenders['none'].recommend('a', 2)
+    assert recommenders['none'] is not none
+
+
+def test_lazy_modes_are_kept_without_idle_seconds(pipeline, coinstall_dict, ranking_dict):
+    clock = FakeClock()
+    recommenders = get_mode_recommenders(pipeline, coinstall_dict, ranking_dict, clock=clock)
+    recommenders['none']
+    clock.now = 10 ** 6
+    assert recommenders.evict_idle() == []
+    assert 'none' in recommenders.built_modes()
+
+
+def test_concurrent_first_lookups_build_once(pipeline, coinstall_dict, ranking_dict):
+    recommenders = get_mode_recommenders(pipeline, coinstall_dict, ranking_dict)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(recommenders['row_count'])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, results))) == 1
+
+
+def test_build_recommender_requires_a_run(pipeline):
+    with pytest.raises(ValueError):
+        pipeline.build_recommender('none')
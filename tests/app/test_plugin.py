@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+
+import boto3
+from flask import Flask
+from mock import ANY, patch, MagicMock
+import pytest
+
+from taar_lite.app import plugin
+from taar_lite.app.encoding import ResponseEncoder
+from taar_lite.app.metrics import InMemorySink
+from taar_lite.app.plugin import ResourceProxy
+from taar_lite.app.production import TaarLiteAppResource
+from taar_lite.app.response_cache import ResponseCache
+
+
+def test_resource_proxy_constructs_the_resource_once():
+    proxy = ResourceProxy()
+    constructed = []
+
+    def factory():
+        time.sleep(0.05)
+        resource = object()
+        constructed.append(resource)
+        return resource
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(proxy.getOrCreateResource(factory)))
+        for _ in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(constructed) == 1
+    assert results == constructed * 16
+    assert proxy.getResource() is constructed[0]
+
+
+@pytest.fixture
+def proxy_manager():
+    yield plugin.PROXY_MANAGER
+    plugin.PROXY_MANAGER.setResource(None)
+
+
+@pytest.fixture
+def app(proxy_manager):
+    app = Flask('test')
+    app.config['TESTING'] = True
+    app.taar_plugin = plugin.configure_plugin(app)
+    return app
+
+
+def test_ready_is_unavailable_until_the_models_are_loaded(app):
+    resource = MagicMock()
+    resource.is_ready.return_value = False
+    app.taar_plugin.set({'PROXY_RESOURCE': resource})
+    response = app.test_client().get('/taarlite/api/v1/ready')
+    assert response.status_code == 503
+    assert response.get_json() == {'ready': False}
+
+    resource.is_ready.return_value = True
+    response = app.test_client().get('/taarlite/api/v1/ready')
+    assert response.status_code == 200
+    assert response.get_json() == {'ready': True}
+
+
+def test_ready_reflects_a_real_resource(app, test_context):
+    app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+    response = app.test_client().get('/taarlite/api/v1/ready')
+    assert response.status_code == 200
+
+
+def test_ready_probes_retry_a_failed_first_load(app, test_context):
+    conn = boto3.resource('s3', region_name='us-west-2')
+    coinstallations = conn.Object('addon_list_bucket', 'addon_list_key')
+    body = coinstallations.get()['Body'].read()
+    coinstallations.delete()
+    resource = TaarLiteAppResource(test_context)
+    assert not resource.is_ready()
+    app.taar_plugin.set({'PROXY_RESOURCE': resource})
+
+    coinstallations.put(Body=body)
+    client = app.test_client()
+    assert client.get('/taarlite/api/v1/ready').status_code == 503
+    for _ in range(100):
+        if client.get('/taarlite/api/v1/ready').status_code == 200:
+            break
+        time.sleep(0.01)
+    assert resource.is_ready()
+
+
+def test_eager_init_constructs_the_resource_at_configuration(proxy_manager, test_context):
+    with patch.object(plugin, 'TAAR_EAGER_INIT', True), \
+            patch.object(plugin, 'create_resource', lambda: TaarLiteAppResource(test_context)):
+        plugin.configure_plugin(Flask('test'))
+    assert proxy_manager.getResource().is_ready()
+
+
+def test_batch_recommendations(app, test_context):
+    app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+    with patch.object(plugin, 'TAAR_MAX_RESULTS', 1):
+        response = app.test_client().post('/taarlite/api/v1/addon_recommendations/',
+                                          json={'guids': ['a', 'b', 'z'], 'normalize': 'none'})
+    assert response.status_code == 200
+    assert response.get_json() == {'results': {'a': ['b'], 'b': ['a'], 'z': []}}
+
+
+@pytest.mark.parametrize('body', [None, [], {}, {'guids': 'a'}, {'guids': [1]}, {'guids': ['a'] * 101}])
+def test_batch_recommendations_rejects_malformed_requests(app, body):
+    app.taar_plugin.set({'PROXY_RESOURCE': MagicMock()})
+    response = app.test_client().post('/taarlite/api/v1/addon_recommendations/', json=body)
+    assert response.status_code == 400
+
+
+def test_recommendation_responses_are_cached_per_generation(app):
+    resource = MagicMock()
+    resource.current_generation.return_value = 1
+    resource.encoded_recommendations.return_value = None
+    resource.recommend.return_value = [('b', 1.0)]
+    app.taar_plugin.set({'PROXY_RESOURCE': resource})
+    client = app.test_client()
+    with patch.object(plugin, 'TAAR_MAX_RESULTS', 1), \
+            patch.object(plugin, 'RESPONSE_CACHE', ResponseCache(16)):
+        assert client.get('/taarlite/api/v1/addon_recommendations/a/').get_json() == {'results': ['b']}
+        resource.recommend.return_value = [('c', 1.0)]
+        assert client.get('/taarlite/api/v1/addon_recommendations/a/').get_json() == {'results': ['b']}
+        assert resource.recommend.call_count == 1
+        # The cached request is still reported by the resource
+        resource.record_request.assert_called_once_with({'guid': 'a'}, [('b', 1.0)], ANY)
+
+        resource.current_generation.return_value = 2
+        assert client.get('/taarlite/api/v1/addon_recommendations/a/').get_json() == {'results': ['c']}
+        assert resource.recommend.call_count == 2
+
+        stats = client.get('/taarlite/api/v1/cache_stats').get_json()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['invalidations'] == 1
+
+
+def test_recommendation_route_reports_request_metrics(app, test_context):
+    metrics = InMemorySink()
+    test_context['metrics'] = metrics
+    app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+    client = app.test_client()
+    with patch.object(plugin, 'RESPONSE_CACHE', ResponseCache(16)):
+        client.get('/taarlite/api/v1/addon_recommendations/a/')
+        client.get('/taarlite/api/v1/addon_recommendations/a/')
+    assert metrics.counters['response_cache.misses'] == 1
+    assert metrics.counters['response_cache.hits'] == 1
+    assert len(metrics.timings['request.lookup']) == 2
+    assert len(metrics.timings['request.ranking']) == 1
+    assert len(metrics.timings['request.serialization']) == 1
+    assert len(metrics.timings['request.total']) == 2
+
+
+def test_cached_recommendation_responses_are_logged(app, test_context, caplog):
+    app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+    client = app.test_client()
+    with patch.object(plugin, 'RESPONSE_CACHE', ResponseCache(16)), caplog.at_level(logging.INFO):
+        for _ in range(3):
+            client.get('/taarlite/api/v1/addon_recommendations/a/')
+        for _ in range(2):
+            client.get('/taarlite/api/v1/addon_recommendations/a/?normalize=nope')
+    assert sum('Addon: [a] triggered these recommendation guids' in message for message in caplog.messages) == 3
+    assert sum('Invalid normalization parameter' in message for message in caplog.messages) == 2
+
+
+def test_preencoded_responses_match_the_encoded_recommendations(app, test_context):
+    client = app.test_client()
+    urls = ['/taarlite/api/v1/addon_recommendations/{}/{}'.format(guid, query)
+            for guid in ['a', 'b', 'z']
+            for query in ['', '?normalize=none', '?normalize=row_sum', '?normalize=nope']]
+    with patch.object(plugin, 'TAAR_MAX_RESULTS', 1), \
+            patch.object(plugin, 'RESPONSE_CACHE', ResponseCache(0)):
+        app.taar_plugin.set({'PROXY_RESOURCE': TaarLiteAppResource(test_context)})
+        expected = [client.get(url).get_json() for url in urls]
+
+        metrics = InMemorySink()
+        test_context['metrics'] = metrics
+        resource = TaarLiteAppResource(test_context, response_encoder=ResponseEncoder(1, plugin.encode_results))
+        app.taar_plugin.set({'PROXY_RESOURCE': resource})
+        assert [client.get(url).get_json() for url in urls] == expected
+    assert expected[0] == {'results': ['b']}
+    # Only the invalid normalization is not encoded ahead of time
+    assert metrics.counters['request.preencoded'] == 9
+    assert metrics.counters['response_cache.misses'] == 3
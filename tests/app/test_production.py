@@ -1,13 +1,33 @@
+import json
+import threading
+import time
+
+import boto3
 from mock import patch, MagicMock
+import pytest
 
+from taar_lite.app.compile_model import compile_model
+from taar_lite.app.encoding import ResponseEncoder
+from taar_lite.app.loaders import StreamingGraphLoader
+from taar_lite.app.metrics import InMemorySink
+from taar_lite.app.mode_recommenders import ModePolicy
 from taar_lite.app.production import (
+    ADDON_LIST_BUCKET,
+    ADDON_LIST_KEY,
+    GUID_RANKING_KEY,
     TaarLiteAppResource,
     LoggingMinInstallPrune,
+    REFRESH_MODE_BACKGROUND,
+    NORM_MODE_GUIDCEPTION,
     NORM_MODE_ROWCOUNT,
     NORM_MODE_ROWNORMSUM,
     NORM_MODE_ROWSUM
 )
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.guidguid import GuidGuidCoinstallRecommender
+from taar_lite.recommenders.pipeline import TreatmentPipeline
 from taar_lite.recommenders.treatments import (
+    Guidception,
     NoTreatment,
     RowCount,
     RowNormSum,
@@ -31,6 +51,49 @@ def test_calling_with_normalize_string_matches(test_context):
     assert_recommender_match(NORM_MODE_ROWSUM)
 
 
+def test_refresh_and_requests_report_metrics(fake_loader_context):
+    metrics = InMemorySink()
+    fake_loader_context['metrics'] = metrics
+    app_resource = TaarLiteAppResource(fake_loader_context)
+    assert app_resource.metrics is metrics
+    assert len(metrics.timings['refresh.duration']) == 1
+    assert len(metrics.timings['refresh.prefix.LoggingMinInstallPrune']) == 1
+    assert len(metrics.timings['refresh.branch.' + NORM_MODE_ROWSUM]) == 1
+    assert metrics.gauges['model.generation'] == 1
+    assert metrics.gauges['model.none.nodes'] == 2
+    assert metrics.gauges['model.none.edges'] == 2
+
+    app_resource.recommend({'guid': 'a'}, limit=4)
+    app_resource.recommend({'guid': 'a', 'normalize': 'NOTARECOMMENDER'}, limit=4)
+    assert len(metrics.timings['request.lookup']) == 1
+    assert len(metrics.timings['request.ranking']) == 1
+    assert metrics.counters['request.invalid_normalization'] == 1
+
+    fake_loader_context['coinstall_loader'].set_data({'a': {'b': 1}, 'b': {'a': 2}})
+    app_resource.refresh()
+    assert metrics.counters['refresh.errors'] == 1
+
+
+def test_request_lookup_does_not_time_inline_refreshes(test_context):
+    metrics = InMemorySink()
+    test_context['metrics'] = metrics
+    app_resource = TaarLiteAppResource(test_context)
+    with patch.object(app_resource, 'refresh', side_effect=lambda: time.sleep(0.2)):
+        app_resource.recommend({'guid': 'a'}, limit=4)
+        app_resource.recommend_many(['a'], limit=4)
+    assert metrics.timings['request.lookup'][0] < 0.2
+    assert metrics.timings['batch.lookup'][0] < 0.2
+
+
+def test_encoded_recommendations_are_only_served_for_the_encoded_limit(test_context):
+    encoder = ResponseEncoder(1, lambda results: json.dumps(results).encode('utf-8'))
+    app_resource = TaarLiteAppResource(test_context, response_encoder=encoder)
+    assert app_resource.encoded_recommendations({'guid': 'a'}, limit=1) == b'[["b", 1.0]]'
+    assert app_resource.encoded_recommendations({'guid': 'z'}, limit=1) == b'[]'
+    assert app_resource.encoded_recommendations({'guid': 'a'}, limit=4) is None
+    assert TaarLiteAppResource(test_context).encoded_recommendations({'guid': 'a'}, limit=1) is None
+
+
 def test_calling_with_normalize_as_random_value_returns_empty_list(test_context):
     app_resource = TaarLiteAppResource(test_context)
     recs = app_resource.recommend({'guid': 'a', 'normalize': 'NOTARECOMMENDER'}, limit=4)
@@ -54,9 +117,341 @@ def test_recommenders_use_their_respective_treatments(test_context):
     assert isinstance(recommenders[NORM_MODE_ROWSUM].treatments[1], RowSum)
 
 
+def test_guidception_is_served_when_configured(test_context):
+    assert NORM_MODE_GUIDCEPTION not in TaarLiteAppResource(test_context)._recommenders
+
+    with patch('taar_lite.app.production.TAAR_GUIDCEPTION_DEPTH', 3):
+        app_resource = TaarLiteAppResource(test_context)
+        recommender = app_resource._recommenders[NORM_MODE_GUIDCEPTION]
+        assert isinstance(recommender.treatments[0], LoggingMinInstallPrune)
+        assert isinstance(recommender.treatments[1], Guidception)
+        assert recommender.treatments[1].depth == 3
+        assert app_resource.recommend({'guid': 'a', 'normalize': NORM_MODE_GUIDCEPTION}, limit=4) == [('b', 1.0)]
+
+
 def test_recommenders_have_tie_breaker_dict_set(test_context):
     app_resource = TaarLiteAppResource(test_context)
     recommenders = app_resource._recommenders  # noqa
     tie_breaker_dict = app_resource._guid_rankings  # noqa
     for norm in ['none', NORM_MODE_ROWCOUNT, NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM]:
         assert recommenders[norm].tie_breaker_dict == tie_breaker_dict
+
+
+class FakeJSONLoader:
+    """Stands in for LazyJSONLoader, serving data that tests can replace."""
+
+    def __init__(self, data):
+        self.calls = 0
+        self.error = None
+        self.set_data(data)
+
+    def set_data(self, data):
+        self._data = data
+        self._refreshed = True
+
+    def get(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        refreshed, self._refreshed = self._refreshed, False
+        return self._data, refreshed
+
+
+@pytest.fixture
+def fake_loader_context(test_context):
+    test_context['coinstall_loader'] = FakeJSONLoader({'a': {'b': 1}, 'b': {'a': 1}})
+    test_context['ranking_loader'] = FakeJSONLoader({'a': 100, 'b': 100})
+    return test_context
+
+
+def test_background_mode_serves_requests_without_touching_the_loaders(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context, refresh_mode=REFRESH_MODE_BACKGROUND,
+                                       refresh_interval=3600)
+    coinstall_loader = fake_loader_context['coinstall_loader']
+    calls = coinstall_loader.calls
+    coinstall_loader.set_data({'a': {'b': 1, 'c': 1}, 'b': {'a': 1}, 'c': {'a': 1}})
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('b', 1.0)]
+    assert coinstall_loader.calls == calls
+    app_resource.stop_refresher()
+
+
+def test_refresh_publishes_a_new_generation(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context, refresh_mode=REFRESH_MODE_BACKGROUND,
+                                       refresh_interval=3600)
+    fake_loader_context['coinstall_loader'].set_data({'a': {'b': 1, 'c': 1}, 'b': {'a': 1}, 'c': {'a': 1}})
+    fake_loader_context['ranking_loader'].set_data({'a': 100, 'b': 100, 'c': 200})
+    generation = app_resource.generation
+    app_resource.refresh()
+    assert app_resource.generation > generation
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('c', 1.0), ('b', 1.0)]
+    status = app_resource.refresh_status()
+    assert status['generation'] == app_resource.generation
+    assert status['refresh_mode'] == REFRESH_MODE_BACKGROUND
+    assert status['last_refresh_duration'] >= 0
+    assert status['last_error'] is None
+    app_resource.stop_refresher()
+
+
+def test_failed_refresh_keeps_the_current_generation(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context, refresh_mode=REFRESH_MODE_BACKGROUND,
+                                       refresh_interval=3600)
+    generation = app_resource.generation
+    fake_loader_context['coinstall_loader'].error = IOError('S3 is down')
+    app_resource.refresh()
+    assert app_resource.generation == generation
+    assert 'S3 is down' in app_resource.refresh_status()['last_error']
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('b', 1.0)]
+    app_resource.stop_refresher()
+
+
+def test_rankings_are_not_combined_with_a_graph_pruned_for_previous_rankings(test_context):
+    test_context['coinstall_loader'] = StreamingGraphLoader(test_context, 'addon_list_bucket', 'addon_list_key')
+    app_resource = TaarLiteAppResource(test_context)
+    generation = app_resource.generation
+
+    # The rankings change the row filter, and the graph can not be parsed again
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.Object('addon_list_bucket', 'guid_ranking_key').put(Body=json.dumps({'a': 100, 'b': 1}))
+    conn.Object('addon_list_bucket', 'addon_list_key').put(Body=b'{"a": ')
+    test_context['ranking_loader']._expiry_time = 0
+    app_resource.refresh()
+    assert app_resource.generation == generation
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('b', 1.0)]
+
+    conn.Object('addon_list_bucket', 'addon_list_key').put(Body=json.dumps({'a': {'b': 1}, 'b': {'a': 1}}))
+    app_resource.refresh()
+    assert app_resource.generation > generation
+    assert app_resource.recommend({'guid': 'b'}, limit=4) == []
+
+
+def test_rejected_models_are_not_validated_again(fake_loader_context):
+    fake_loader_context['coinstall_loader'].set_data({'a': {'b': 1}, 'b': {}})
+    validate = GuidGuidCoinstallRecommender.validate_coinstall_dict
+    with patch.object(GuidGuidCoinstallRecommender, 'validate_coinstall_dict', side_effect=validate) as spy:
+        app_resource = TaarLiteAppResource(fake_loader_context)
+        for _ in range(3):
+            assert app_resource.recommend({'guid': 'a'}, limit=4) == []
+        assert spy.call_count == 1
+        assert not app_resource.is_ready()
+        assert 'AsymmetricCoinstallError' in app_resource.refresh_status()['last_error']
+
+        fake_loader_context['coinstall_loader'].set_data({'a': {'b': 1}, 'b': {'a': 1}})
+        assert app_resource.recommend({'guid': 'a'}, limit=4) == [('b', 1.0)]
+        assert spy.call_count == 2
+
+
+def test_refresher_thread_swaps_in_new_generations(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context, refresh_mode=REFRESH_MODE_BACKGROUND,
+                                       refresh_interval=0.01)
+    fake_loader_context['coinstall_loader'].set_data({'a': {'c': 1}, 'c': {'a': 1}})
+    deadline = time.time() + 5
+    while app_resource.recommend({'guid': 'a'}, limit=4) != [('c', 1.0)] and time.time() < deadline:
+        time.sleep(0.01)
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('c', 1.0)]
+    app_resource.stop_refresher()
+
+
+def test_loaders_refreshing_together_trigger_a_single_rebuild(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context)
+    assert app_resource.generation == 1
+    fake_loader_context['coinstall_loader'].set_data({'a': {'c': 1}, 'c': {'a': 1}})
+    fake_loader_context['ranking_loader'].set_data({'a': 100, 'c': 100})
+    assert app_resource.recommend({'guid': 'a'}, limit=4) == [('c', 1.0)]
+    assert app_resource.generation == 2
+
+
+def test_unchanged_models_are_not_rebuilt(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context)
+    coinstall_loader = fake_loader_context['coinstall_loader']
+    coinstall_loader.set_data(coinstall_loader.get()[0])
+    app_resource.refresh()
+    assert app_resource.generation == 1
+
+
+def test_recommend_is_consistent_while_generations_are_swapped(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context, refresh_mode=REFRESH_MODE_BACKGROUND,
+                                       refresh_interval=3600)
+    coinstall_loader = fake_loader_context['coinstall_loader']
+    models = [
+        {'a': {'b': 1}, 'b': {'a': 1}},
+        {'a': {'c': 2}, 'c': {'a': 2}},
+    ]
+    valid_results = [[('b', 1)], [('c', 2)]]
+    stop = threading.Event()
+    errors = []
+
+    def refresher():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            coinstall_loader.set_data(models[i % 2])
+            app_resource.refresh()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                result = app_resource.recommend({'guid': 'a', 'normalize': 'none'}, limit=4)
+                assert result in valid_results
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresher)] + [threading.Thread(target=reader) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert app_resource.generation > 2
+    app_resource.stop_refresher()
+
+
+def test_recommend_many_serves_a_batch_from_one_generation(test_context):
+    app_resource = TaarLiteAppResource(test_context)
+    assert app_resource.recommend_many(['a', 'b', 'z'], normalize='none') == {
+        'a': [('b', 1)],
+        'b': [('a', 1)],
+        'z': [],
+    }
+    assert app_resource.recommend_many(['a'], normalize='NOTARECOMMENDER') == {'a': []}
+
+
+def test_compact_model_serves_the_same_recommendations(fake_loader_context):
+    coinstalls = {'a': {'b': 3, 'c': 1, 'd': 3}, 'b': {'a': 3, 'c': 2}, 'c': {'a': 1, 'b': 2}, 'd': {'a': 3}}
+    rankings = {'a': 150, 'b': 120, 'c': 110, 'd': 130}
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    fake_loader_context['ranking_loader'].set_data(rankings)
+    compact = TaarLiteAppResource(fake_loader_context, compact_model=True)
+    plain = TaarLiteAppResource(fake_loader_context, compact_model=False)
+    assert isinstance(compact._recommenders['none'].raw_coinstall_graph, CoinstallGraph)
+    assert not isinstance(plain._recommenders['none'].raw_coinstall_graph, CoinstallGraph)
+    for norm in ['none', NORM_MODE_ROWCOUNT, NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM]:
+        for guid in coinstalls:
+            for limit in (1, 4, 20):
+                client_data = {'guid': guid, 'normalize': norm}
+                assert compact.recommend(client_data, limit) == plain.recommend(client_data, limit)
+
+
+@pytest.mark.parametrize('compact_model', [True, False])
+def test_parallel_treatments_serve_the_same_recommendations(fake_loader_context, compact_model):
+    coinstalls = {'a': {'b': 3, 'c': 1, 'd': 3}, 'b': {'a': 3, 'c': 2}, 'c': {'a': 1, 'b': 2}, 'd': {'a': 3}}
+    rankings = {'a': 150, 'b': 120, 'c': 110, 'd': 130}
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    fake_loader_context['ranking_loader'].set_data(rankings)
+    serial = TaarLiteAppResource(fake_loader_context, compact_model=compact_model)
+    with patch('taar_lite.app.production.TAAR_TREATMENT_PROCESSES', 2):
+        fake_loader_context['coinstall_loader'].set_data(coinstalls)
+        parallel = TaarLiteAppResource(fake_loader_context, compact_model=compact_model)
+    for norm in ['none', NORM_MODE_ROWCOUNT, NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM]:
+        for guid in coinstalls:
+            for limit in (1, 4, 20):
+                client_data = {'guid': guid, 'normalize': norm}
+                assert parallel.recommend(client_data, limit) == serial.recommend(client_data, limit)
+
+
+def test_lazy_normalizations_are_built_on_first_request(fake_loader_context):
+    coinstalls = {'a': {'b': 3, 'c': 1}, 'b': {'a': 3, 'c': 2}, 'c': {'a': 1, 'b': 2}}
+    rankings = {'a': 150, 'b': 120, 'c': 110}
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    fake_loader_context['ranking_loader'].set_data(rankings)
+    eager = TaarLiteAppResource(fake_loader_context)
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    lazy = TaarLiteAppResource(fake_loader_context,
+                               mode_policy=ModePolicy(frozenset(['none', NORM_MODE_ROWCOUNT]), 0))
+
+    assert lazy.refresh_status()['built_modes'] == [NORM_MODE_ROWSUM, NORM_MODE_ROWNORMSUM]
+    assert list(lazy._recommenders) == list(eager._recommenders)
+    for norm in ['none', NORM_MODE_ROWCOUNT, NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM]:
+        for guid in coinstalls:
+            client_data = {'guid': guid, 'normalize': norm}
+            assert lazy.recommend(client_data, 4) == eager.recommend(client_data, 4)
+    assert lazy.refresh_status()['built_modes'] == list(eager._recommenders)
+
+
+def test_recommenders_are_loaded_from_a_compiled_model_file(fake_loader_context, tmp_path):
+    coinstalls = {'a': {'b': 3, 'c': 1, 'd': 3}, 'b': {'a': 3, 'c': 2}, 'c': {'a': 1, 'b': 2}, 'd': {'a': 3}}
+    rankings = {'a': 150, 'b': 120, 'c': 110, 'd': 130}
+    coinstall_path = tmp_path / 'coinstallation.json'
+    coinstall_path.write_text(json.dumps(coinstalls))
+    ranking_path = tmp_path / 'ranking.json'
+    ranking_path.write_text(json.dumps(rankings))
+    model_path = str(tmp_path / 'taarlite.model')
+    compile_model(str(coinstall_path), str(ranking_path), model_path, precompute_limit=2)
+
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    fake_loader_context['ranking_loader'].set_data(rankings)
+    from_json = TaarLiteAppResource(fake_loader_context)
+    with patch.object(TreatmentPipeline, 'run') as run:
+        from_file = TaarLiteAppResource(fake_loader_context, model_file=model_path)
+    assert not run.called
+    assert from_file.is_ready()
+    for norm in ['none', NORM_MODE_ROWCOUNT, NORM_MODE_ROWNORMSUM, NORM_MODE_ROWSUM]:
+        for guid in coinstalls:
+            for limit in (1, 4):
+                client_data = {'guid': guid, 'normalize': norm}
+                assert from_file.recommend(client_data, limit) == from_json.recommend(client_data, limit)
+
+
+def test_model_files_compiled_with_other_parameters_are_recomputed(fake_loader_context, tmp_path):
+    coinstalls = {'a': {'b': 3, 'c': 1, 'd': 3}, 'b': {'a': 3, 'c': 2}, 'c': {'a': 1, 'b': 2}, 'd': {'a': 3}}
+    rankings = {'a': 150, 'b': 120, 'c': 110, 'd': 130}
+    coinstall_path = tmp_path / 'coinstallation.json'
+    coinstall_path.write_text(json.dumps(coinstalls))
+    ranking_path = tmp_path / 'ranking.json'
+    ranking_path.write_text(json.dumps(rankings))
+    model_path = str(tmp_path / 'taarlite.model')
+    with patch('taar_lite.app.production.TAAR_GUIDCEPTION_DEPTH', 3):
+        compile_model(str(coinstall_path), str(ranking_path), model_path, precompute_limit=2)
+
+    fake_loader_context['coinstall_loader'].set_data(coinstalls)
+    fake_loader_context['ranking_loader'].set_data(rankings)
+    with patch('taar_lite.app.production.TAAR_GUIDCEPTION_DEPTH', 3), \
+            patch('taar_lite.app.production.TAAR_PRECOMPUTE_LIMIT', 2), \
+            patch.object(TreatmentPipeline, 'run') as run:
+        same = TaarLiteAppResource(fake_loader_context, model_file=model_path)
+    assert not run.called
+    assert same._recommenders[NORM_MODE_GUIDCEPTION].precompute_limit == 2
+
+    with patch('taar_lite.app.production.TAAR_GUIDCEPTION_DEPTH', 3), \
+            patch.object(TreatmentPipeline, 'run') as run:
+        other_limit = TaarLiteAppResource(fake_loader_context, model_file=model_path)
+    assert not run.called
+    assert other_limit._recommenders[NORM_MODE_GUIDCEPTION].precompute_limit == 10
+
+    with patch('taar_lite.app.production.TAAR_GUIDCEPTION_DEPTH', 3), \
+            patch('taar_lite.app.production.TAAR_GUIDCEPTION_DAMPING', 0.25):
+        from_json = TaarLiteAppResource(fake_loader_context)
+        with patch.object(TreatmentPipeline, 'run', autospec=True, side_effect=TreatmentPipeline.run) as run:
+            from_file = TaarLiteAppResource(fake_loader_context, model_file=model_path)
+    assert run.called
+    for guid in coinstalls:
+        client_data = {'guid': guid, 'normalize': NORM_MODE_GUIDCEPTION}
+        assert from_file.recommend(client_data, 4) == from_json.recommend(client_data, 4)
+
+
+def test_s3_models_are_streamed_into_a_pruned_graph(test_context):
+    coinstalls = {'a': {'b': 3, 'c': 1}, 'b': {'a': 3}, 'c': {'a': 1}}
+    rankings = {'a': 1000, 'b': 1000, 'c': 1}
+    conn = boto3.resource('s3', region_name='us-west-2')
+    conn.create_bucket(Bucket=ADDON_LIST_BUCKET)
+    conn.Object(ADDON_LIST_BUCKET, ADDON_LIST_KEY).put(Body=json.dumps(coinstalls))
+    conn.Object(ADDON_LIST_BUCKET, GUID_RANKING_KEY).put(Body=json.dumps(rankings))
+    del test_context['coinstall_loader']
+    del test_context['ranking_loader']
+
+    compact = TaarLiteAppResource(test_context, compact_model=True)
+    plain = TaarLiteAppResource(test_context, compact_model=False)
+    assert compact._addons_coinstallations == {'a': {'b': 3, 'c': 1}, 'b': {'a': 3}}
+    for guid in coinstalls:
+        assert compact.recommend({'guid': guid}, limit=4) == plain.recommend({'guid': guid}, limit=4)
+
+
+def test_asymmetric_coinstallations_are_not_published(fake_loader_context):
+    app_resource = TaarLiteAppResource(fake_loader_context)
+    generation = app_resource.generation
+    fake_loader_context['coinstall_loader'].set_data({'a': {'b': 1}, 'b': {'a': 2}})
+    app_resource.refresh()
+    assert app_resource.generation == generation
+    assert 'a -> b: 1.0 != 2.0' in app_resource.refresh_status()['last_error']
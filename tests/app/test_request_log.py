@@ -0,0 +1,89 @@
+import logging
+
+from taar_lite.app.request_log import RequestLog, log_asynchronously
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class Unformattable:
+
+    def __str__(self):
+        raise AssertionError("Formatted a dropped record")
+
+
+def recording_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+def test_request_log_formats_the_recommendations():
+    logger, handler = recording_logger('test_request_log.format')
+    RequestLog(logger).log('a', [('b', 1.0)])
+    assert handler.messages == ["Addon: [a] triggered these recommendation guids: [[\"('b', 1.0)\"]]"]
+
+
+def test_request_log_samples_requests():
+    logger, handler = recording_logger('test_request_log.sample')
+    request_log = RequestLog(logger, sample_rate=3)
+    for i in range(7):
+        request_log.log(str(i), [])
+    assert [message[8] for message in handler.messages] == ['0', '3', '6']
+
+    RequestLog(logger, sample_rate=0).log('a', [Unformattable()])
+    assert len(handler.messages) == 3
+
+
+def test_dropped_records_are_not_formatted():
+    logger, handler = recording_logger('test_request_log.lazy')
+    logger.setLevel(logging.WARNING)
+    RequestLog(logger).log('a', [Unformattable()])
+    assert handler.messages == []
+
+
+def test_deferred_recommendations_are_only_computed_for_emitted_records():
+    calls = []
+
+    def recommend(guid, limit):
+        calls.append((guid, limit))
+        return [('b', 1.0)]
+
+    logger, handler = recording_logger('test_request_log.deferred')
+    request_log = RequestLog(logger, sample_rate=2)
+    for _ in range(4):
+        request_log.log_deferred('a', recommend, 'a', 4)
+    assert calls == [('a', 4)] * 2
+    assert handler.messages == ["Addon: [a] triggered these recommendation guids: [[\"('b', 1.0)\"]]"] * 2
+
+    RequestLog(logger, sample_rate=0).log_deferred('a', recommend, 'a', 4)
+    logger.setLevel(logging.WARNING)
+    RequestLog(logger).log_deferred('a', recommend, 'a', 4)
+    assert len(calls) == 2
+
+
+def test_records_are_emitted_by_a_background_thread():
+    parent, handler = recording_logger('test_request_log.async')
+    logger = logging.getLogger('test_request_log.async.child')
+    queue_handler = log_asynchronously(logger, queue_size=4)
+    assert log_asynchronously(logger) is queue_handler
+    assert logger.handlers == [queue_handler]
+
+    RequestLog(logger).log('a', [('b', 1.0)])
+    queue_handler.listener.stop()
+    assert handler.messages == ["Addon: [a] triggered these recommendation guids: [[\"('b', 1.0)\"]]"]
+
+    # A full queue drops records instead of blocking
+    for i in range(6):
+        logger.info('record %d', i)
+    assert queue_handler.dropped == 2
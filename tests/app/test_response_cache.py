@@ -0,0 +1,36 @@
+from taar_lite.app.response_cache import ResponseCache
+
+
+def test_cache_evicts_least_recently_used_entries():
+    cache = ResponseCache(2)
+    cache.put(1, 'a', b'a')
+    cache.put(1, 'b', b'b')
+    assert cache.get(1, 'a') == b'a'
+    cache.put(1, 'c', b'c')
+    assert cache.get(1, 'b') is None
+    assert cache.get(1, 'a') == b'a'
+    assert cache.get(1, 'c') == b'c'
+    assert cache.stats() == {
+        'size': 2,
+        'max_size': 2,
+        'hits': 3,
+        'misses': 1,
+        'evictions': 1,
+        'invalidations': 0,
+    }
+
+
+def test_cache_is_invalidated_when_the_token_changes():
+    cache = ResponseCache(2)
+    cache.put(1, 'a', b'a')
+    assert cache.get(2, 'a') is None
+    assert cache.stats()['invalidations'] == 1
+    cache.put(2, 'a', b'new a')
+    assert cache.get(2, 'a') == b'new a'
+
+
+def test_cache_of_size_zero_is_disabled():
+    cache = ResponseCache(0)
+    cache.put(1, 'a', b'a')
+    assert cache.get(1, 'a') is None
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,167 @@
+import random
+
+import pytest
+
+from taar_lite.recommenders.delta import CoinstallDelta
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.guidguid import GuidGuidCoinstallRecommender
+from taar_lite.recommenders.treatments import (
+    ColumnStats,
+    MinInstallPrune,
+    NoTreatment,
+    RowCount,
+    RowNormSum,
+    RowSum
+)
+
+TREATMENTS = [NoTreatment, RowCount, RowNormSum, RowSum]
+
+
+def random_graph(rng, guids):
+    graph = {}
+    for guid in guids:
+        others = [other for other in guids if other != guid]
+        graph[guid] = {other: rng.randint(1, 50) for other in rng.sample(others, rng.randint(1, 5))}
+    return graph
+
+
+def random_delta(rng, graph, rankings, num_rows, num_rankings=0):
+    guids = list(graph)
+    new_guids = ['new-{}'.format(rng.random()) for _ in range(2)]
+    changed_rows = {}
+    for guid in rng.sample(guids, num_rows) + new_guids:
+        others = [other for other in guids + new_guids if other != guid]
+        changed_rows[guid] = {other: rng.randint(1, 50) for other in rng.sample(others, rng.randint(1, 5))}
+    removed_rows = [guid for guid in rng.sample(guids, 2) if guid not in changed_rows]
+
+    changed_rankings = {}
+    for guid in rng.sample(guids, num_rankings):
+        changed_rankings[guid] = rng.randint(0, 5000)
+    return CoinstallDelta(changed_rows, removed_rows, changed_rankings)
+
+
+def build(graph, rankings, treatment_class):
+    return GuidGuidCoinstallRecommender(
+        graph,
+        treatments=[MinInstallPrune(), treatment_class()],
+        treatment_kwargs={'ranking_dict': rankings},
+        tie_breaker_dict=rankings,
+        validate_raw_coinstall_dict=False,
+        precompute_limit=3
+    )
+
+
+def assert_same_recommender(incremental, full):
+    assert list(incremental.raw_coinstall_graph.items()) == list(full.raw_coinstall_graph.items())
+    assert incremental.tie_breaker_dict == full.tie_breaker_dict
+    assert incremental.treatments[0].min_installs == full.treatments[0].min_installs
+    # Compare in order, so that full ties rank the same way too
+    assert list(incremental.treated_graph.items()) == list(full.treated_graph.items())
+    assert list(incremental.top_n_table.items()) == list(full.top_n_table.items())
+
+
+@pytest.fixture
+def rng():
+    return random.Random(7)
+
+
+@pytest.fixture
+def graph(rng):
+    return random_graph(rng, ['guid-{}'.format(i) for i in range(40)])
+
+
+@pytest.fixture
+def rankings(rng, graph):
+    return {guid: rng.randint(0, 5000) for guid in graph}
+
+
+def test_between_and_apply_round_trip(graph, rankings, rng):
+    delta = random_delta(rng, graph, rankings, 3, 2)
+    new_graph = delta.apply_to_graph(graph)
+    new_rankings = delta.apply_to_rankings(rankings)
+
+    round_trip = CoinstallDelta.between(graph, new_graph, rankings, new_rankings)
+    assert round_trip.changed_rows == delta.changed_rows
+    assert round_trip.removed_rows == delta.removed_rows
+    assert round_trip.rankings == delta.rankings
+    assert round_trip.apply_to_graph(graph) == new_graph
+    assert len(round_trip) == len(delta)
+
+
+def test_delta_rejects_rows_both_changed_and_removed():
+    with pytest.raises(ValueError):
+        CoinstallDelta({'a': {'b': 1}}, ['a'])
+
+
+def test_apply_to_coinstall_graph_matches_dict(graph, rankings, rng):
+    delta = random_delta(rng, graph, rankings, 3)
+    new_graph = delta.apply_to_graph(CoinstallGraph.from_dict(graph))
+    assert isinstance(new_graph, CoinstallGraph)
+    assert new_graph.to_dict() == delta.apply_to_graph(graph)
+
+
+@pytest.mark.parametrize('treatment_class', TREATMENTS)
+@pytest.mark.parametrize('num_rankings', [0, 3])
+def test_incremental_matches_full_rebuild(graph, rankings, rng, treatment_class, num_rankings):
+    recommender = build(graph, rankings, treatment_class)
+    # Successive deltas each build on the incremental state of the last
+    for _ in range(5):
+        delta = random_delta(rng, graph, rankings, 2, num_rankings)
+        graph = delta.apply_to_graph(graph)
+        rankings = delta.apply_to_rankings(rankings)
+
+        recommender = recommender.with_delta(delta)
+        if treatment_class is not NoTreatment:
+            assert recommender._steps[1][2].changed_columns is not None
+        assert_same_recommender(recommender, build(graph, rankings, treatment_class))
+
+
+def test_incremental_recomputes_only_affected_columns(graph, rankings, rng):
+    recommender = build(graph, rankings, RowSum)
+    delta = CoinstallDelta({'guid-0': dict(graph['guid-0'], **{'guid-1': 1000})})
+    updated = recommender.with_delta(delta)
+
+    column_stats = updated._steps[1][2]
+    assert column_stats.changed_columns == {'guid-1'} | set(graph['guid-0'])
+    assert column_stats.sums == ColumnStats(updated._steps[1][0]).compute().sums
+
+
+def test_large_delta_rebuilds_from_scratch(graph, rankings, rng):
+    recommender = build(graph, rankings, RowNormSum)
+    delta = random_delta(rng, graph, rankings, 20)
+    updated = recommender.with_delta(delta, max_changed_fraction=0.1)
+    assert updated._steps[1][2].changed_columns is None
+    assert_same_recommender(updated, build(delta.apply_to_graph(graph), rankings, RowNormSum))
+
+
+def test_with_delta_leaves_the_recommender_unchanged(graph, rankings, rng):
+    recommender = build(graph, rankings, RowCount)
+    before = build(graph, rankings, RowCount)
+    recommender.with_delta(random_delta(rng, graph, rankings, 2, 30))
+    assert_same_recommender(recommender, before)
+
+
+def test_with_delta_on_coinstall_graph(graph, rankings, rng):
+    recommender = build(CoinstallGraph.from_dict(graph), rankings, RowNormSum)
+    delta = random_delta(rng, graph, rankings, 2, 2)
+    updated = recommender.with_delta(delta)
+
+    full = build(CoinstallGraph.from_dict(delta.apply_to_graph(graph)), delta.apply_to_rankings(rankings), RowNormSum)
+    assert dict(updated.top_n_table) == dict(full.top_n_table)
+
+
+def test_min_install_threshold_updates_incrementally(rankings, rng):
+    prune = MinInstallPrune()
+    prune._set_min_install_threshold(rankings)
+
+    new_rankings = dict(rankings)
+    for guid in rng.sample(list(rankings), 5):
+        new_rankings[guid] = rng.randint(0, 5000)
+    del new_rankings['guid-3']
+    new_rankings['new'] = 12
+    changed_rankings = CoinstallDelta.between({}, {}, rankings, new_rankings).ranking_guids
+    prune._update_min_install_threshold(new_rankings, rankings, changed_rankings)
+
+    expected = MinInstallPrune()
+    expected._set_min_install_threshold(new_rankings)
+    assert prune.min_installs == expected.min_installs
@@ -0,0 +1,85 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+
+from taar_lite.recommenders.graph import CoinstallGraph, CoinstallGraphBuilder
+
+
+@pytest.fixture
+def coinstall_dict():
+    return {
+        'a': {'b': 10, 'c': 13},
+        'b': {'a': 10, 'c': 4, 'd': 1},
+        'c': {'a': 13, 'b': 4},
+    }
+
+
+def test_graph_round_trips_the_dict_format(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    assert graph.to_dict() == coinstall_dict
+    assert graph == coinstall_dict
+    assert list(graph) == ['a', 'b', 'c']
+    assert len(graph) == 3
+
+
+def test_guids_without_a_row_are_indexed_but_not_contained(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    assert graph.vocabulary == ['a', 'b', 'c', 'd']
+    assert 'd' not in graph
+    assert 'e' not in graph
+    with pytest.raises(KeyError):
+        graph['d']
+
+
+def test_row_returns_vocabulary_indices_and_weights(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    indices, weights = graph.row('b')
+    assert indices.tolist() == [0, 2, 3]
+    assert weights.tolist() == [10, 4, 1]
+
+
+def test_select_rows_drops_rows_and_keeps_vocabulary(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    pruned = graph.select_rows(np.array([True, False, True, True]))
+    assert pruned == {'a': {'b': 10, 'c': 13}, 'c': {'a': 13, 'b': 4}}
+    assert pruned.vocabulary is graph.vocabulary
+
+
+def test_with_data_shares_the_graph_structure(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    doubled = graph.with_data(graph.matrix.data * 2)
+    assert doubled['a'] == {'b': 20, 'c': 26}
+    assert np.shares_memory(doubled.matrix.indices, graph.matrix.indices)
+    assert np.shares_memory(doubled.matrix.indptr, graph.matrix.indptr)
+
+
+def test_vectors_are_shared_by_derived_graphs(coinstall_dict):
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    rankings = {'a': 3, 'b': 2}
+    vector = graph.vector(rankings)
+    assert vector.tolist() == [3, 2, 0, 0]
+    assert graph.with_data(graph.matrix.data * 2).vector(rankings) is vector
+    assert graph.select_rows(graph.row_mask).vector(rankings) is vector
+    assert graph.vector(rankings, default=1).tolist() == [3, 2, 1, 1]
+
+
+def test_vocabulary_guids_are_interned():
+    coinstall_dict = json.loads('{"guid_a": {"guid_b": 1}, "guid_b": {"guid_a": 1, "guid_c": 1}}')
+    graph = CoinstallGraph.from_dict(coinstall_dict)
+    for guid in graph.vocabulary:
+        assert sys.intern(''.join(guid)) is guid
+
+
+def test_builder_accepts_rows_in_any_order():
+    builder = CoinstallGraphBuilder()
+    builder.add_row('a', {'c': 1, 'b': 2})
+    builder.add_row('c', {'a': 1})
+    builder.add_row('b', {'a': 2})
+    graph = builder.build()
+    assert graph.vocabulary == ['a', 'c', 'b']
+    assert graph == {'a': {'c': 1, 'b': 2}, 'b': {'a': 2}, 'c': {'a': 1}}
+    assert graph.row('a')[0].tolist() == [1, 2]
+    with pytest.raises(ValueError):
+        builder.add_row('a', {})
@@ -1,7 +1,8 @@
 import pytest
 
-from taar_lite.recommenders.guidguid import GuidGuidCoinstallRecommender
-from taar_lite.recommenders.treatments import NoTreatment
+from taar_lite.recommenders.graph import CoinstallGraph, TopNTable
+from taar_lite.recommenders.guidguid import AsymmetricCoinstallError, GuidGuidCoinstallRecommender
+from taar_lite.recommenders.treatments import NoTreatment, RowNormSum
 
 
 @pytest.fixture
@@ -27,7 +28,8 @@ def recommender(coinstall_dict, ranking_dict):
     return GuidGuidCoinstallRecommender(
         raw_coinstall_dict=coinstall_dict,
         treatments=[NoTreatment()],
-        tie_breaker_dict=ranking_dict
+        tie_breaker_dict=ranking_dict,
+        lex_scores=True
     )
 
 
@@ -64,3 +66,124 @@ def test_get_recommend_graph_returns_complete_rec_graph(recommender):
         'b': [('c', '000000001.0000000000.0000000090')],
         'c': [('b', '000000001.0000000000.0000000100')],
     }
+
+
+@pytest.fixture
+def precomputed_recommender(coinstall_dict, ranking_dict):
+    return GuidGuidCoinstallRecommender(
+        raw_coinstall_dict=coinstall_dict,
+        treatments=[NoTreatment()],
+        tie_breaker_dict=ranking_dict,
+        precompute_limit=1,
+        lex_scores=True
+    )
+
+
+def test_top_n_table_is_not_built_by_default(recommender):
+    assert recommender.precompute_limit is None
+    assert recommender.top_n_table is None
+
+
+def test_top_n_table_is_built_with_the_treatment_graph(precomputed_recommender):
+    assert precomputed_recommender.top_n_table == {
+        'a': [('b', '000000001.0000000000.0000000100')],
+        'b': [('c', '000000001.0000000000.0000000090')],
+        'c': [('b', '000000001.0000000000.0000000100')],
+    }
+
+
+def test_precomputed_recommend_matches_live_recommend(recommender, precomputed_recommender):
+    for guid in ['a', 'b', 'c', 'd']:
+        for limit in [0, 1, 2, 10]:
+            assert precomputed_recommender.recommend(guid, limit) == recommender.recommend(guid, limit)
+
+
+def test_precomputed_recommend_falls_back_when_limit_exceeds_depth(precomputed_recommender):
+    assert len(precomputed_recommender.recommend('a', 2)) == 2
+
+
+def test_precomputed_recommend_without_limit_returns_every_recommendation(recommender, precomputed_recommender):
+    for guid in ['a', 'b', 'c', 'd']:
+        assert precomputed_recommender.recommend(guid, None) == recommender.recommend(guid, None)
+    assert len(precomputed_recommender.recommend('a', None)) == 2
+
+
+def test_recommend_returns_numeric_weights_by_default(coinstall_dict, ranking_dict):
+    recommender = GuidGuidCoinstallRecommender(
+        raw_coinstall_dict=coinstall_dict,
+        treatments=[NoTreatment()],
+        tie_breaker_dict=ranking_dict
+    )
+    assert recommender.recommend('a', limit=2) == [('b', 1), ('c', 1)]
+
+
+def test_numeric_ranking_orders_negative_and_large_weights():
+    weights = {'neg_small': -1, 'neg_large': -10, 'large': 10 ** 12, 'small': 10 ** 9}
+    recommender = GuidGuidCoinstallRecommender(
+        raw_coinstall_dict={'a': weights},
+        treatments=[NoTreatment()],
+        validate_raw_coinstall_dict=False
+    )
+    assert [guid for guid, _ in recommender.recommend('a', limit=4)] == [
+        'large', 'small', 'neg_small', 'neg_large'
+    ]
+    assert [guid for guid, _ in recommender.recommend('a', limit=2)] == ['large', 'small']
+
+
+@pytest.mark.parametrize('lex_scores', [False, True])
+def test_graph_backed_recommender_matches_dict_recommender(coinstall_dict, ranking_dict, lex_scores):
+    coinstall_dict['a']['b'] = 3
+    coinstall_dict['b']['a'] = 3
+
+    def get_recommender(coinstalls, precompute_limit=None):
+        return GuidGuidCoinstallRecommender(
+            raw_coinstall_dict=coinstalls,
+            treatments=[RowNormSum()],
+            tie_breaker_dict=ranking_dict,
+            precompute_limit=precompute_limit,
+            lex_scores=lex_scores
+        )
+
+    dict_recommender = get_recommender(coinstall_dict)
+    graph_recommender = get_recommender(CoinstallGraph.from_dict(coinstall_dict))
+    precomputed_graph_recommender = get_recommender(CoinstallGraph.from_dict(coinstall_dict), 1)
+    assert isinstance(graph_recommender.treated_graph, CoinstallGraph)
+    for limit in [0, 1, 2, 10]:
+        expected = dict_recommender.get_recommendation_graph(limit)
+        assert graph_recommender.get_recommendation_graph(limit) == expected
+        assert precomputed_graph_recommender.get_recommendation_graph(limit) == expected
+    assert graph_recommender.recommend('d', 2) == []
+    assert isinstance(precomputed_graph_recommender.top_n_table, TopNTable)
+    assert precomputed_graph_recommender.top_n_table == {
+        guid: dict_recommender.recommend(guid, 1) for guid in coinstall_dict
+    }
+
+
+def test_recommend_many_matches_recommend(recommender):
+    assert recommender.recommend_many(['a', 'c', 'd'], limit=1) == {
+        'a': recommender.recommend('a', 1),
+        'c': recommender.recommend('c', 1),
+        'd': [],
+    }
+
+
+@pytest.mark.parametrize('as_graph', [False, True])
+def test_validation_reports_asymmetric_pairs(as_graph):
+    coinstalls = {
+        'a': {'b': 1, 'c': 2, 'e': 5},
+        'b': {'a': 1, 'c': 3},
+        'c': {'a': 2.5},
+        'd': {},
+    }
+    if as_graph:
+        coinstalls = CoinstallGraph.from_dict(coinstalls)
+    with pytest.raises(AsymmetricCoinstallError) as excinfo:
+        GuidGuidCoinstallRecommender(raw_coinstall_dict=coinstalls, treatments=[NoTreatment()])
+    # Edges to 'e', which has no row, are not checked
+    assert excinfo.value.pairs == [('a', 'c', 2.0, 2.5), ('b', 'c', 3.0, None)]
+    assert isinstance(excinfo.value, AssertionError)
+
+
+def test_validation_accepts_symmetric_graphs(coinstall_dict):
+    GuidGuidCoinstallRecommender.validate_coinstall_dict(coinstall_dict)
+    GuidGuidCoinstallRecommender.validate_coinstall_dict(CoinstallGraph.from_dict(coinstall_dict))
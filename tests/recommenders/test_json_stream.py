@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.json_stream import graph_from_json_stream, iter_object_items
+
+
+@pytest.fixture
+def coinstall_dict():
+    return {
+        'a': {'b': 10, 'c': 13.5},
+        'b': {'a': 10, 'c': 4, 'd': 1},
+        'c': {'a': 13.5, 'b': 4},
+        'we"ird {guid}\\': {'a': 1e-3},
+    }
+
+
+def chunked(text, size):
+    return [text[i:i + size].encode('utf-8') for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 64, 4096])
+def test_rows_are_parsed_across_chunk_boundaries(coinstall_dict, chunk_size):
+    text = json.dumps(coinstall_dict, indent=2)
+    assert dict(iter_object_items(chunked(text, chunk_size))) == coinstall_dict
+    assert graph_from_json_stream(chunked(text, chunk_size)) == CoinstallGraph.from_dict(coinstall_dict)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4096])
+def test_filtered_rows_are_skipped(coinstall_dict, chunk_size):
+    text = json.dumps(coinstall_dict)
+    parsed = []
+
+    def keep(guid):
+        parsed.append(guid)
+        return guid in ('b', 'we"ird {guid}\\')
+
+    graph = graph_from_json_stream(chunked(text, chunk_size), keep)
+    assert parsed == list(coinstall_dict)
+    assert graph == {'b': coinstall_dict['b'], 'we"ird {guid}\\': coinstall_dict['we"ird {guid}\\']}
+    # Guids coinstalled with a kept row are still indexed
+    assert set(graph.vocabulary) == {'a', 'b', 'c', 'd', 'we"ird {guid}\\'}
+
+
+def test_multibyte_characters_split_across_chunks():
+    text = json.dumps({'guïd': {'☃': 1}}, ensure_ascii=False)
+    assert dict(iter_object_items(chunked(text, 1))) == {'guïd': {'☃': 1}}
+
+
+def test_empty_object():
+    assert list(iter_object_items(['{ }'])) == []
+
+
+@pytest.mark.parametrize('text', ['', '[1]', '{"a": 1', '{"a" 1}', '{"a": 1}x', '{"a": {"b": 1}'])
+def test_malformed_documents_raise_value_error(text):
+    with pytest.raises(ValueError):
+        list(iter_object_items(chunked(text, 2)))
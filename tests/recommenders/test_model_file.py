@@ -0,0 +1,128 @@
+from collections import OrderedDict
+import struct
+
+import numpy as np
+import pytest
+
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.model_file import ArrayFile, ModelFile, ModelFileError, write_array_file, write_model_file
+from taar_lite.recommenders.pipeline import TreatmentPipeline
+from taar_lite.recommenders.treatments import MinInstallPrune, NoTreatment, RowNormSum
+
+
+@pytest.fixture
+def coinstall_graph():
+    return CoinstallGraph.from_dict({
+        'a': {'b': 3, 'c': 1, 'd': 3},
+        'b': {'a': 3, 'c': 2},
+        'c': {'a': 1, 'b': 2},
+        'd': {'a': 3},
+    })
+
+
+@pytest.fixture
+def ranking_dict():
+    return {'a': 150, 'b': 120, 'c': 110, 'd': 130, 'not_in_graph': 1}
+
+
+def build_recommenders(graph, ranking_dict):
+    pipeline = TreatmentPipeline(prefix=[], branches={'none': NoTreatment(), 'rownorm_sum': RowNormSum()})
+    return pipeline.build_recommenders(graph, tie_breaker_dict=ranking_dict, precompute_limit=2)
+
+
+def test_model_file_round_trips_the_models(tmp_path, coinstall_graph, ranking_dict):
+    path = str(tmp_path / 'model')
+    write_model_file(path, coinstall_graph, ranking_dict)
+    model_file = ModelFile(path)
+    assert model_file.graph == coinstall_graph
+    assert model_file.graph.vocabulary == coinstall_graph.vocabulary
+    assert model_file.rankings == ranking_dict
+    assert model_file.treated_graphs == {}
+
+
+def test_model_file_keeps_the_rankings_of_guids_outside_the_graph(tmp_path, coinstall_graph):
+    ranking_dict = {'a': 150, 'b': 120, 'c': 110, 'd': 130, 'e': 10000, 'f': 20000}
+    path = str(tmp_path / 'model')
+    write_model_file(path, coinstall_graph, ranking_dict)
+    model_file = ModelFile(path)
+    assert model_file.rankings == ranking_dict
+
+    # The install threshold is computed from every ranking, so the file
+    # prunes the same rows as the JSON models
+    def build(graph, rankings):
+        pipeline = TreatmentPipeline(prefix=[MinInstallPrune()], branches={'none': NoTreatment()},
+                                     treatment_kwargs={'ranking_dict': rankings})
+        return pipeline.build_recommenders(graph, tie_breaker_dict=rankings)
+
+    from_file = build(model_file.graph, model_file.rankings)
+    from_dict = build(coinstall_graph, ranking_dict)
+    assert from_file['none'].treated_graph == from_dict['none'].treated_graph
+    assert len(from_file['none'].treated_graph) < len(coinstall_graph)
+
+
+def test_model_file_maps_the_edge_arrays(tmp_path, coinstall_graph, ranking_dict):
+    path = str(tmp_path / 'model')
+    write_model_file(path, coinstall_graph, ranking_dict)
+    matrix = ModelFile(path).graph.matrix
+    for array in (matrix.data, matrix.indices, matrix.indptr):
+        assert not array.flags.writeable
+        assert not array.flags.owndata
+
+
+def test_model_file_stores_treated_graphs_and_top_n_tables(tmp_path, coinstall_graph, ranking_dict):
+    recommenders = build_recommenders(coinstall_graph, ranking_dict)
+    path = str(tmp_path / 'model')
+    write_model_file(path, coinstall_graph, ranking_dict, recommenders)
+
+    model_file = ModelFile(path)
+    assert list(model_file.treated_graphs) == ['none', 'rownorm_sum']
+    for name, recommender in recommenders.items():
+        assert model_file.treated_graphs[name] == recommender.treated_graph
+        assert model_file.top_n_table(name) == recommender.top_n_table
+    # The untreated branch shares its arrays with the raw graph
+    sections = model_file._header['recommenders']['none']['graph']
+    assert sections == model_file._header['graph']
+
+
+def test_model_file_stores_the_parameters_of_its_recommenders(tmp_path, coinstall_graph, ranking_dict):
+    path = str(tmp_path / 'model')
+    write_model_file(path, coinstall_graph, ranking_dict)
+    assert ModelFile(path).parameters is None
+
+    parameters = {'treatments': {'branches': {'guidception': {'depth': 3, 'damping': 0.25}}}, 'precompute_limit': 2}
+    write_model_file(path, coinstall_graph, ranking_dict, build_recommenders(coinstall_graph, ranking_dict), parameters)
+    assert ModelFile(path).parameters == parameters
+
+
+def test_model_file_rejects_other_versions(tmp_path, coinstall_graph, ranking_dict):
+    path = tmp_path / 'model'
+    write_model_file(str(path), coinstall_graph, ranking_dict)
+    contents = bytearray(path.read_bytes())
+    struct.pack_into('<I', contents, 8, 99)
+    path.write_bytes(bytes(contents))
+    with pytest.raises(ModelFileError):
+        ModelFile(str(path))
+
+    path.write_bytes(b'not a model file')
+    with pytest.raises(ModelFileError):
+        ModelFile(str(path))
+
+
+def test_model_file_rejects_non_integer_rankings(tmp_path, coinstall_graph):
+    with pytest.raises(ModelFileError):
+        write_model_file(str(tmp_path / 'model'), coinstall_graph, {'a': 1.5})
+
+
+def test_array_files_map_their_arrays_read_only(tmp_path):
+    data = np.arange(6, dtype=np.float64)
+    path = str(tmp_path / 'arrays')
+    write_array_file(path, OrderedDict([('data', data), ('view', data), ('empty', np.zeros(0, dtype=np.int32))]),
+                     {'vocabulary': ['a', 'b']})
+
+    arrays = ArrayFile(path)
+    assert arrays['data'].tolist() == data.tolist()
+    assert not arrays['data'].flags.writeable
+    # Arrays that share memory are stored once
+    assert np.shares_memory(arrays['data'], arrays['view'])
+    assert arrays['empty'].dtype == np.int32 and arrays['empty'].size == 0
+    assert arrays.guids('vocabulary') == ['a', 'b']
@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import logging
+import threading
+
+from mock import patch
+import numpy as np
+import pytest
+
+from taar_lite.recommenders import pipeline
+from taar_lite.recommenders.graph import CoinstallGraph
+from taar_lite.recommenders.guidguid import GuidGuidCoinstallRecommender
+from taar_lite.recommenders.pipeline import TreatmentPipeline
+from taar_lite.recommenders.treatments import (
+    ColumnStats,
+    MinInstallPrune,
+    NoTreatment,
+    RowCount,
+    RowNormSum,
+    RowSum,
+)
+
+
+@pytest.fixture
+def coinstall_dict():
+    return {
+        'a': {'b': 10, 'c': 13, 'd': 1},
+        'b': {'a': 10, 'c': 4},
+        'c': {'a': 13, 'b': 4, 'd': 2},
+        'd': {'a': 1, 'c': 2},
+    }
+
+
+@pytest.fixture
+def ranking_dict():
+    return {'a': 100, 'b': 90, 'c': 80, 'd': 1}
+
+
+def get_pipeline(ranking_dict, processes=0, **treatment_kwargs):
+    return TreatmentPipeline(
+        prefix=[MinInstallPrune()],
+        branches=OrderedDict([
+            ('none', NoTreatment()),
+            ('row_count', RowCount()),
+            ('row_sum', RowSum()),
+            ('rownorm_sum', RowNormSum()),
+        ]),
+        treatment_kwargs=dict(treatment_kwargs, ranking_dict=ranking_dict),
+        processes=processes
+    )
+
+
+@pytest.mark.parametrize('to_graph', [dict, CoinstallGraph.from_dict])
+def test_pipeline_recommenders_match_individual_recommenders(coinstall_dict, ranking_dict, to_graph):
+    pipeline = get_pipeline(ranking_dict)
+    recommenders = pipeline.build_recommenders(to_graph(coinstall_dict), tie_breaker_dict=ranking_dict)
+    assert list(recommenders) == list(pipeline.branches)
+    for name, treatment in pipeline.branches.items():
+        expected = GuidGuidCoinstallRecommender(
+            raw_coinstall_dict=coinstall_dict,
+            treatments=[MinInstallPrune(), treatment],
+            treatment_kwargs={'ranking_dict': ranking_dict},
+            tie_breaker_dict=ranking_dict
+        )
+        treated_graph = recommenders[name].treated_graph
+        assert list(treated_graph) == list(expected.treated_graph)
+        for guid, coinstalls in expected.treated_graph.items():
+            assert treated_graph[guid] == pytest.approx(coinstalls)
+        assert len(recommenders[name].treatments) == 2
+        assert recommenders[name].treatments[1] is treatment
+
+
+def test_pipeline_reports_stage_timings(coinstall_dict, ranking_dict):
+    pipeline = get_pipeline(ranking_dict)
+    pipeline.build_recommenders(coinstall_dict)
+    assert list(pipeline.timings) == [
+        'prefix.MinInstallPrune',
+        'column_stats',
+        'branch.none',
+        'branch.row_count',
+        'branch.row_sum',
+        'branch.rownorm_sum',
+        'recommender.none',
+        'recommender.row_count',
+        'recommender.row_sum',
+        'recommender.rownorm_sum',
+    ]
+    assert all(seconds >= 0 for seconds in pipeline.timings.values())
+
+
+def test_column_stats_are_only_reused_for_the_graph_they_describe(coinstall_dict):
+    column_stats = ColumnStats(coinstall_dict)
+    assert ColumnStats.for_graph(coinstall_dict, column_stats=column_stats) is column_stats
+    assert ColumnStats.for_graph(dict(coinstall_dict), column_stats=column_stats) is not column_stats
+    assert column_stats.sums == {'a': 24, 'b': 14, 'c': 19, 'd': 3}
+    assert column_stats.counts == {'a': 3, 'b': 2, 'c': 3, 'd': 2}
+
+
+@pytest.mark.parametrize('to_graph', [dict, CoinstallGraph.from_dict])
+@pytest.mark.parametrize('lex_scores', [False, True])
+def test_forked_branches_match_serial_branches(coinstall_dict, ranking_dict, to_graph, lex_scores):
+    raw_graph = to_graph(coinstall_dict)
+    kwargs = dict(tie_breaker_dict=ranking_dict, precompute_limit=2, lex_scores=lex_scores)
+    expected = get_pipeline(ranking_dict).build_recommenders(raw_graph, **kwargs)
+    pipeline = get_pipeline(ranking_dict, processes=2)
+    recommenders = pipeline.build_recommenders(raw_graph, **kwargs)
+
+    assert list(recommenders) == list(expected)
+    for name, recommender in recommenders.items():
+        assert recommender.raw_coinstall_graph is raw_graph
+        assert recommender.treatments[1] is pipeline.branches[name]
+        assert recommender.precompute_limit == 2
+        assert dict(recommender.treated_graph) == dict(expected[name].treated_graph)
+        assert dict(recommender.top_n_table) == dict(expected[name].top_n_table)
+        for guid in coinstall_dict:
+            assert recommender.recommend(guid, 3) == expected[name].recommend(guid, 3)
+
+    assert 'branch.rownorm_sum' in pipeline.timings
+    assert 'recommender.rownorm_sum' in pipeline.timings
+    assert 'branches' in pipeline.timings
+
+
+def test_concurrent_builds_in_worker_processes_keep_their_own_inputs(coinstall_dict):
+    rankings = [{'a': 100, 'b': 90, 'c': 80, 'd': 1}, {'a': 100, 'b': 1, 'c': 80, 'd': 90}]
+    results = [None, None]
+    start_methods = [None, None]
+    started = threading.Barrier(2)
+
+    def build(i):
+        started.wait()
+        # Other threads are running, so the workers are not forked
+        start_methods[i] = pipeline._pool_context().get_start_method()
+        results[i] = get_pipeline(rankings[i], processes=2).build_recommenders(
+            CoinstallGraph.from_dict(coinstall_dict), tie_breaker_dict=rankings[i])
+
+    threads = [threading.Thread(target=build, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 'fork' not in start_methods
+    for ranking_dict, recommenders in zip(rankings, results):
+        expected = get_pipeline(ranking_dict).build_recommenders(
+            CoinstallGraph.from_dict(coinstall_dict), tie_breaker_dict=ranking_dict)
+        for name, recommender in recommenders.items():
+            assert dict(recommender.treated_graph) == dict(expected[name].treated_graph)
+
+
+def _unpicklable(self):
+    raise TypeError("can't pickle Logger objects")
+
+
+def test_workers_started_while_other_threads_run_map_the_prefix_output(coinstall_dict, ranking_dict):
+    stopped = threading.Event()
+    thread = threading.Thread(target=stopped.wait)
+    thread.start()
+    try:
+        # Loggers can not be pickled before Python 3.7
+        with patch.object(logging.Logger, '__reduce__', _unpicklable), \
+                patch.object(pipeline, '_share_prefix_output', wraps=pipeline._share_prefix_output) as share:
+            assert pipeline._pool_context().get_start_method() != 'fork'
+            recommenders = get_pipeline(ranking_dict, processes=2, logger=logging.getLogger('taarlite')) \
+                .build_recommenders(CoinstallGraph.from_dict(coinstall_dict), precompute_limit=2)
+    finally:
+        stopped.set()
+        thread.join()
+
+    assert share.called
+    expected = get_pipeline(ranking_dict).build_recommenders(CoinstallGraph.from_dict(coinstall_dict),
+                                                             precompute_limit=2)
+    for name, recommender in recommenders.items():
+        assert recommender.treated_graph == expected[name].treated_graph
+        assert recommender.top_n_table == expected[name].top_n_table
+
+
+def test_forked_branches_share_the_prefix_output(coinstall_dict, ranking_dict):
+    recommenders = get_pipeline(ranking_dict, processes=2).build_recommenders(
+        CoinstallGraph.from_dict(coinstall_dict), precompute_limit=2)
+    row_count, row_sum = recommenders['row_count'].treated_graph, recommenders['row_sum'].treated_graph
+    assert row_count.vocabulary is row_sum.vocabulary
+    assert np.shares_memory(row_count.matrix.indices, row_sum.matrix.indices)
+    assert not np.shares_memory(row_count.matrix.data, row_sum.matrix.data)
@@ -1,5 +1,8 @@
 import pytest
+from taar_lite.recommenders.graph import CoinstallGraph
 from taar_lite.recommenders.treatments import (
+    Guidception,
+    MinInstallPrune,
     NoTreatment,
     RowCount,
     RowNormSum,
@@ -92,6 +95,27 @@ def test_row_norm_sum_treatment(mock_data):
     assert expected_guid_2 == actual_guid_2
 
 
+def test_row_norm_sum_matches_list_accumulation(mock_data):
+    """RowNormSum used to keep every row normalized weight of a GUID in a
+    list and sum that list for each edge.  The streaming normalizer must give
+    identical results."""
+    guid_row_norm = {}
+    for coinstalls in mock_data.values():
+        rowsum = sum(coinstalls.values())
+        for coinstall_guid, coinstall_count in coinstalls.items():
+            guid_row_norm.setdefault(coinstall_guid, []).append(1.0 * coinstall_count / rowsum)
+
+    expected = {}
+    for guidkey, coinstalls in mock_data.items():
+        rowsum = sum(coinstalls.values())
+        expected[guidkey] = {
+            guid: (weight / rowsum) / sum(guid_row_norm[guid])
+            for guid, weight in coinstalls.items()
+        }
+
+    assert RowNormSum().treat(mock_data) == expected
+
+
 def test_row_sum_treatment(mock_data):
     # Numerator is the value for the coinstallation
     # for the looked-up guid.
@@ -108,3 +132,68 @@ def test_row_sum_treatment(mock_data):
     treated_data = treatment.treat(mock_data)
     actual_guid_2 = treated_data['guid-2']
     assert expected_guid_2 == actual_guid_2
+
+
+@pytest.mark.parametrize('treatment', [
+    NoTreatment(), RowCount(), RowNormSum(), RowSum(), Guidception(), Guidception(depth=4, damping=0.3)
+])
+def test_treat_graph_matches_treat(mock_data, treatment):
+    expected = treatment.treat(mock_data)
+    actual = treatment.treat_graph(CoinstallGraph.from_dict(mock_data))
+    assert list(actual) == list(expected)
+    for guid, coinstalls in expected.items():
+        assert actual[guid] == pytest.approx(coinstalls)
+
+
+def test_min_install_prune_treat_graph_matches_treat(mock_data):
+    ranking_dict = {'guid-1': 100, 'guid-2': 1, 'guid-3': 90, 'guid-6': 50}
+    expected = MinInstallPrune().treat(mock_data, ranking_dict=ranking_dict)
+    actual = MinInstallPrune().treat_graph(CoinstallGraph.from_dict(mock_data), ranking_dict=ranking_dict)
+    assert actual == expected
+
+
+def test_guidception_treatment(mock_data):
+    # The values documented by the original recursive implementation
+    expected_guid_2 = {
+        'guid-1': 0.2666666666666667,
+        'guid-3': 0.23333333333333334,
+        'guid-4': 0.16666666666666666,
+        'guid-8': 0.2,
+        'guid-9': 0.13333333333333333
+    }
+    treated_data = Guidception().treat(mock_data)
+    assert treated_data['guid-2'] == pytest.approx(expected_guid_2)
+
+    # and the other rows it produced
+    assert treated_data['guid-1'] == pytest.approx({
+        'guid-2': 0.6107114308553158,
+        'guid-3': 0.16107114308553153,
+        'guid-4': 0.11610711430855315,
+        'guid-5': 0.0004996003197442046,
+        'guid-6': 0.11161071143085532
+    })
+    assert treated_data['guid-6'] == pytest.approx({
+        'guid-1': 0.15222482435597193,
+        'guid-7': 0.1873536299765808,
+        'guid-8': 0.33021077283372363,
+        'guid-9': 0.33021077283372363
+    })
+    assert treated_data['guid-4'] == pytest.approx({'guid-2': 1.0})
+
+
+def test_guidception_depth_credits_walks_that_continue(mock_data):
+    # guid-5 and guid-7 have no row, so walks through guid-1 and guid-6
+    # can end after two steps and those guids lose weight with depth.
+    shallow = Guidception(depth=2).treat(mock_data)['guid-2']
+    deep = Guidception(depth=3, damping=1.0).treat(mock_data)['guid-2']
+    assert deep['guid-1'] / deep['guid-3'] < shallow['guid-1'] / shallow['guid-3']
+    assert sum(deep.values()) == pytest.approx(1.0)
+
+    # A depth of 1 only row normalizes
+    assert Guidception(depth=1).treat(mock_data)['guid-4'] == {'guid-2': 1.0}
+    assert Guidception(depth=1).treat(mock_data)['guid-2']['guid-1'] == pytest.approx(50 / 150)
+
+
+def test_guidception_rejects_depth_below_one():
+    with pytest.raises(ValueError):
+        Guidception(depth=0)